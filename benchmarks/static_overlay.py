@@ -0,0 +1,100 @@
+"""
+Compare drawtext/drawbox burn-ins against the pre-rasterized static layer.
+
+Usage:
+    python benchmarks/static_overlay.py [--frames 240] [--font path.ttf]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dwencode.encode import encode  # noqa: E402
+from dwencode.ffpath import get_ffmpeg_path  # noqa: E402
+
+
+RESOLUTIONS = {'1080p': (1920, 1080), '4K': (3840, 2160)}
+
+
+def create_sequence(directory, width, height, frames):
+    pattern = os.path.join(directory, 'frame.%04d.jpg').replace('\\', '/')
+    subprocess.check_call([
+        get_ffmpeg_path(), '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'testsrc=size=%ix%i:rate=24' % (width, height),
+        '-frames:v', str(frames), '-start_number', '1', '-q:v', '2',
+        pattern])
+    return pattern
+
+
+def get_overlays(width, height):
+    rectangles = [
+        dict(x=int(width * .1), y=int(height * .1), width=int(width * .8),
+             height=int(height * .8), color='#FFEE55', opacity=.2,
+             thickness=2),
+        dict(x=int(width * .15), y=int(height * .15), width=int(width * .7),
+             height=int(height * .7), color='#909090', opacity=.3,
+             thickness=1)]
+    return dict(
+        top_left='{datetime}',
+        top_middle='proj_ep010_sq120_sh0170_spline_v002_tk001',
+        top_middle_color='#FFEE55',
+        top_right='DreamWall',
+        bottom_left='f:35.0mm',
+        bottom_middle='{framerange}',
+        bottom_right='John Doe',
+        rectangles=rectangles)
+
+
+def time_encode(
+        pattern, size, output_path, frames, static_overlay, font_path):
+    width, height = size
+    start_time = time.time()
+    encode(
+        images_path=pattern,
+        output_path=output_path,
+        start=1,
+        end=frames,
+        source_width=width,
+        source_height=height,
+        font_path=font_path,
+        static_overlay=static_overlay,
+        overwrite=True,
+        **get_overlays(width, height))
+    return frames / (time.time() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=240)
+    parser.add_argument('--font', help='ttf font (default: ffmpeg default)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='dwencode_bench_')
+    try:
+        print('%-6s %14s %14s %8s' % (
+            '', 'drawtext fps', 'static fps', 'gain'))
+        for name, (width, height) in RESOLUTIONS.items():
+            sequence_directory = os.path.join(directory, name)
+            os.makedirs(sequence_directory)
+            pattern = create_sequence(
+                sequence_directory, width, height, args.frames)
+            output_path = os.path.join(directory, name + '.mov')
+            drawtext_fps = time_encode(
+                pattern, (width, height), output_path, args.frames, False,
+                args.font)
+            static_fps = time_encode(
+                pattern, (width, height), output_path, args.frames, True,
+                args.font)
+            print('%-6s %14.1f %14.1f %7.2fx' % (
+                name, drawtext_fps, static_fps, static_fps / drawtext_fps))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
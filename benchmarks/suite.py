@@ -0,0 +1,300 @@
+"""
+Reproducible benchmarks on synthetic media generated locally with the lavfi
+"testsrc" and "sine" sources (nothing to download).
+
+Measures:
+- encode(): frames per second across resolutions, codecs and overlays
+- concatenate_videos() and pyav.concatenate_videos(): clips per second
+- probe: latency per backend
+
+Results are written as JSON. Compare two runs with --compare.
+
+Usage:
+    python benchmarks/suite.py [--output results.json] [--quick]
+    python benchmarks/suite.py --compare before.json after.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import functools
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dwencode.encode import encode  # noqa: E402
+from dwencode.concatenate import concatenate_videos  # noqa: E402
+from dwencode.ffpath import get_ffmpeg_path  # noqa: E402
+
+
+RESOLUTIONS = {
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4K': (3840, 2160),
+}
+CODECS = {
+    'h264': '-vcodec libx264 -pix_fmt yuv420p',
+    'prores': '-vcodec prores_ks -profile:v 2',
+    'mjpeg': '-vcodec mjpeg -q:v 3',
+}
+OVERLAYS = ('none', 'drawtext', 'static')
+CLIPS_COUNTS = (10, 100, 1000)
+PYAV_CLIPS_COUNTS = (10, 100)
+CLIP_FRAMES = 24
+PROBE_REPEATS = 20
+# Results with the same key are compared between runs:
+KEYS = ('benchmark', 'backend', 'resolution', 'codec', 'overlays', 'clips')
+
+
+def run_lavfi(output_path, video_source, audio_source=None, args=None):
+    cmd = [
+        get_ffmpeg_path(), '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', video_source]
+    if audio_source:
+        cmd += ['-f', 'lavfi', '-i', audio_source, '-shortest']
+    subprocess.check_call(cmd + (args or []) + [output_path])
+
+
+def create_sequence(directory, width, height, frames):
+    pattern = os.path.join(directory, 'frame.%04d.jpg').replace('\\', '/')
+    run_lavfi(
+        pattern, 'testsrc=size=%ix%i:rate=24' % (width, height),
+        args=['-frames:v', str(frames), '-start_number', '1', '-q:v', '2'])
+    return pattern
+
+
+def create_clips(directory, count, frames=CLIP_FRAMES):
+    """Encode one short h264/aac clip and copy it @count times."""
+    clip_path = os.path.join(directory, 'source.mov')
+    if not os.path.exists(clip_path):
+        run_lavfi(
+            clip_path, 'testsrc=size=640x360:rate=24',
+            'sine=frequency=440:sample_rate=48000',
+            ['-frames:v', str(frames), '-c:v', 'libx264', '-pix_fmt',
+             'yuv420p', '-c:a', 'aac'])
+    clips_directory = os.path.join(directory, 'clips_%i' % count)
+    os.makedirs(clips_directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(clips_directory, 'clip_%04i.mov' % i)
+        shutil.copyfile(clip_path, path)
+        paths.append(path.replace('\\', '/'))
+    return paths
+
+
+def get_overlays(overlays, width, height):
+    if overlays == 'none':
+        return dict()
+    rectangles = [
+        dict(x=int(width * .1), y=int(height * .1), width=int(width * .8),
+             height=int(height * .8), color='#FFEE55', opacity=.2,
+             thickness=2)]
+    return dict(
+        top_left='{datetime}',
+        top_middle='proj_ep010_sq120_sh0170_spline_v002_tk001',
+        top_right='DreamWall',
+        bottom_middle='{framerange}',
+        rectangles=rectangles,
+        static_overlay=overlays == 'static')
+
+
+def timed(function, *args, **kwargs):
+    """Return (seconds, error message or None)."""
+    start_time = time.perf_counter()
+    try:
+        function(*args, **kwargs)
+        error = None
+    except Exception as e:
+        error = str(e).strip().splitlines()[-1] if str(e).strip() else repr(e)
+    return time.perf_counter() - start_time, error
+
+
+def bench_encode(directory, resolutions, codecs, frames, font_path=None):
+    results = []
+    for name in resolutions:
+        width, height = RESOLUTIONS[name]
+        sequence_directory = os.path.join(directory, 'sequence_' + name)
+        os.makedirs(sequence_directory)
+        pattern = create_sequence(sequence_directory, width, height, frames)
+        for codec in codecs:
+            for overlays in OVERLAYS:
+                seconds, error = timed(
+                    encode, pattern, os.path.join(directory, 'encode.mov'),
+                    start=1, end=frames, source_width=width,
+                    source_height=height, video_codec=CODECS[codec],
+                    font_path=font_path, overwrite=True,
+                    **get_overlays(overlays, width, height))
+                results.append(dict(
+                    benchmark='encode', resolution=name, codec=codec,
+                    overlays=overlays, frames=frames, seconds=seconds,
+                    fps=None if error else frames / seconds, error=error))
+                print_result(results[-1])
+    return results
+
+
+def _consume(iterator):
+    for _ in iterator:
+        pass
+
+
+def bench_concatenate(directory, clips_counts, pyav_clips_counts):
+    results = []
+    output_path = os.path.join(directory, 'concatenate.mov')
+    for count in sorted(set(clips_counts) | set(pyav_clips_counts)):
+        paths = create_clips(directory, count)
+        backends = []
+        if count in clips_counts:
+            backends.append(('ffmpeg', lambda: concatenate_videos(
+                paths, output_path, overwrite=True)))
+        if count in pyav_clips_counts:
+            backends.append(('pyav', lambda: _concatenate_pyav(
+                paths, output_path)))
+        for backend, function in backends:
+            seconds, error = timed(function)
+            results.append(dict(
+                benchmark='concatenate', backend=backend, clips=count,
+                frames=count * CLIP_FRAMES, seconds=seconds,
+                clips_per_second=None if error else count / seconds,
+                error=error))
+            print_result(results[-1])
+    return results
+
+
+def _concatenate_pyav(paths, output_path):
+    from dwencode import pyav
+    _consume(pyav.concatenate_videos(paths, output_path))
+
+
+def get_probe_backends():
+    """Return {name: function(path)} of the installed probe backends."""
+    from dwencode import probe
+    return {
+        backend.name: functools.partial(
+            probe.get_video_duration, backend=backend.name)
+        for backend in probe.BACKENDS if backend.is_available()}
+
+
+def bench_probe(directory, repeats=PROBE_REPEATS):
+    results = []
+    path = create_clips(directory, 1)[0]
+    for backend, function in sorted(get_probe_backends().items()):
+        seconds, error = timed(
+            lambda: [function(path) for _ in range(repeats)])
+        results.append(dict(
+            benchmark='probe', backend=backend, repeats=repeats,
+            seconds=seconds,
+            latency_ms=None if error else seconds / repeats * 1000,
+            error=error))
+        print_result(results[-1])
+    return results
+
+
+def print_result(result):
+    key = ' '.join(str(result[k]) for k in KEYS if result.get(k) is not None)
+    if result['error']:
+        print('%-40s ERROR: %s' % (key, result['error']))
+        return
+    for name in ('fps', 'clips_per_second', 'latency_ms'):
+        if result.get(name) is not None:
+            print('%-40s %10.2f %s' % (key, result[name], name))
+
+
+def get_environment():
+    try:
+        ffmpeg_version = subprocess.check_output(
+            [get_ffmpeg_path(), '-version']).decode().splitlines()[0]
+    except Exception:
+        ffmpeg_version = None
+    return dict(
+        date=datetime.datetime.now().isoformat(),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        cpu_count=os.cpu_count(),
+        ffmpeg=ffmpeg_version)
+
+
+def compare(before_path, after_path, threshold=0.05):
+    """Print the speed ratio of the results found in both runs."""
+    with open(before_path) as f:
+        before = {
+            tuple(r.get(k) for k in KEYS): r for r in json.load(f)['results']}
+    with open(after_path) as f:
+        after = json.load(f)['results']
+    regressions = 0
+    for result in after:
+        key = tuple(result.get(k) for k in KEYS)
+        previous = before.get(key)
+        if not previous or previous['error'] or result['error']:
+            continue
+        ratio = previous['seconds'] / result['seconds']  # > 1 is faster
+        status = ''
+        if ratio < 1 - threshold:
+            status = 'REGRESSION'
+            regressions += 1
+        elif ratio > 1 + threshold:
+            status = 'faster'
+        name = ' '.join(str(k) for k in key if k is not None)
+        print('%-40s %6.2fx %s' % (name, ratio, status))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--frames', type=int, default=96)
+    parser.add_argument(
+        '--resolutions', nargs='+', default=['720p', '1080p'],
+        choices=sorted(RESOLUTIONS))
+    parser.add_argument(
+        '--codecs', nargs='+', default=sorted(CODECS), choices=sorted(CODECS))
+    parser.add_argument(
+        '--clips', nargs='+', type=int, default=list(CLIPS_COUNTS))
+    parser.add_argument(
+        '--pyav-clips', nargs='+', type=int, default=list(PYAV_CLIPS_COUNTS))
+    parser.add_argument(
+        '--skip', nargs='+', default=[],
+        choices=['encode', 'concatenate', 'probe'])
+    parser.add_argument('--font', help='ttf font (default: ffmpeg default)')
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='Small run: 720p, h264, 24 frames, 10 clips.')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+        help='Compare two results files instead of running benchmarks.')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+    if args.quick:
+        args.resolutions, args.codecs, args.frames = ['720p'], ['h264'], 24
+        args.clips = args.pyav_clips = [10]
+
+    directory = tempfile.mkdtemp(prefix='dwencode_bench_')
+    results = []
+    try:
+        if 'encode' not in args.skip:
+            results += bench_encode(
+                directory, args.resolutions, args.codecs, args.frames,
+                args.font)
+        if 'concatenate' not in args.skip:
+            results += bench_concatenate(
+                directory, args.clips, args.pyav_clips)
+        if 'probe' not in args.skip:
+            results += bench_probe(directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(
+            environment=get_environment(), arguments=vars(args),
+            results=results), f, indent=2)
+    print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
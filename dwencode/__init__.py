@@ -2,6 +2,7 @@ __author__ = 'Olivier Evers'
 __copyright__ = 'DreamWall'
 __license__ = 'MIT'
 
-from dwencode.encode import encode, extract_image_from_video
+from dwencode.encode import encode, encode_frames, extract_image_from_video
+from dwencode.batch import encode_many, encode_chunked
 from dwencode.concatenate import concatenate_videos
 from dwencode.thumbnail import create_thumbnail
@@ -46,6 +46,9 @@ parser.add_argument('-i', '--overlay-image', help='path-x-y')
 parser.add_argument(
     '-box', '--rectangle', action='append',
     help='x-y-width-height-color-opacity-thickness')
+parser.add_argument(
+    '-so', '--static-overlay', default=False, action='store_true',
+    help='rasterize static texts and rectangles once (needs Pillow)')
 
 parser.add_argument('-c:v', '--video-codec')
 parser.add_argument('-c:a', '--audio-codec')
@@ -63,8 +66,6 @@ args = parser.parse_args()
 
 # Reformat some args:
 images_path = args.images_path
-for i in range(8, 0, -1):
-    images_path = images_path.replace('#' * i, '%0{}d'.format(i))
 
 rectangles = []
 for rectangle in args.rectangle or []:
@@ -137,6 +138,7 @@ encode.encode(
 
     overlay_image=overlay_image,
     rectangles=rectangles,
+    static_overlay=args.static_overlay,
 
     video_codec=args.video_codec,
     audio_codec=args.audio_codec,
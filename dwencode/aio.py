@@ -0,0 +1,261 @@
+"""
+Asyncio versions of encode, concatenate_videos and probe.
+
+FFmpeg runs with asyncio.create_subprocess_exec, so the event loop is never
+blocked. Cancelling a coroutine kills its FFmpeg process. The number of
+simultaneous processes is limited by semaphores (see set_limit).
+"""
+
+__author__ = 'Olivier Evers'
+__copyright__ = 'DreamWall'
+__license__ = 'MIT'
+
+
+import os
+import locale
+import asyncio
+import inspect
+import weakref
+import functools
+from collections import deque
+
+from dwencode.concatenate import (
+    DEFAULT_CONCAT_ENCODING, get_concatenate_command, get_master_paths)
+from dwencode.encode import get_encode_command, remove_temp_files
+from dwencode.probe.cache import get_cache
+from dwencode.probe.ffprobe import get_probe_command, load_probe_output
+from dwencode.progress import STDERR_MAX_LINES, ProgressParser
+
+
+LIMITS = {
+    'encode': max(1, (os.cpu_count() or 1) // 4),
+    'concatenate': max(1, (os.cpu_count() or 1) // 4),
+    'probe': 32,
+}
+_semaphores = weakref.WeakKeyDictionary()  # {loop: {kind: semaphore}}
+_END = object()
+
+
+def set_limit(kind, value):
+    """
+    Set the maximum number of simultaneous FFmpeg processes of a kind
+    ("encode", "concatenate" or "probe"). Applies to semaphores created
+    afterwards, i.e. call it before starting the jobs.
+    """
+    if kind not in LIMITS:
+        raise ValueError('Unknown kind: %s' % kind)
+    LIMITS[kind] = value
+    for semaphores in _semaphores.values():
+        semaphores.pop(kind, None)
+
+
+def get_semaphore(kind):
+    """Return the default semaphore of a kind for the running event loop."""
+    semaphores = _semaphores.setdefault(asyncio.get_running_loop(), dict())
+    if kind not in semaphores:
+        semaphores[kind] = asyncio.Semaphore(LIMITS[kind])
+    return semaphores[kind]
+
+
+async def _read_stderr(stream, lines, verbose):
+    encoding = locale.getpreferredencoding()
+    async for line in stream:
+        line = line.decode(encoding, errors='replace').rstrip()
+        lines.append(line)
+        if verbose:
+            print(line)
+
+
+async def _iter_chunks(chunks):
+    """
+    Yield the chunks of an async or regular iterable. Regular iterables
+    (e.g. frames rendered on the fly) are advanced in the default executor
+    to not block the event loop.
+    """
+    if hasattr(chunks, '__aiter__'):
+        async for chunk in chunks:
+            yield chunk
+        return
+    loop = asyncio.get_running_loop()
+    iterator = iter(chunks)
+    while True:
+        chunk = await loop.run_in_executor(None, next, iterator, _END)
+        if chunk is _END:
+            return
+        yield chunk
+
+
+async def _run_in_executor(function, *args, **kwargs):
+    """
+    Run a blocking function (command builders scanning directories, probing
+    movies or reading the probe cache) in the default executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(function, *args, **kwargs))
+
+
+async def _write_stdin(stream, chunks):
+    try:
+        async for chunk in _iter_chunks(chunks):
+            stream.write(chunk)
+            await stream.drain()  # waits while FFmpeg is busy
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # FFmpeg exited, its return code reports the error
+    finally:
+        stream.close()
+
+
+async def _kill(proc):
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+
+
+async def iter_progress(
+        cmd, total_frames=None, total_duration=None, cwd=None,
+        verbose=False, stdin_chunks=None, semaphore=None):
+    """
+    Launch an FFmpeg command (list of args) containing PROGRESS_ARGS and
+    asynchronously yield dwencode.progress.Progress events.
+
+    @stdin_chunks is an optional iterable, or async iterable, of bytes-like
+    objects written to FFmpeg stdin. Regular iterables are advanced in the
+    default executor, so slow generators do not block the event loop.
+
+    The process is killed if the iteration is cancelled or stopped early.
+    Raise an Exception with the end of stderr if FFmpeg fails.
+    """
+    async with semaphore or get_semaphore('encode'):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, cwd=cwd,
+            stdin=None if stdin_chunks is None else asyncio.subprocess.PIPE)
+        stderr_lines = deque(maxlen=STDERR_MAX_LINES)
+        tasks = [asyncio.ensure_future(
+            _read_stderr(proc.stderr, stderr_lines, verbose))]
+        if stdin_chunks is not None:
+            tasks.append(asyncio.ensure_future(
+                _write_stdin(proc.stdin, stdin_chunks)))
+
+        parser = ProgressParser(total_frames, total_duration)
+        encoding = locale.getpreferredencoding()
+        try:
+            async for line in proc.stdout:
+                event = parser.feed(line.decode(encoding, errors='replace'))
+                if event is not None:
+                    yield event
+            await proc.wait()
+            await asyncio.gather(*tasks)
+        finally:
+            await _kill(proc)
+            for task in tasks:
+                task.cancel()
+    if proc.returncode != 0:
+        raise Exception('\n'.join(stderr_lines))
+
+
+async def run_ffmpeg(
+        cmd, progress_callback=None, total_frames=None, total_duration=None,
+        cwd=None, verbose=False, stdin_chunks=None, semaphore=None):
+    """
+    Run an FFmpeg command (list of args), calling @progress_callback with
+    each Progress event. The callback can be a coroutine function.
+    """
+    events = iter_progress(
+        cmd, total_frames, total_duration, cwd, verbose, stdin_chunks,
+        semaphore)
+    try:
+        async for event in events:
+            if not progress_callback:
+                continue
+            result = progress_callback(event)
+            if inspect.isawaitable(result):
+                await result
+    finally:
+        await events.aclose()
+
+
+async def encode(
+        images_path, output_path, *args, progress_callback=None,
+        semaphore=None, **kwargs):
+    """
+    Same as dwencode.encode(), as a coroutine.
+
+    - progress_callback (callable or coroutine function) Called with
+        dwencode.progress.Progress events
+    - semaphore (asyncio.Semaphore) Limits simultaneous processes. Default
+        is shared by all encodes (see set_limit)
+    """
+    command = await _run_in_executor(
+        get_encode_command, images_path, output_path, *args,
+        progress=bool(progress_callback), **kwargs)
+    try:
+        await run_ffmpeg(
+            command.args, progress_callback, command.total_frames,
+            verbose=kwargs.get('verbose', False),
+            stdin_chunks=command.stdin_chunks,
+            semaphore=semaphore or get_semaphore('encode'))
+    finally:
+        remove_temp_files(command.temp_paths)
+
+
+async def concatenate_videos(
+        paths, output_path, verbose=False, ffmpeg_path=None, delete_list=True,
+        ffmpeg_codec=DEFAULT_CONCAT_ENCODING, overwrite=False,
+        stack_orientation='horizontal', stack_master_list=0,
+        progress_callback=None, semaphore=None, grid=None):
+    """
+    Same as dwencode.concatenate_videos(), as a coroutine.
+    Movies durations are probed asynchronously for the progress ETA.
+    """
+    total_duration = None
+    if progress_callback:
+        datas = await probe_many(get_master_paths(paths, stack_master_list))
+        durations = [d.get('format', {}).get('duration') for d in datas]
+        if None not in durations:  # else ETA falls back to frame counts
+            total_duration = sum(float(d) for d in durations)
+    cmd, list_paths = await _run_in_executor(
+        get_concatenate_command, paths, output_path, ffmpeg_path,
+        ffmpeg_codec, overwrite, stack_orientation, stack_master_list,
+        bool(progress_callback), grid)
+    try:
+        await run_ffmpeg(
+            cmd, progress_callback, total_duration=total_duration,
+            verbose=verbose,
+            semaphore=semaphore or get_semaphore('concatenate'))
+    finally:
+        if delete_list:
+            remove_temp_files(list_paths)
+
+
+async def probe(
+        vid_file_path, ffprobe_path=None, semaphore=None, use_cache=True):
+    """Same as dwencode.probe.ffprobe.probe(), as a coroutine."""
+    cache = get_cache() if use_cache else None
+    if cache:
+        data = await _run_in_executor(cache.get, vid_file_path, 'ffprobe')
+        if data:
+            return data
+    command = get_probe_command(vid_file_path, ffprobe_path)
+    async with semaphore or get_semaphore('probe'):
+        proc = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, cwd=os.path.expanduser('~'))
+        try:
+            out, err = await proc.communicate()
+        finally:
+            await _kill(proc)
+    data = load_probe_output(out, err, proc.returncode, vid_file_path)
+    if cache and data.get('streams'):
+        await _run_in_executor(cache.set, vid_file_path, 'ffprobe', data)
+    return data
+
+
+async def probe_many(paths, ffprobe_path=None, semaphore=None):
+    """Probe movies concurrently. Return the results in the paths order."""
+    return await asyncio.gather(*[
+        probe(path, ffprobe_path, semaphore) for path in paths])
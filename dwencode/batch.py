@@ -0,0 +1,212 @@
+"""
+Run many FFmpeg encodes at once without oversubscribing the machine.
+"""
+
+__author__ = 'Olivier Evers'
+__copyright__ = 'DreamWall'
+__license__ = 'MIT'
+
+
+import os
+import time
+import shlex
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dwencode.concatenate import create_list_file
+from dwencode.encode import encode, get_image_format, get_sound_args
+from dwencode.ffpath import get_ffmpeg_path
+from dwencode.progress import run_ffmpeg
+from dwencode.sequence import conform_pattern, scan_sequence
+
+
+EncodeResult = namedtuple(
+    'EncodeResult', ['job', 'output_path', 'error', 'duration'])
+
+
+def get_workers_and_threads(jobs_count, max_workers=None, threads=None):
+    """
+    Split the cpu cores between the concurrent encodes.
+    By default, each FFmpeg process gets 4 threads.
+    """
+    cpu_count = os.cpu_count() or 1
+    if not max_workers:
+        max_workers = max(1, cpu_count // (threads or 4))
+    max_workers = max(1, min(max_workers, jobs_count))
+    if not threads:
+        threads = max(1, cpu_count // max_workers)
+    return max_workers, threads
+
+
+def _run_job(job, threads):
+    job = dict(job)
+    job.setdefault('threads', threads)
+    start_time = time.time()
+    try:
+        encode(**job)
+        error = None
+    except Exception as e:
+        error = e
+    return EncodeResult(
+        job, job.get('output_path'), error, time.time() - start_time)
+
+
+def encode_many(jobs, max_workers=None, threads=None, callback=None):
+    """
+    Encode multiple image sequences in parallel.
+
+    - jobs (list of dicts) encode() keyword arguments, one dict per movie
+    - max_workers (int) Number of simultaneous FFmpeg processes. Default
+        is based on the cpu count and on the threads per job.
+    - threads (int) Threads given to each FFmpeg process. Default splits
+        the cpu count between the workers. Jobs specifying their own
+        "threads" value are left untouched.
+    - callback (callable) Called with each EncodeResult when it finishes,
+        from the calling thread. Its exceptions stop the batch.
+
+    A failing job does not stop the batch: its exception is stored in the
+    "error" field of its result. Results are returned in the jobs order.
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    max_workers, threads = get_workers_and_threads(
+        len(jobs), max_workers, threads)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_run_job, job, threads) for job in jobs]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                if callback:
+                    callback(result)
+        except BaseException:
+            for future in futures:
+                future.cancel()  # do not start the remaining jobs
+            raise
+        return [future.result() for future in futures]
+
+
+def get_chunks_ranges(start, end, chunks):
+    """Split [start, end] into contiguous frame ranges of similar length."""
+    frames_count = end - start + 1
+    chunks = max(1, min(chunks, frames_count))
+    ranges = []
+    chunk_start = start
+    for i in range(chunks):
+        chunk_size = frames_count // chunks + (i < frames_count % chunks)
+        ranges.append((chunk_start, chunk_start + chunk_size - 1))
+        chunk_start += chunk_size
+    return ranges
+
+
+def encode_chunked(
+        images_path,
+        output_path,
+        start=None,
+        end=None,
+        chunks=None,
+        max_workers=None,
+        threads=None,
+        frame_rate=None,
+        sound_path=None,
+        sound_offset=None,
+        video_codec=None,
+        audio_codec=None,
+        add_silent_audio=False,
+        silence_settings=None,
+        ffmpeg_path=None,
+        metadata=None,
+        overwrite=False,
+        verbose=False,
+        **kwargs):
+    """
+    Encode a long image sequence as several frame ranges in parallel, then
+    stream copy them into a single movie with the concat demuxer.
+
+    - chunks (int) Number of frame ranges. Default is the number of workers.
+    - max_workers (int) Number of simultaneous FFmpeg processes.
+    - threads (int) Threads given to each FFmpeg process.
+
+    Other arguments are the same as encode(). Chunks are encoded with closed
+    GOPs and {frame}/{framerange} texts display the global frame numbers.
+    Sound and metadata are added when concatenating the chunks.
+    """
+    images_path = conform_pattern(images_path)
+    sequence = scan_sequence(images_path)
+    if sequence:
+        start = sequence.first if start is None else start
+        end = sequence.last if end is None else end
+    if end is None:
+        raise ValueError('Chunked encoding needs an end frame.')
+    ffmpeg_path = get_ffmpeg_path(ffmpeg_path)
+    frame_rate = frame_rate or 24
+    start = start or 0
+
+    # Read source format only once:
+    if not (kwargs.get('source_width') and kwargs.get('source_height')):
+        first_image = images_path % start
+        if sequence:
+            first_image = sequence.path(sequence.get_existing_frame(start))
+        kwargs['source_width'], kwargs['source_height'] = get_image_format(
+            first_image)
+
+    max_workers, threads = get_workers_and_threads(
+        chunks or end - start + 1, max_workers, threads)
+    ranges = get_chunks_ranges(start, end, chunks or max_workers)
+    video_codec = (video_codec or '-vcodec libx264') + ' -flags +cgop'
+
+    temp_directory = tempfile.mkdtemp(prefix='dwencode_chunks_')
+    try:
+        extension = os.path.splitext(output_path)[-1]
+        jobs = []
+        for i, (chunk_start, chunk_end) in enumerate(ranges):
+            chunk_path = os.path.join(
+                temp_directory, 'chunk_%04i%s' % (i, extension))
+            jobs.append(dict(
+                images_path=images_path,
+                output_path=chunk_path.replace('\\', '/'),
+                start=chunk_start,
+                end=chunk_end,
+                framerange=(start, end),
+                frame_rate=frame_rate,
+                video_codec=video_codec,
+                ffmpeg_path=ffmpeg_path,
+                overwrite=True,
+                verbose=verbose,
+                **kwargs))
+        results = encode_many(jobs, max_workers, threads)
+        for result in results:
+            if result.error:
+                raise result.error
+
+        # Concatenate chunks
+        list_path = create_list_file(
+            [result.output_path for result in results])
+        cmd = ffmpeg_path
+        if not verbose:
+            cmd += ' -hide_banner -loglevel error -nostats'
+        cmd += ' -f concat -safe 0 -i "%s"' % list_path
+        sound_input_args, sound_output_args = get_sound_args(
+            sound_path, sound_offset, audio_codec, add_silent_audio,
+            silence_settings, (end - start + 1) / frame_rate)
+        cmd += sound_input_args
+        cmd += ' -map 0:v'
+        if sound_input_args:
+            cmd += ' -map 1:a'
+        for key, value in metadata or []:
+            cmd += ' -metadata %s="%s"' % (key, value)
+        cmd += ' -c:v copy' + sound_output_args
+        if overwrite:
+            cmd += ' -y'
+        cmd += ' "%s"' % output_path
+
+        print(cmd)
+        try:
+            run_ffmpeg(shlex.split(cmd), verbose=verbose)
+        finally:
+            os.remove(list_path)
+    finally:
+        shutil.rmtree(temp_directory, ignore_errors=True)
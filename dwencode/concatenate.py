@@ -4,143 +4,680 @@ __license__ = 'MIT'
 
 
 import os
+import re
+import math
+import bisect
 import shlex
-import locale
+import shutil
+import tempfile
 import subprocess as sp
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+
+from dwencode.encode import get_sound_args
 from dwencode.ffpath import get_ffmpeg_path
+from dwencode.probe import QUICKTIME_EXTENSIONS
+from dwencode.progress import PROGRESS_ARGS, run_ffmpeg
+from dwencode.sequence import escape_concat_path
 
 
 DEFAULT_CONCAT_ENCODING = '-vcodec copy -c:a copy'
 DEFAULT_CONCAT_STACK_ENCODING = (
     '-c:v libx264 -crf 26 -preset fast -tune animation -c:a aac -b:a 128k')
-STACKED_ARGS = (
-    "color=d=0.1[c];[c][0]scale2ref[c][v1];"
-    "[c][1]scale2ref='{scale2ref}'[c][v2];"
-    "[c][v1]overlay=0:0[ol-vid1];"
-    "[ol-vid1][v2]overlay={overlay},setsar=1")
-
-
-def get_common_root(paths):
-    paths = [os.path.normpath(p).replace('\\', '/') for p in paths]
-    root = os.path.commonprefix(paths)
-    if not root or os.path.normpath(root) != os.path.abspath(root):
-        # os.path.exists('/') returns True on Windows...
-        raise Exception('Videos need to be on the same disk.')
-    if not os.path.isdir(root):
-        root = os.path.dirname(root)
-    if root.endswith('/'):
-        root = root[:-1]
-    return root
+STACK_CELL_FILTERS = (
+    '[{index}:v]scale={width}:{height}:force_original_aspect_ratio=decrease,'
+    'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1[cell{index}]')
+# Stream parameters which need to match to concatenate with stream copy:
+CONFORM_KEYS = (
+    'video_codec', 'width', 'height', 'fps', 'pix_fmt', 'audio_codec',
+    'sample_rate', 'channels')
+CONFORM_VIDEO_ENCODERS = {
+    # Parameter sets repeated in-band, see ANNEXB_FILTERS
+    'h264': '-c:v libx264 -crf 16 -preset fast -x264-params repeat-headers=1',
+    'hevc': '-c:v libx265 -crf 18 -preset fast -x265-params repeat-headers=1',
+    'prores': '-c:v prores_ks -profile:v 3',
+    'dnxhd': '-c:v dnxhd -profile:v dnxhr_hq',
+    'mjpeg': '-c:v mjpeg -q:v 2',
+    'mpeg4': '-c:v mpeg4 -q:v 2',
+    'png': '-c:v png',
+}
+# Bitstream filters writing the parameter sets (SPS/PPS) of stream copied
+# movies in-band, before each keyframe: once concatenated, movies encoded
+# with different settings stay decodable although the output only keeps the
+# first codec extradata. Encoders do it with their "repeat-headers" option.
+ANNEXB_FILTERS = {
+    'h264': 'h264_mp4toannexb',
+    'hevc': 'hevc_mp4toannexb',
+}
+# The concat demuxer already applies the H.264 filter to the movies it reads
+# ("auto_convert" option), other codecs need to be remuxed:
+CONCAT_AUTO_CONVERTED_CODECS = ('h264',)
+# avcC profile_idc: x264 profile
+AVC_PROFILES = {
+    66: 'baseline', 77: 'main', 100: 'high', 110: 'high10', 122: 'high422',
+    244: 'high444'}
+CONFORM_AUDIO_ENCODERS = {
+    'aac': '-c:a aac -b:a 192k',
+    'mp3': '-c:a libmp3lame -b:a 192k',
+    'opus': '-c:a libopus -b:a 192k',
+    'flac': '-c:a flac',
+    'alac': '-c:a alac',
+}
 
 
 def get_videos_durations(paths):
-    from dwencode.probe import get_video_duration
+    """
+    Movies are probed once: their information are kept in the persistent
+    probe cache (see dwencode.probe.cache).
+    """
+    from dwencode.probe import get_movies_infos
     durations = []
-    for path in paths:
-        try:
-            durations.append(get_video_duration(path))
-        except ValueError:
+    for path, info in zip(paths, get_movies_infos(paths)):
+        duration = info['video_duration'] or info['duration']
+        if not duration:
             print('ERROR: Could not get duration of %s' % path)
-            raise
+            raise ValueError('Unknown duration: %s' % path)
+        durations.append(duration)
     return durations
 
 
-def create_list_file(paths, root, index=0, timings=None):
-    concat_list = []
+def get_frames_count(info, path):
+    """
+    Return the frames count of a movie information (see get_movies_infos),
+    computed from its duration if unknown (e.g. no nb_frames in the stream).
+    """
+    if info.get('frames'):
+        return info['frames']
+    duration = info.get('video_duration') or info.get('duration')
+    if not duration or not info.get('fps'):
+        raise ValueError('Unknown frames count: %s' % path)
+    return int(round(duration * info['fps']))
+
+
+def get_stream_params(info):
+    """Return the dwencode.probe movie information of CONFORM_KEYS."""
+    params = {key: info.get(key) for key in CONFORM_KEYS}
+    if params['fps']:
+        params['fps'] = round(params['fps'], 3)
+    return params
+
+
+def _is_compatible(params, reference):
+    for key in CONFORM_KEYS:
+        if params[key] == reference[key]:
+            continue
+        # Pixel format is not always known (e.g. mjpeg in QuickTime)
+        if key != 'pix_fmt' or None not in (params[key], reference[key]):
+            return False
+    return True
+
+
+def plan_conform(paths):
+    """
+    Group the movies by stream parameters (CONFORM_KEYS). Return the
+    parameters shared by most movies and the indices of the movies which
+    need to be re-encoded to match them.
+    """
+    from dwencode.probe import get_movies_infos
+    params = [get_stream_params(info) for info in get_movies_infos(paths)]
+    counts = Counter(tuple(p[key] for key in CONFORM_KEYS) for p in params)
+    reference = dict(zip(CONFORM_KEYS, counts.most_common(1)[0][0]))
+    indices = [
+        i for i, p in enumerate(params) if not _is_compatible(p, reference)]
+    return reference, indices
+
+
+def get_conform_command(
+        path, output_path, reference, has_audio, duration=None,
+        ffmpeg_path=None, start_time=None, frames=None, video_encoder=None):
+    """
+    Return the FFmpeg command (list of args) re-encoding a movie to the
+    stream parameters of plan_conform().
+    @start_time (seconds) and @frames only encode a part of the movie.
+    @video_encoder (str) FFmpeg args replacing CONFORM_VIDEO_ENCODERS.
+    """
+    video_codec = reference['video_codec']
+    if not video_encoder and video_codec not in CONFORM_VIDEO_ENCODERS:
+        raise ValueError('Cannot conform movies to %s codec.' % video_codec)
+    width, height = reference['width'], reference['height']
+    filters = [
+        'scale=%i:%i:force_original_aspect_ratio=decrease' % (width, height),
+        'pad=%i:%i:(ow-iw)/2:(oh-ih)/2' % (width, height),
+        'setsar=1']
+    if reference['fps']:
+        fps = Fraction(reference['fps']).limit_denominator(1001)
+        filters.append('fps=%s' % fps)
+    if reference['pix_fmt']:
+        filters.append('format=%s' % reference['pix_fmt'])
+    video_args = '-map 0:v:0 -vf "%s" %s' % (
+        ','.join(filters),
+        video_encoder or CONFORM_VIDEO_ENCODERS[video_codec])
+    if frames:
+        video_args += ' -frames:v %i' % frames
+
+    audio_codec = reference['audio_codec']
+    input_args = ''
+    if not audio_codec:
+        audio_args = ' -an'
+    else:
+        audio_args = CONFORM_AUDIO_ENCODERS.get(
+            audio_codec, '-c:a %s' % audio_codec)
+        audio_args += ' -ar %i -ac %i' % (
+            reference['sample_rate'], reference['channels'])
+        if has_audio:
+            audio_args = ' -map 0:a:0 ' + audio_args
+            if duration:
+                audio_args += ' -t %s' % duration
+        else:
+            silence = 'anullsrc=cl=%s:r=%i' % (
+                'mono' if reference['channels'] == 1 else 'stereo',
+                reference['sample_rate'])
+            input_args, audio_args = get_sound_args(
+                audio_codec=audio_args, add_silent_audio=True,
+                silence_settings=silence, duration=duration)
+            audio_args = ' -map 1:a:0' + audio_args
+
+    seek_args = ' -ss %s' % start_time if start_time else ''
+    cmd = '%s -y%s -i "%s"%s %s%s "%s"' % (
+        get_ffmpeg_path(ffmpeg_path), seek_args, path, input_args,
+        video_args, audio_args, output_path)
+    print(cmd)
+    return shlex.split(cmd)
+
+
+def get_annexb_args(video_codec):
+    """
+    Return the FFmpeg args writing the parameter sets of a codec in-band
+    (see ANNEXB_FILTERS), or an empty string.
+    """
+    if video_codec not in ANNEXB_FILTERS:
+        return ''
+    return ' -bsf:v %s' % ANNEXB_FILTERS[video_codec]
+
+
+def get_inband_remux_command(path, output_path, video_codec, ffmpeg_path=None):
+    """
+    Return the FFmpeg command (list of args) remuxing a movie with stream
+    copy, its parameter sets written in-band.
+    """
+    cmd = '%s -y -i "%s" -map 0:v:0 -map 0:a:0? -c copy%s "%s"' % (
+        get_ffmpeg_path(ffmpeg_path), path, get_annexb_args(video_codec),
+        output_path)
+    print(cmd)
+    return shlex.split(cmd)
+
+
+def get_copy_command(
+        path, output_path, start_time, frames, duration, ffmpeg_path=None,
+        video_codec=None):
+    """
+    Return the FFmpeg command (list of args) extracting @frames from
+    @start_time with stream copy. @start_time needs to be a keyframe.
+    @video_codec parameter sets are written in-band (see ANNEXB_FILTERS).
+    """
+    cmd = (
+        '%s -y -ss %s -i "%s" -map 0:v:0 -map 0:a:0? -frames:v %i -t %s '
+        '-c copy%s "%s"') % (
+            get_ffmpeg_path(ffmpeg_path), start_time, path, frames, duration,
+            get_annexb_args(video_codec), output_path)
+    print(cmd)
+    return shlex.split(cmd)
+
+
+def _run_commands(commands, verbose=False, max_workers=None):
+    max_workers = max_workers or max(1, (os.cpu_count() or 1) // 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in executor.map(
+                lambda cmd: run_ffmpeg(cmd, verbose=verbose), commands):
+            pass
+
+
+def conform_videos(
+        paths, directory, ffmpeg_path=None, verbose=False, max_workers=None):
+    """
+    Re-encode the movies which cannot be concatenated with stream copy to the
+    stream parameters of most movies (see plan_conform), in @directory.
+    Return the paths to concatenate and the created movies paths.
+    """
+    from dwencode.probe import get_movies_infos
+    reference, indices = plan_conform(paths)
+    if not indices:
+        return list(paths), []
+    print('Conforming %i/%i movies to %s' % (
+        len(indices), len(paths), reference))
+    majority_index = next(i for i in range(len(paths)) if i not in indices)
+    extension = os.path.splitext(paths[majority_index])[-1]
+    video_encoder = None
+    if reference['video_codec'] == 'h264':
+        # Same profile and level as the majority, which drive the decoder
+        video_encoder = get_matching_encoder(
+            get_codec_config(paths[majority_index]))
+    infos = get_movies_infos([paths[i] for i in indices])
+    commands = []
+    new_paths = list(paths)
+    for i, info in zip(indices, infos):
+        new_paths[i] = os.path.join(
+            directory, 'conformed_%04i%s' % (i, extension)).replace(
+                '\\', '/')
+        commands.append(get_conform_command(
+            paths[i], new_paths[i], reference, bool(info['audio_codec']),
+            info['video_duration'] or info['duration'], ffmpeg_path,
+            video_encoder=video_encoder))
+
+    _run_commands(commands, verbose, max_workers)
+    return new_paths, [new_paths[i] for i in indices]
+
+
+def remux_inband_parameter_sets(
+        paths, directory, ffmpeg_path=None, verbose=False, max_workers=None):
+    """
+    Remux the movies which are not in @directory (i.e. not re-encoded by
+    conform_videos or trim_videos) with their parameter sets in-band, if
+    the concat demuxer does not do it itself (see ANNEXB_FILTERS). Return
+    the paths to concatenate.
+    """
+    from dwencode.probe import get_movies_infos
+    directory = os.path.abspath(directory)
+    new_paths = list(paths)
+    commands = []
+    for i, (path, info) in enumerate(zip(paths, get_movies_infos(paths))):
+        video_codec = info['video_codec']
+        if (os.path.dirname(os.path.abspath(path)) == directory or
+                video_codec not in ANNEXB_FILTERS or
+                video_codec in CONCAT_AUTO_CONVERTED_CODECS):
+            continue
+        new_paths[i] = os.path.join(
+            directory, 'remuxed_%04i%s' % (
+                i, os.path.splitext(path)[-1])).replace('\\', '/')
+        commands.append(get_inband_remux_command(
+            path, new_paths[i], video_codec, ffmpeg_path))
+    _run_commands(commands, verbose, max_workers)
+    return new_paths
+
+
+def _has_leading_pictures(index, keyframe):
+    """
+    Open GOP: frames decoded after the keyframe but displayed before it
+    reference the previous group of pictures.
+    """
+    next_keyframe = index.get_next_keyframe(keyframe + 1) or index.count
+    pts = index.get_pts(keyframe)
+    return any(
+        index.get_pts(i) < pts for i in range(keyframe + 1, next_keyframe))
+
+
+def get_keyframes(path):
+    """
+    Return the keyframes (presentation frame numbers) of a QuickTime/MP4
+    movie and its frames count, or None if its sample tables cannot be read.
+    Open GOP keyframes (e.g. HEVC CRA) cannot start a stream copy and are
+    skipped.
+    """
+    from dwencode.probe.quicktime import Movie
+    try:
+        index = Movie(path).get_sample_index()
+    except Exception:
+        return None
+    keyframes = index.keyframes
+    if keyframes is None:
+        keyframes = range(index.count)
+    if index.composition_offsets is None:
+        return list(keyframes), index.count
+    keyframes = [k for k in keyframes if not _has_leading_pictures(index, k)]
+    times = sorted(index.get_pts(i) for i in range(index.count))
+    return [
+        bisect.bisect_left(times, index.get_pts(k))
+        for k in keyframes], index.count
+
+
+def get_codec_config(path):
+    """
+    Return the video codec configuration (avcC/hvcC: profile, level and
+    parameter sets) of a QuickTime/MP4 movie, or None if unknown.
+    """
+    from dwencode.probe.quicktime import Movie
+    try:
+        return Movie(path).video_track.codec_config
+    except Exception:
+        return None
+
+
+def get_matching_encoder(codec_config):
+    """
+    Return the FFmpeg encoder args matching the profile and level of an
+    H.264 movie (avcC), for the re-encoded movies or cut points joined to
+    it. None for other codecs.
+    """
+    if not codec_config or len(codec_config) < 4 or codec_config[0] != 1:
+        return None
+    profile = AVC_PROFILES.get(codec_config[1])
+    if not profile:
+        return None
+    args = '%s -profile:v %s' % (CONFORM_VIDEO_ENCODERS['h264'], profile)
+    if codec_config[3] >= 10:
+        args += ' -level:v %.1f' % (codec_config[3] / 10)
+    return args
+
+
+def get_smart_render_segments(first_frame, last_frame, keyframes=None):
+    """
+    Split the [first_frame, last_frame] range of a movie into ("copy" or
+    "encode", first, last) segments: the groups of pictures fully inside the
+    range are stream copied, the partial ones at the cut points re-encoded.
+    @keyframes is the get_keyframes() result. Without it, everything is
+    re-encoded.
+    """
+    if not keyframes:
+        return [('encode', first_frame, last_frame)]
+    keyframes, frames_count = keyframes
+    copy_start = next((k for k in keyframes if k >= first_frame), None)
+    copy_end = max(
+        (b for b in list(keyframes) + [frames_count] if b <= last_frame + 1),
+        default=None)
+    if copy_start is None or copy_end is None or copy_end <= copy_start:
+        return [('encode', first_frame, last_frame)]
+    segments = []
+    if first_frame < copy_start:
+        segments.append(('encode', first_frame, copy_start - 1))
+    segments.append(('copy', copy_start, copy_end - 1))
+    if copy_end <= last_frame:
+        segments.append(('encode', copy_end, last_frame))
+    return segments
+
+
+def _get_trim_command(
+        path, output_path, info, kind, first_frame, last_frame, fps,
+        ffmpeg_path=None, video_encoder=None):
+    frames = last_frame - first_frame + 1
+    start_time = float(first_frame / fps)
+    duration = float(frames / fps)
+    if kind == 'copy':
+        return get_copy_command(
+            path, output_path, start_time, frames, duration, ffmpeg_path,
+            info['video_codec'])
+    return get_conform_command(
+        path, output_path, get_stream_params(info),
+        bool(info['audio_codec']), duration, ffmpeg_path, start_time, frames,
+        video_encoder)
+
+
+def trim_videos(
+        paths, trims, directory, ffmpeg_path=None, verbose=False,
+        max_workers=None):
+    """
+    Smart render the [first frame, last frame] @trims of the movies (None
+    keeps the whole movie, or the movie end as last frame), in @directory.
+    Return the paths to concatenate.
+
+    Whole groups of pictures are stream copied, and only the frames between
+    the cut points and their nearest keyframes are re-encoded, with the
+    movie stream parameters (and H.264 profile and level). The re-encoded
+    parts get other codec parameter sets than the copied ones: H.264 and
+    HEVC parameter sets are written in-band (see ANNEXB_FILTERS).
+    """
+    from dwencode.probe import get_movies_infos
+    indices = [i for i, trim in enumerate(trims) if trim]
+    infos = get_movies_infos([paths[i] for i in indices])
+    new_paths = []
+    commands = []
+    for i, path in enumerate(paths):
+        if not trims[i]:
+            new_paths.append(path)
+            continue
+        info = infos[indices.index(i)]
+        if not info['fps']:
+            raise ValueError('Unknown frame rate: %s' % path)
+        fps = Fraction(info['fps']).limit_denominator(1001)
+        extension = os.path.splitext(path)[-1]
+        keyframes = None
+        if extension.lower() in QUICKTIME_EXTENSIONS:
+            keyframes = get_keyframes(path)
+        first_frame, last_frame = trims[i]
+        if last_frame is None:
+            last_frame = get_frames_count(info, path) - 1
+        segments = get_smart_render_segments(
+            first_frame, last_frame, keyframes)
+        print('Trimming %s: %s' % (path, segments))
+        video_encoder = None
+        if len(segments) > 1:
+            video_encoder = get_matching_encoder(get_codec_config(path))
+        for j, (kind, first_frame, last_frame) in enumerate(segments):
+            output_path = os.path.join(
+                directory, 'trimmed_%04i_%i%s' % (i, j, extension)).replace(
+                    '\\', '/')
+            commands.append(_get_trim_command(
+                path, output_path, info, kind, first_frame, last_frame, fps,
+                ffmpeg_path, video_encoder))
+            new_paths.append(output_path)
+    _run_commands(commands, verbose, max_workers)
+    return new_paths
+
+
+def read_edl(path):
+    """
+    Read a simple edit list: one movie per line, optionally followed by its
+    first and last frames (frames start at 0), e.g.:
+        # comment
+        takes/sh010_v003.mov 24 120
+        "takes/sh020 v001.mov" 12
+    Relative paths are relative to the list directory.
+    Return (paths, trims), as used by concatenate_videos().
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    paths, trims = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            match = re.match(r'^(.+?)(?:\s+(\d+)(?:\s+(\d+))?)?$', line)
+            movie_path, first, last = match.groups()
+            movie_path = movie_path.strip('"\'')
+            paths.append(os.path.join(directory, movie_path))
+            trim = None
+            if first is not None:
+                trim = int(first), None if last is None else int(last)
+            trims.append(trim)
+    return paths, trims
+
+
+def create_list_file(paths, timings=None):
+    """
+    Write an FFmpeg concat demuxer list of the movies absolute paths in the
+    temporary directory. Return the list path.
+    @timings are the durations forced to each movie.
+    """
+    concat_list = ['ffconcat version 1.0']
     for i, path in enumerate(paths):
-        concat_list.append('file %s' % path.replace(root, '.'))
+        concat_list.append("file '%s'" % escape_concat_path(path))
         if timings:
             timing = timings[i]
             concat_list.extend(
                 ['duration %s' % timing, 'outpoint %s' % timing])
     concat_list = '\n'.join(concat_list)
     print(concat_list)
-    list_path = os.path.join(
-        root, 'temp_video_concatenation_list_%i.txt' % index).replace(
-            '\\', '/')
-
-    if os.path.exists(list_path):
-        os.remove(list_path)
-    with open(list_path, 'w') as f:
+    handle, list_path = tempfile.mkstemp(
+        prefix='dwencode_concat_', suffix='.txt')
+    with os.fdopen(handle, 'w') as f:
         f.write(concat_list)
+    return list_path.replace('\\', '/')
+
 
-    return list_path
+def get_grid_shape(count, grid=None, stack_orientation='horizontal'):
+    """
+    Return the (rows, columns) of a stack of @count movies.
+
+    - grid (tuple or str) (rows, columns), or "auto" for a square-ish grid.
+        Default is one row or column, depending on @stack_orientation.
+    """
+    if grid == 'auto':
+        columns = int(math.ceil(math.sqrt(count)))
+        return int(math.ceil(count / float(columns))), columns
+    if grid:
+        rows, columns = grid
+        if rows * columns < count:
+            raise ValueError(
+                'Grid %ix%i is too small for %i movies.' % (
+                    rows, columns, count))
+        return rows, columns
+    if stack_orientation in ('horizontal', 0):
+        return 1, count
+    return count, 1
+
+
+def get_stack_filter(count, width, height, rows, columns):
+    """
+    Return a filter graph scaling each input once to a cell of the grid,
+    and assembling them with a single xstack filter (output is [stack]).
+    """
+    filters = [
+        STACK_CELL_FILTERS.format(index=i, width=width, height=height)
+        for i in range(count)]
+    cells = ''.join('[cell%i]' % i for i in range(count))
+    if count == 1:
+        filters.append('[cell0]null[stack]')
+    else:
+        layout = '|'.join(
+            '%i_%i' % ((i % columns) * width, (i // columns) * height)
+            for i in range(count))
+        filters.append('%sxstack=inputs=%i:layout=%s:fill=black[stack]' % (
+            cells, count, layout))
+    return ';'.join(filters)
 
 
 def _get_input_args(
-        paths, stack_orientation='horizontal', master_list_index=0):
-    input_pattern = '-f concat -safe 0 -i %s '
+        paths, stack_orientation='horizontal', master_list_index=0,
+        grid=None):
+    input_pattern = '-f concat -safe 0 -i "%s" '
     if not isinstance(paths[0], list):
-        common_root = get_common_root(paths)
-        list_path = create_list_file(paths, common_root)
-        args = input_pattern % list_path
-        return [list_path], args, common_root
-    common_root = get_common_root(
-        [path for sublist in paths for path in sublist])
+        list_path = create_list_file(paths)
+        return [list_path], input_pattern % list_path
     args = ' '
     lists_paths = []
     timings = get_videos_durations(paths[master_list_index])
-    for i, stack in enumerate(paths):
-        list_path = create_list_file(stack, common_root, i, timings)
+    for stack in paths:
+        list_path = create_list_file(stack, timings)
         lists_paths.append(list_path)
         args += input_pattern % list_path
-    if stack_orientation in ('horizontal', 0):
-        scale2ref = "w=main_w+iw:h=max(main_h,ih)"
-        overlay = "W-w:0"
-    else:
-        scale2ref = "w=max(main_w,iw):h=main_h+ih"
-        overlay = "0:H-h"
-    stackarg = STACKED_ARGS.format(scale2ref=scale2ref, overlay=overlay)
-    args += '-filter_complex "%s" ' % stackarg
-    return lists_paths, args, common_root
+
+    # Cells have the size of the first master movie:
+    from dwencode.probe import get_movie_info
+    info = get_movie_info(paths[master_list_index][0])
+    rows, columns = get_grid_shape(len(paths), grid, stack_orientation)
+    stack_filter = get_stack_filter(
+        len(paths), info['width'], info['height'], rows, columns)
+    args += '-filter_complex "%s" -map "[stack]" -map %i:a? ' % (
+        stack_filter, master_list_index)
+    return lists_paths, args
+
+
+def get_concatenate_command(
+        paths, output_path, ffmpeg_path=None,
+        ffmpeg_codec=DEFAULT_CONCAT_ENCODING, overwrite=False,
+        stack_orientation='horizontal', stack_master_list=0, progress=False,
+        grid=None):
+    """
+    Return the concatenate_videos() FFmpeg command (list of args) and the
+    created lists paths.
+    """
+    ffmpeg = get_ffmpeg_path(ffmpeg_path)
+    list_paths, input_args = _get_input_args(
+        paths, stack_orientation, stack_master_list, grid)
+    overwrite = '-y' if overwrite else ''
+
+    if isinstance(paths[0], list) and ffmpeg_codec == DEFAULT_CONCAT_ENCODING:
+        # => obviously cannot stream copy
+        ffmpeg_codec = DEFAULT_CONCAT_STACK_ENCODING
+
+    progress_args = PROGRESS_ARGS if progress else ''
+
+    cmd = '%s %s %s %s %s %s' % (
+        ffmpeg, input_args, ffmpeg_codec, progress_args, overwrite,
+        output_path)
+
+    print(cmd)
+    return shlex.split(cmd), list_paths
+
+
+def get_master_paths(paths, stack_master_list=0):
+    """Movies driving the concatenation timing."""
+    if isinstance(paths[0], list):
+        return paths[stack_master_list]
+    return paths
 
 
 def concatenate_videos(
         paths, output_path, verbose=False, ffmpeg_path=None, delete_list=True,
         ffmpeg_codec=DEFAULT_CONCAT_ENCODING, overwrite=False,
-        stack_orientation='horizontal', stack_master_list=0):
+        stack_orientation='horizontal', stack_master_list=0,
+        progress_callback=None, conform=False, grid=None, trims=None):
     """
-    Movies are expected to have:
-    - a common parent directory
-    - same format
+    Movies are expected to have the same format, unless @conform is True.
+    They can be on different disks or read-only storage: the concat lists
+    are written in the temporary directory, with absolute paths.
 
     @paths argument can be a list or a list of lists. If there is multiple
     lists, it will encode them side by side (or on top of each other,
-    depending on the @stack_orientation argument).
+    depending on the @stack_orientation argument), or in a @grid of
+    (rows, columns), or "auto" for a square-ish grid. Each movie is scaled
+    to the size of the first master movie.
 
     @stack_master_list is the index of the list which will drive the timing
     of the concatenation.
-    """
-    ffmpeg = get_ffmpeg_path(ffmpeg_path)
-    list_paths, input_args, common_root = _get_input_args(
-        paths, stack_orientation, stack_master_list)
-    overwrite = '-y' if overwrite else ''
 
-    if isinstance(paths[0], list) and ffmpeg_codec == DEFAULT_CONCAT_ENCODING:
-        # => obviously cannot stream copy
-        ffmpeg_codec = DEFAULT_CONCAT_STACK_ENCODING
+    @progress_callback is called with dwencode.progress.Progress events.
+    Movies durations are probed to estimate the remaining time.
 
-    cmd = '%s %s %s %s %s' % (
-        ffmpeg, input_args, ffmpeg_codec, overwrite, output_path)
+    @conform probes the movies and re-encodes the ones whose codec, size,
+    frame rate, pixel format or audio layout differ from most movies, so
+    they can all be concatenated with stream copy. H.264 and HEVC parameter
+    sets are then written in-band (see ANNEXB_FILTERS).
 
-    print(cmd)
-    cmd = shlex.split(cmd)
+    @trims is a list of (first frame, last frame) per movie (frames start at
+    0, None keeps the whole movie, or the movie end as last frame). They are
+    smart rendered: only the frames between the cut points and the nearest
+    keyframes are re-encoded. See read_edl().
+    @conform and @trims are not supported with stacked lists (which are
+    re-encoded anyway).
+    """
+    temp_directory = None
+    if (conform or trims) and isinstance(paths[0], list):
+        raise ValueError(
+            'conform and trims are not supported with stacked lists.')
+    if conform or trims:
+        temp_directory = tempfile.mkdtemp(prefix='dwencode_concat_')
+        try:
+            if trims:
+                paths = trim_videos(
+                    paths, trims, temp_directory, ffmpeg_path, verbose)
+            if conform:
+                paths = conform_videos(
+                    paths, temp_directory, ffmpeg_path, verbose)[0]
+            paths = remux_inband_parameter_sets(
+                paths, temp_directory, ffmpeg_path, verbose)
+        except BaseException:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+            raise
+
+    cmd, list_paths = get_concatenate_command(
+        paths, output_path, ffmpeg_path, ffmpeg_codec, overwrite,
+        stack_orientation, stack_master_list, bool(progress_callback), grid)
 
     try:
-        if verbose:
-            proc = sp.Popen(
-                cmd, cwd=common_root, stdout=sp.PIPE, stderr=sp.PIPE)
-            out, err = proc.communicate()
-            encoding = locale.getpreferredencoding()
-            out = out.decode(encoding)
-            print(out)
-            err = err.decode(encoding)
-            print(err)
-            if proc.returncode != 0:
-                raise ValueError(err)
+        if progress_callback or verbose:
+            total_duration = None
+            if progress_callback:
+                total_duration = sum(get_videos_durations(
+                    get_master_paths(paths, stack_master_list)))
+            run_ffmpeg(
+                cmd, progress_callback, total_duration=total_duration,
+                verbose=verbose)
         else:
-            sp.call(cmd, cwd=common_root)
+            sp.call(cmd)
     finally:
         if delete_list:
             for list_path in list_paths:
                 os.remove(list_path)
+        if temp_directory:
+            shutil.rmtree(temp_directory, ignore_errors=True)
@@ -11,8 +11,23 @@ import os
 import datetime
 import shlex
 import subprocess
+from collections import namedtuple
 
 from dwencode.ffpath import get_ffmpeg_path
+from dwencode.imagesize import get_image_size
+from dwencode.overlay import (
+    TEXT_SLOTS, create_static_layer_file, get_text_geometry, is_static_text)
+from dwencode.progress import PROGRESS_ARGS, run_ffmpeg
+from dwencode.sequence import (
+    conform_pattern, create_hold_list_file, scan_sequence)
+
+
+EncodeCommand = namedtuple('EncodeCommand', [
+    'args',  # FFmpeg command as a list of arguments
+    'total_frames',  # number of frames encoded (None if unknown)
+    'stdin_chunks',  # iterable of bytes to write to FFmpeg stdin, or None
+    'temp_paths',  # temporary files to remove once FFmpeg is done
+])
 
 
 def extract_image_from_video(video_path, time, output_path, ffmpegpath=None):
@@ -29,6 +44,10 @@ def conform_path(font_path):
 
 
 def get_image_format(image_path):
+    try:
+        return get_image_size(image_path)
+    except ValueError:
+        pass  # not a format known by the header reader
     try:
         from PIL import Image
     except ImportError:
@@ -56,9 +75,11 @@ def get_padding_values(width, height, target_width, target_height):
 
 
 def drawtext(
-        text, x, y, color=None, font_path=None, size=36, start=None, end=None):
+        text, x, y, color=None, font_path=None, size=36, start=None, end=None,
+        framerange=None):
     if text == '{framerange}':
-        return draw_framerange(x, y, color, font_path, size, start, end)
+        return draw_framerange(
+            x, y, color, font_path, size, start, end, framerange)
     args = []
     if not color:
         # TODO: handle border colors options
@@ -82,9 +103,11 @@ def drawtext(
 
 
 def draw_framerange(
-        x, y, color, font_path=None, size=36, start=None, end=None):
+        x, y, color, font_path=None, size=36, start=None, end=None,
+        framerange=None):
     # framerange is made of two separate texts:
-    left_text, right_text = '{frame}', '[%i-%i]' % (start, end)
+    framerange = framerange or (start, end)
+    left_text, right_text = '{frame}', '[%i-%i]' % framerange
     x = str(x)
     if '/2' in x:
         # middle
@@ -116,6 +139,449 @@ def imagepos(x, y):
     return '[0:v][1:v]overlay=%i:%i' % (x, y)
 
 
+def get_scale_filters(
+        width, height, target_width, target_height, crop=False):
+    if crop:
+        return ['crop=%i:%i:0:100' % (target_width, target_height)]
+    image_width, x_offset, y_offset = get_padding_values(
+        width, height, target_width, target_height)
+    return [
+        'scale=%i:-1' % image_width,
+        'pad=%i:%i:%i:%i' % (
+            target_width, target_height, x_offset, y_offset)]
+
+
+def get_text_filters(
+        texts, target_width, target_height, font_path=None, font_scale=1.0,
+        start=None, end=None, framerange=None, skip_static=False):
+    """
+    Return drawtext filters of texts [(slot, text, color)], sized and
+    positioned for the target size.
+    """
+    font_size, margin_size, bottom_pos = get_text_geometry(
+        target_width, target_height, font_scale)
+    horizontal_positions = dict(
+        left=margin_size,
+        middle='(w-tw)/2',
+        right='w-%i-(tw)' % margin_size)
+    vertical_positions = dict(top=margin_size, bottom=bottom_pos)
+
+    kwargs = dict(
+        font_path=font_path, size=font_size, start=start, end=end,
+        framerange=framerange)
+    filters = []
+    for slot, text, color in texts:
+        if skip_static and is_static_text(text):
+            continue
+        horizontal, vertical = TEXT_SLOTS[slot]
+        filters.append(drawtext(
+            text, horizontal_positions[horizontal],
+            vertical_positions[vertical], color, **kwargs))
+    return filters
+
+
+def scale_rectangles(rectangles, scale_x, scale_y):
+    """Fit rectangles placed for the main target size to another size."""
+    if not rectangles or (scale_x == 1 and scale_y == 1):
+        return rectangles
+    return [dict(
+        rectangle,
+        x=round(float(rectangle['x']) * scale_x),
+        y=round(float(rectangle['y']) * scale_y),
+        width=round(float(rectangle['width']) * scale_x),
+        height=round(float(rectangle['height']) * scale_y),
+        thickness=max(1, round(
+            float(rectangle['thickness']) * min(scale_x, scale_y))))
+        for rectangle in rectangles]
+
+
+def get_output_specs(
+        output_path, outputs, target_width, target_height, video_codec,
+        audio_codec):
+    """
+    Return the main output and the additional outputs as complete dicts.
+    A size given with a single dimension keeps the main output ratio.
+    """
+    specs = [dict(
+        path=output_path, target_width=target_width,
+        target_height=target_height, video_codec=video_codec,
+        audio_codec=audio_codec, overlays=True, thumbnail=False, frame=None,
+        format=None)]
+    for output in outputs or []:
+        spec = dict(
+            target_width=None, target_height=None, video_codec=None,
+            audio_codec=audio_codec, overlays=True, thumbnail=False,
+            frame=None, format=None)
+        spec.update(output)
+        width, height = spec['target_width'], spec['target_height']
+        if width and not height:
+            height = int(round(width * target_height / target_width / 2) * 2)
+        elif height and not width:
+            width = int(round(height * target_width / target_height / 2) * 2)
+        spec['target_width'] = width or target_width
+        spec['target_height'] = height or target_height
+        if not spec['thumbnail'] and not spec['video_codec']:
+            spec['video_codec'] = video_codec
+        specs.append(spec)
+    return specs
+
+
+def get_sound_args(
+        sound_path=None, sound_offset=None, audio_codec=None,
+        add_silent_audio=False, silence_settings=None, duration=None):
+    """
+    Return the sound input arguments and the audio output arguments.
+    """
+    # Audio codec
+    if audio_codec and (sound_path or add_silent_audio):
+        audio_codec = ' ' + audio_codec
+    elif sound_path:
+        audio_codec = ' -c:a copy'
+    else:
+        audio_codec = ' '
+
+    # Known duration is preferred to -shortest, which can drop the last
+    # frames of a stream copied video.
+    input_args = output_args = ''
+    end_args = ' -t %s' % duration if duration else ' -shortest'
+    if sound_path:
+        if sound_offset:
+            input_args += ' -itsoffset %f' % sound_offset
+        input_args += ' -i "%s"' % sound_path
+        if '-c:a copy' not in audio_codec:
+            output_args += ' -af apad' + end_args  # audio as long as video
+        elif duration:
+            output_args += ' -t %s' % duration
+    elif add_silent_audio:
+        # Add empty sound in case of concatenate with "-c:a copy"
+        silence_settings = silence_settings or 'anullsrc=cl=mono:r=48000'
+        input_args += ' -f lavfi -i %s' % silence_settings
+        output_args += end_args
+    return input_args, output_args + audio_codec
+
+
+def get_output_filters(
+        spec, width, height, crop, texts, font_path, font_scale, start, end,
+        framerange, rectangles, static_layers, label='base'):
+    """
+    Return the filters chain of an output spec: scaling, static layer,
+    texts and boxes.
+    """
+    target_width, target_height = spec['target_width'], spec['target_height']
+    filters = get_scale_filters(
+        width, height, target_width, target_height, crop)
+    if spec['thumbnail'] and spec['frame'] is not None:
+        filters.insert(0, 'trim=start_frame=%i' % (spec['frame'] - start))
+    if not spec['overlays']:
+        return filters
+
+    # Add static layer
+    static_layer = static_layers.get((target_width, target_height))
+    if static_layer:
+        filters = [','.join(filters) + '[%s];[%s][%i:v]overlay=0:0' % (
+            label, label, static_layer[0])]
+
+    # Overlay text
+    filters.extend(get_text_filters(
+        texts, target_width, target_height, font_path, font_scale, start,
+        end, framerange, skip_static=bool(static_layer)))
+
+    # Add boxes (rectangles/safe-frames)
+    if not static_layer:
+        filters.extend(drawbox(**rectangle) for rectangle in rectangles or [])
+    return filters
+
+
+def get_split_graph(
+        specs, pre_filters, output_filters, overlay_image=None,
+        overlay_image_index=None):
+    """
+    Return a filter graph decoding the images once and splitting them to one
+    "[out<index>]" labelled chain per output spec.
+    """
+    graph = []
+    source = '[0:v]'
+    if pre_filters:
+        graph.append(source + ','.join(pre_filters) + '[src]')
+        source = '[src]'
+
+    # Outputs without overlays branch before the overlay image
+    sources = {True: source, False: source}
+    if overlay_image_index is not None:
+        if not all(spec['overlays'] for spec in specs):
+            graph.append('%ssplit=2[raw][pre]' % source)
+            sources[False], source = '[raw]', '[pre]'
+        graph.append('%s[%i:v]overlay=%i:%i[over]' % (
+            source, overlay_image_index, overlay_image['x'],
+            overlay_image['y']))
+        sources[True] = '[over]'
+
+    groups = dict()
+    for i, spec in enumerate(specs):
+        groups.setdefault(sources[spec['overlays']], []).append(i)
+    spec_sources = dict()
+    for source, indexes in groups.items():
+        if len(indexes) == 1:
+            spec_sources[indexes[0]] = source
+            continue
+        labels = ['[split%i]' % i for i in indexes]
+        graph.append('%ssplit=%i%s' % (
+            source, len(indexes), ''.join(labels)))
+        spec_sources.update(zip(indexes, labels))
+
+    for i, filters in enumerate(output_filters):
+        graph.append('%s%s[out%i]' % (spec_sources[i], ','.join(filters), i))
+    return ';'.join(graph)
+
+
+def get_encode_command(
+        images_path,
+        output_path,
+        start=None,
+        end=None,
+        frame_rate=None,
+        sound_path=None,
+        sound_offset=None,
+        source_width=None,
+        source_height=None,
+        target_width=None,
+        target_height=None,
+        crop=False,
+        framerange=None,
+        top_left=None,
+        top_middle=None,
+        top_right=None,
+        bottom_left=None,
+        bottom_middle=None,
+        bottom_right=None,
+        top_left_color=None,
+        top_middle_color=None,
+        top_right_color=None,
+        bottom_left_color=None,
+        bottom_middle_color=None,
+        bottom_right_color=None,
+        font_path=None,
+        font_scale=1.0,
+        overlay_image=None,
+        rectangles=None,
+        static_overlay=False,
+        input_args=None,
+        video_codec=None,
+        audio_codec=None,
+        add_silent_audio=False,
+        silence_settings=None,
+        threads=None,
+        ffmpeg_path=None,
+        metadata=None,
+        overwrite=False,
+        verbose=False,
+        progress=False,
+        frames=None,
+        pix_fmt='rgb24',
+        outputs=None):
+    """
+    Return the EncodeCommand of an encode() call, without running it.
+    Arguments are the same as encode(), except progress (bool) which adds the
+    FFmpeg "-progress" arguments.
+
+    The caller runs the command and removes the temp_paths files afterwards
+    (see remove_temp_files).
+    """
+    # Check ffmpeg is found:
+    ffmpeg_path = get_ffmpeg_path(ffmpeg_path)
+
+    frame_rate = frame_rate or 24
+
+    # Find frame range and missing images
+    sequence = None
+    if frames is None:
+        images_path = conform_pattern(images_path)
+        sequence = scan_sequence(images_path)
+    if sequence:
+        start = sequence.first if start is None else start
+        end = sequence.last if end is None else end
+    start = start or 0
+    hold_missing_frames = bool(
+        sequence and end is not None and sequence.missing(start, end))
+
+    raw_font_path, font_path = font_path, conform_path(font_path)
+    if source_width and source_height:
+        width, height = source_width, source_height
+    elif frames is not None:
+        raise ValueError('Frames encoding needs source_width/source_height.')
+    elif sequence:
+        width, height = get_image_format(
+            sequence.path(sequence.get_existing_frame(start)))
+    else:
+        width, height = get_image_format(images_path % start)
+    target_width = target_width or width
+    target_height = target_height or height
+
+    # Command start
+    cmd = ffmpeg_path or 'ffmpeg'
+    if not verbose:
+        cmd += ' -hide_banner -loglevel error -nostats'
+
+    # Input
+    hold_list_path = None
+    if frames is not None:
+        images_path = 'pipe:0'
+        cmd += ' -f rawvideo -pix_fmt %s -s %ix%i -framerate %s' % (
+            pix_fmt, width, height, frame_rate)
+    elif hold_missing_frames:
+        print('Missing frames: %s' % sequence.missing(start, end))
+        images_path = hold_list_path = create_hold_list_file(
+            sequence, start, end, frame_rate)
+        cmd += ' -f concat -safe 0'
+    else:
+        cmd += ' -framerate %i -f image2 -start_number %i' % (
+            frame_rate, start)
+    if input_args:
+        cmd += ' %s ' % input_args
+    cmd += ' -i "%s"' % images_path
+
+    specs = get_output_specs(
+        output_path, outputs, target_width, target_height, video_codec,
+        audio_codec)
+    overlay_specs = [spec for spec in specs if spec['overlays']]
+    texts = [(slot, text, color) for slot, text, color in (
+        ('top_left', top_left, top_left_color),
+        ('top_middle', top_middle, top_middle_color),
+        ('top_right', top_right, top_right_color),
+        ('bottom_left', bottom_left, bottom_left_color),
+        ('bottom_middle', bottom_middle, bottom_middle_color),
+        ('bottom_right', bottom_right, bottom_right_color)) if text]
+    inputs_count = 1
+
+    # Overlay inputs
+    overlay_image_index = None
+    if overlay_image and overlay_specs:
+        cmd += ' -i "%s"' % overlay_image['path']
+        overlay_image_index = inputs_count
+        inputs_count += 1
+
+    # Static texts and rectangles rasterized once (per output size)
+    static_layers = dict()  # {(width, height): (input index, path)}
+    if static_overlay:
+        static_texts = {
+            slot: (text, color) for slot, text, color in texts
+            if is_static_text(text)}
+        for spec in overlay_specs:
+            size = spec['target_width'], spec['target_height']
+            if size in static_layers or not (static_texts or rectangles):
+                continue
+            path = create_static_layer_file(
+                size[0], size[1], static_texts, scale_rectangles(
+                    rectangles, size[0] / target_width,
+                    size[1] / target_height),
+                raw_font_path, font_scale)
+            static_layers[size] = inputs_count, path
+            inputs_count += 1
+            cmd += ' -i "%s"' % path
+
+    # Sound
+    duration = None
+    if end:
+        duration = (end - start + 1) / frame_rate
+    sound_input_args, _ = get_sound_args(
+        sound_path, sound_offset, audio_codec, add_silent_audio,
+        silence_settings, duration)
+    sound_index = inputs_count if sound_input_args else None
+    cmd += sound_input_args
+
+    # Filter complex
+    pre_filters = []
+
+    # Add overlay images
+    if overlay_image_index is not None and len(specs) == 1:
+        pre_filters.append(imagepos(overlay_image['x'], overlay_image['y']))
+
+    # Duplicate held images to constant frame rate
+    if hold_list_path:
+        pre_filters.append('fps=%s' % frame_rate)
+
+    output_filters = []
+    for i, spec in enumerate(specs):
+        filters = get_output_filters(
+            spec, width, height, crop, texts, font_path, font_scale, start,
+            end, framerange, scale_rectangles(
+                rectangles, spec['target_width'] / target_width,
+                spec['target_height'] / target_height),
+            static_layers, 'base%i' % i if len(specs) > 1 else 'base')
+        output_filters.append(filters)
+
+    if len(specs) == 1:
+        cmd += ' -filter_complex "%s"' % ','.join(
+            pre_filters + output_filters[0])
+    else:
+        cmd += ' -filter_complex "%s"' % get_split_graph(
+            specs, pre_filters, output_filters, overlay_image,
+            overlay_image_index)
+
+    # Outputs
+    for i, spec in enumerate(specs):
+        if len(specs) > 1:
+            cmd += ' -map "[out%i]"' % i
+
+        # Frame count
+        if spec['thumbnail']:
+            cmd += ' -frames:v 1'
+        elif end:
+            cmd += ' -frames:v %i' % (end - start + 1)
+
+        # Metadata
+        if not spec['thumbnail']:
+            for key, value in metadata or []:
+                cmd += ' -metadata %s="%s"' % (key, value)
+
+        # Video codec
+        codec = spec['video_codec']
+        if not codec and not spec['thumbnail']:
+            codec = '-vcodec libx264'
+        if codec:
+            cmd += ' ' + codec.strip()
+        if threads:
+            cmd += ' -threads %i' % threads
+
+        # Sound
+        if sound_index is not None and not spec['thumbnail']:
+            if len(specs) > 1:
+                cmd += ' -map %i:a' % sound_index
+            cmd += get_sound_args(
+                sound_path, sound_offset, spec['audio_codec'],
+                add_silent_audio, silence_settings, duration)[1]
+        if not spec['thumbnail']:
+            cmd += ' -fflags +genpts'
+
+        # Progress
+        if progress and i == 0:
+            cmd += ' ' + PROGRESS_ARGS
+
+        # Output
+        if spec['format']:
+            cmd += ' -f %s' % spec['format']
+        if overwrite:
+            cmd += ' -y'
+        cmd += ' "%s"' % spec['path']
+
+    print(cmd)
+    total_frames = end - start + 1 if end else None
+    stdin_chunks = None
+    if frames is not None:
+        stdin_chunks = _iter_frames_data(frames)
+    temp_paths = [path for _, path in static_layers.values()]
+    if hold_list_path:
+        temp_paths.append(hold_list_path)
+    return EncodeCommand(
+        shlex.split(cmd), total_frames, stdin_chunks, temp_paths)
+
+
+def remove_temp_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
 def encode(
         images_path,
         output_path,
@@ -129,6 +595,7 @@ def encode(
         target_width=None,
         target_height=None,
         crop=False,
+        framerange=None,
         top_left=None,
         top_middle=None,
         top_right=None,
@@ -145,30 +612,39 @@ def encode(
         font_scale=1.0,
         overlay_image=None,
         rectangles=None,
+        static_overlay=False,
         input_args=None,
         video_codec=None,
         audio_codec=None,
         add_silent_audio=False,
         silence_settings=None,
+        threads=None,
         ffmpeg_path=None,
         metadata=None,
         overwrite=False,
-        verbose=False):
+        verbose=False,
+        progress_callback=None,
+        frames=None,
+        pix_fmt='rgb24',
+        outputs=None):
     """
     Encode images to movie with text overlays (using FFmpeg).
 
     - images_path (str) Use patterns such as "/path/to/image.%04d.jpg"
+        or "/path/to/image.####.jpg"
     - output_path (str) With any FFmpeg supported extensions
-    - start (int) First frame. Default is 0
-    - end (int) Last frame
+    - start (int) First frame. Default is the first image found (or 0)
+    - end (int) Last frame. Default is the last image found
     - frame_rate (float) Default is 24
     - sound_path (str) Optional
     - sound_offset (float) Default is 0
-    - source_width (int) Optional if you have Pillow (PIL)
-    - source_height (int) Optional if you have Pillow (PIL)
+    - source_width (int) Optional for jpg/png/tif/dpx/exr, or with Pillow
+    - source_height (int) Optional for jpg/png/tif/dpx/exr, or with Pillow
     - target_width (str) Different ratio than source will add black bars.
     - target_height (str) Different ratio than source will add black bars.
     - crop (bool) Crop the image if source is different than target
+    - framerange (tuple) First and last frames displayed by {framerange}.
+        Default is (start, end)
     - top_left (str) Text to display
     - top_middle (str) Text to display
     - top_right (str) Text to display
@@ -184,13 +660,27 @@ def encode(
     - font_path (str) FFmpeg supported font for all texts
     - overlay_image (dict) needs {path, x, y}
     - rectangles (dicts) need {x,y,width,height,color,opacity,thickness}
+    - static_overlay (bool) Rasterize the texts without {frame} and the
+        rectangles once (needs Pillow) instead of drawing them on each frame
     - video_codec (str) FFmpeg video codec arguments
     - audio_codec (str) FFmpeg audio codec arguments
     - add_silent_audio (str) add silent audio if no audio is provided
     - silence_settings (str) FFmpeg sound codec settings
+    - threads (int) Maximum number of threads used by the encoder
     - ffmpeg_path (str) Default: searches for 'ffmpeg' in PATH env
     - metadata (str) Movie metadata
     - overwrite (str) Default is False
+    - progress_callback (callable) Called with dwencode.progress.Progress
+        events (frame, fps, speed, total_size, out_time, eta, done)
+    - frames (iterable) Images (NumPy arrays or bytes) streamed to FFmpeg
+        stdin instead of reading images_path. See encode_frames()
+    - pix_fmt (str) Pixel format of the frames. Default is rgb24
+    - outputs (dicts) Additional movies or thumbnail made from the same
+        decoded images, in the same FFmpeg process. Keys are: path,
+        target_width, target_height, video_codec, audio_codec, format,
+        overlays (bool, default True), thumbnail (bool, single image
+        without sound) and frame (thumbnail frame, default is start).
+        Missing keys use the main output values.
 
     You can use the following text expressions:
     - {frame}: current frame
@@ -203,136 +693,78 @@ def encode(
 
     Image ratio is preserved. Input a different target ratio to add black bars.
 
+    Missing images hold the previous image instead of stopping the encode.
+
     Font size is automatically adapted to target size.
     """
-    # Check ffmpeg is found:
-    ffmpeg_path = get_ffmpeg_path(ffmpeg_path)
-
-    frame_rate = frame_rate or 24
-    start = start or 0
-
-    font_path = conform_path(font_path)
-    if source_width and source_height:
-        width, height = source_width, source_height
-    else:
-        width, height = get_image_format(images_path % start)
-    target_width = target_width or width
-    target_height = target_height or height
-
-    # Command start
-    cmd = ffmpeg_path or 'ffmpeg'
-    if not verbose:
-        cmd += ' -hide_banner -loglevel error -nostats'
-
-    # Input
-    cmd += ' -framerate %i -f image2 -start_number %i' % (frame_rate, start)
-    if input_args:
-        cmd += ' %s ' % input_args
-    cmd += ' -i "%s"' % images_path
-
-    # Overlay inputs
-    if overlay_image:
-        cmd += ' -i "%s"' % overlay_image['path']
-
-    # Audio codec
-    if audio_codec and (sound_path or add_silent_audio):
-        audio_codec = ' ' + audio_codec
-    elif sound_path:
-        audio_codec = ' -c:a copy'
-    else:
-        audio_codec = ' '
-
-    # Sound
-    if sound_path:
-        if sound_offset:
-            cmd += ' -itsoffset %f' % sound_offset
-        cmd += ' -i "%s"' % sound_path
-        if end:
-            duration = (end - start + 1) / frame_rate
-            cmd += ' -t %s' % duration
-        if '-c:a copy' not in audio_codec:
-            cmd += ' -af apad -shortest'  # make sure audio is as long as vid
-    elif add_silent_audio:
-        # Add empty sound in case of concatenate with "-c:a copy"
-        silence_settings = silence_settings or 'anullsrc=cl=mono:r=48000'
-        cmd += ' -f lavfi -i %s -shortest' % silence_settings
-
-    # Start filter complex
-    filter_complex = []
-
-    # Add overlay images
-    if overlay_image:
-        filter_complex.append(imagepos(overlay_image['x'], overlay_image['y']))
-
-    # Scaling and padding
-    image_width, x_offset, y_offset = get_padding_values(
-        width, height, target_width, target_height)
-    if not crop:
-        filter_complex.append('scale=%i:-1' % image_width)
-        filter_complex.append('pad=%i:%i:%i:%i' % (
-            target_width, target_height, x_offset, y_offset))
-    else:
-        filter_complex.append(
-            'crop=%i:%i:0:100' % (target_width, target_height))
-
-    # Overlay text
-    font_size = round(target_width / 53.0 * font_scale)
-    margin_size = left_pos = top_pos = round(target_width / 240.0)
-    right_pos = 'w-%i-(tw)' % margin_size
-    bottom_pos = target_height - font_size - margin_size
-    middle_pos = '(w-tw)/2'
-
-    kwargs = dict(font_path=font_path, size=font_size, start=start, end=end)
-    filters_args = (
-        (top_left, left_pos, top_pos, top_left_color),
-        (top_middle, middle_pos, top_pos, top_middle_color),
-        (top_right, right_pos, top_pos, top_right_color),
-        (bottom_left, top_pos, bottom_pos, bottom_left_color),
-        (bottom_middle, middle_pos, bottom_pos, bottom_middle_color),
-        (bottom_right, right_pos, bottom_pos, bottom_right_color))
-
-    for text, left, top, color in filters_args:
-        if not text:
-            continue
-        filter_complex.append(drawtext(text, left, top, color, **kwargs))
-
-    # Add boxes (rectangles/safe-frames)
-    for rectangle in rectangles or []:
-        filter_complex.append(drawbox(**rectangle))
-
-    # Format filter complex
-    cmd += ' -filter_complex "%s"' % ','.join(filter_complex)
-
-    # Metadata
-    for key, value in metadata or []:
-        cmd += ' -metadata %s="%s"' % (key, value)
-
-    # Video codec
-    if not video_codec:
-        cmd += ' -vcodec libx264'
-    else:
-        if not video_codec.startswith(' '):
-            video_codec = ' ' + video_codec
-        cmd += video_codec
-
-    # Sound
-    cmd += audio_codec + ' -fflags +genpts'
-
-    # Output
-    if overwrite:
-        cmd += ' -y'
-    cmd += ' "%s"' % output_path
-
-    # Launch ffmpeg
-    print(cmd)
-    if os.name == 'nt':
-        cmd = shlex.split(cmd)
-    proc = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        print(out)
-        raise Exception(err)
+    command = get_encode_command(
+        images_path, output_path,
+        progress=bool(progress_callback), start=start, end=end,
+        frame_rate=frame_rate, sound_path=sound_path,
+        sound_offset=sound_offset, source_width=source_width,
+        source_height=source_height, target_width=target_width,
+        target_height=target_height, crop=crop, framerange=framerange,
+        top_left=top_left, top_middle=top_middle, top_right=top_right,
+        bottom_left=bottom_left, bottom_middle=bottom_middle,
+        bottom_right=bottom_right, top_left_color=top_left_color,
+        top_middle_color=top_middle_color, top_right_color=top_right_color,
+        bottom_left_color=bottom_left_color,
+        bottom_middle_color=bottom_middle_color,
+        bottom_right_color=bottom_right_color, font_path=font_path,
+        font_scale=font_scale, overlay_image=overlay_image,
+        rectangles=rectangles, static_overlay=static_overlay,
+        input_args=input_args, video_codec=video_codec,
+        audio_codec=audio_codec, add_silent_audio=add_silent_audio,
+        silence_settings=silence_settings, threads=threads,
+        ffmpeg_path=ffmpeg_path, metadata=metadata, overwrite=overwrite,
+        verbose=verbose, frames=frames, pix_fmt=pix_fmt, outputs=outputs)
+    try:
+        run_ffmpeg(
+            command.args, progress_callback, command.total_frames,
+            verbose=verbose,
+            stdin_chunks=command.stdin_chunks)
+    finally:
+        remove_temp_files(command.temp_paths)
+
+
+def _iter_frames_data(frames):
+    for frame in frames:
+        if isinstance(frame, (bytes, bytearray, memoryview)):
+            yield frame
+        elif getattr(frame, 'flags', None) and frame.flags.c_contiguous:
+            yield memoryview(frame).cast('B')  # NumPy array, avoid copy
+        else:
+            yield frame.tobytes()
+
+
+def encode_frames(
+        frames,
+        output_path,
+        width,
+        height,
+        pix_fmt='rgb24',
+        start=0,
+        end=None,
+        **kwargs):
+    """
+    Encode in-memory images to movie, streamed to FFmpeg stdin as rawvideo.
+
+    - frames (iterable) NumPy arrays (height x width x channels) or bytes.
+        Consumed lazily: FFmpeg reading speed drives the iteration.
+    - width (int) Frames width
+    - height (int) Frames height
+    - pix_fmt (str) FFmpeg pixel format of the frames. Default is rgb24
+    - start (int) Number of the first frame, for {frame} texts
+    - end (int) Last frame number. Default is deduced from len(frames)
+
+    Other arguments are the same as encode() (texts, padding, sound,
+    metadata...).
+    """
+    if end is None and hasattr(frames, '__len__'):
+        end = start + len(frames) - 1
+    return encode(
+        None, output_path, start=start, end=end, source_width=width,
+        source_height=height, frames=frames, pix_fmt=pix_fmt, **kwargs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,147 @@
+"""
+Read images width and height from their header only, without Pillow.
+
+Supported formats: JPEG, PNG, TIFF, DPX and OpenEXR.
+"""
+
+__author__ = 'Olivier Evers'
+__copyright__ = 'DreamWall'
+__license__ = 'MIT'
+
+
+import os
+import struct
+from functools import lru_cache
+
+
+HEADER_SIZE = 4096
+# Start Of Frame markers (DHT, JPG and DAC excluded)
+JPEG_SOF_MARKERS = {
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_STANDALONE_MARKERS = {0x01, 0xD8, 0xD9} | set(range(0xD0, 0xD8))
+TIFF_SHORT, TIFF_LONG = 3, 4
+
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError('Unexpected end of file.')
+    return data
+
+
+def _read_png_size(f, header):
+    return struct.unpack('>II', header[16:24])
+
+
+def _read_jpeg_size(f, header):
+    f.seek(2)
+    while True:
+        byte = _read(f, 1)
+        while byte != b'\xff':
+            byte = _read(f, 1)
+        while byte == b'\xff':  # fill bytes
+            byte = _read(f, 1)
+        marker = ord(byte)
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        length = struct.unpack('>H', _read(f, 2))[0]
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>xHH', _read(f, 5))
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def _read_tiff_size(f, header):
+    endian = '<' if header[:2] == b'II' else '>'
+    if struct.unpack(endian + 'H', header[2:4])[0] != 42:
+        raise ValueError('BigTIFF is not supported.')
+    f.seek(struct.unpack(endian + 'I', header[4:8])[0])
+    entries_count = struct.unpack(endian + 'H', _read(f, 2))[0]
+    values = dict()
+    for _ in range(entries_count):
+        tag, type_, _, value = struct.unpack(
+            endian + 'HHI4s', _read(f, 12))
+        if tag not in (256, 257):  # ImageWidth, ImageLength
+            continue
+        if type_ == TIFF_SHORT:
+            values[tag] = struct.unpack(endian + 'H', value[:2])[0]
+        elif type_ == TIFF_LONG:
+            values[tag] = struct.unpack(endian + 'I', value)[0]
+        if len(values) == 2:
+            return values[256], values[257]
+    raise ValueError('TIFF size tags not found.')
+
+
+def _read_dpx_size(f, header):
+    endian = '>' if header[:4] == b'SDPX' else '<'
+    f.seek(772)  # image information header: pixels per line, lines
+    return struct.unpack(endian + 'II', _read(f, 8))
+
+
+def _read_null_terminated(f):
+    chars = []
+    char = _read(f, 1)
+    while char != b'\x00':
+        chars.append(char)
+        char = _read(f, 1)
+    return b''.join(chars).decode('latin1')
+
+
+def _read_exr_size(f, header):
+    f.seek(8)
+    windows = dict()
+    while True:
+        name = _read_null_terminated(f)
+        if not name:
+            break
+        type_ = _read_null_terminated(f)
+        size = struct.unpack('<i', _read(f, 4))[0]
+        if name in ('displayWindow', 'dataWindow') and type_ == 'box2i':
+            windows[name] = struct.unpack('<4i', _read(f, 16))
+            f.seek(size - 16, 1)
+        else:
+            f.seek(size, 1)
+    # FFmpeg outputs images of the display window size.
+    window = windows.get('displayWindow') or windows.get('dataWindow')
+    if not window:
+        raise ValueError('EXR window attributes not found.')
+    x_min, y_min, x_max, y_max = window
+    return x_max - x_min + 1, y_max - y_min + 1
+
+
+READERS = (
+    (b'\x89PNG\r\n\x1a\n', _read_png_size),
+    (b'\xff\xd8', _read_jpeg_size),
+    (b'II*\x00', _read_tiff_size),
+    (b'MM\x00*', _read_tiff_size),
+    (b'II+\x00', _read_tiff_size),
+    (b'MM\x00+', _read_tiff_size),
+    (b'SDPX', _read_dpx_size),
+    (b'XPDS', _read_dpx_size),
+    (b'\x76\x2f\x31\x01', _read_exr_size),
+)
+
+
+@lru_cache(maxsize=4096)
+def _get_image_size(image_path, file_size, modification_time):
+    with open(image_path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        for magic, reader in READERS:
+            if header.startswith(magic):
+                try:
+                    width, height = reader(f, header)
+                except struct.error:  # header truncated in the first block
+                    raise ValueError('Truncated image header: %s' % image_path)
+                return int(width), int(height)
+    raise ValueError('Unsupported image format: %s' % image_path)
+
+
+def get_image_size(image_path):
+    """
+    Return (width, height) read from the image header. Results are cached
+    until the file size or modification time changes.
+    Raise ValueError for unsupported formats and truncated headers.
+    """
+    stat = os.stat(image_path)
+    return _get_image_size(image_path, stat.st_size, stat.st_mtime_ns)
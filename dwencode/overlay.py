@@ -0,0 +1,197 @@
+"""
+Rasterize burn-ins (texts and rectangles) with Pillow, matching the FFmpeg
+drawtext/drawbox layout used by dwencode.encode.
+"""
+
+__author__ = 'Olivier Evers'
+__copyright__ = 'DreamWall'
+__license__ = 'MIT'
+
+
+import os
+import datetime
+import tempfile
+from functools import lru_cache
+
+
+TEXT_SLOTS = {
+    'top_left': ('left', 'top'),
+    'top_middle': ('middle', 'top'),
+    'top_right': ('right', 'top'),
+    'bottom_left': ('left', 'bottom'),
+    'bottom_middle': ('middle', 'bottom'),
+    'bottom_right': ('right', 'bottom'),
+}
+DYNAMIC_EXPRESSIONS = ('{frame}', '{framerange}')
+BORDER_COLOR = (0, 0, 0, 102)  # black@0.4, same as drawtext default border
+
+
+def _import_pillow():
+    try:
+        from PIL import Image, ImageColor, ImageDraw, ImageFont
+    except ImportError:
+        raise Exception('Install Pillow (PIL) to rasterize overlays.')
+    return Image, ImageColor, ImageDraw, ImageFont
+
+
+def get_text_geometry(target_width, target_height, font_scale=1.0):
+    """Return font size, margin and bottom texts position."""
+    font_size = round(target_width / 53.0 * font_scale)
+    margin_size = round(target_width / 240.0)
+    bottom_pos = target_height - font_size - margin_size
+    return font_size, margin_size, bottom_pos
+
+
+def is_static_text(text):
+    return not any(e in text for e in DYNAMIC_EXPRESSIONS)
+
+
+def format_static_text(text):
+    timetag = datetime.datetime.now().strftime(r'%Y/%m/%d %H:%M')
+    return text.replace('{datetime}', timetag)
+
+
+def parse_color(color, default='white'):
+    """
+    Convert FFmpeg color (e.g. "#RRGGBB@A", "0xRRGGBB", "RRGGBB", "white")
+    to a RGBA tuple.
+    """
+    ImageColor = _import_pillow()[1]
+    color = color or default
+    opacity = 1.0
+    if '@' in color:
+        color, opacity = color.split('@')
+        opacity = float(opacity)
+    if color.lower().startswith('0x'):
+        color = color[2:]
+    if len(color) in (6, 8) and not color.startswith('#'):
+        try:
+            int(color, 16)
+            color = '#' + color
+        except ValueError:
+            pass
+    rgba = ImageColor.getcolor(color, 'RGBA')
+    return rgba[:3] + (round(rgba[3] * opacity),)
+
+
+@lru_cache()
+def get_font(font_path, size):
+    ImageFont = _import_pillow()[3]
+    if font_path:
+        return ImageFont.truetype(font_path, size)
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow < 10.1 default font cannot be scaled.
+        return ImageFont.load_default()
+
+
+def get_text_position(
+        slot, text_width, target_width, target_height, font_scale=1.0):
+    horizontal, vertical = TEXT_SLOTS[slot]
+    _, margin_size, bottom_pos = get_text_geometry(
+        target_width, target_height, font_scale)
+    if horizontal == 'left':
+        x = margin_size
+    elif horizontal == 'middle':
+        x = round((target_width - text_width) / 2)
+    else:
+        x = target_width - margin_size - text_width
+    y = margin_size if vertical == 'top' else bottom_pos
+    return x, y
+
+
+def draw_text(layer, slot, text, color, font_path=None, font_scale=1.0):
+    Image, _, ImageDraw, _ = _import_pillow()
+    width, height = layer.size
+    font_size = get_text_geometry(width, height, font_scale)[0]
+    font = get_font(font_path, font_size)
+    text_layer = Image.new('RGBA', layer.size)
+    draw = ImageDraw.Draw(text_layer)
+    x, y = get_text_position(
+        slot, draw.textlength(text, font=font), width, height, font_scale)
+    kwargs = dict()
+    if not color:
+        kwargs = dict(
+            stroke_width=int(font_size / 18), stroke_fill=BORDER_COLOR)
+    draw.text(
+        (x, y), text, font=font, fill=parse_color(color), anchor='la',
+        **kwargs)
+    layer.alpha_composite(text_layer)
+
+
+def get_framerange_anchor(slot, target_width, target_height, font_scale=1.0):
+    """
+    Position between the "{frame}" and "[start-end]" texts of a framerange,
+    same as dwencode.encode.draw_framerange.
+    """
+    font_size, margin_size, bottom_pos = get_text_geometry(
+        target_width, target_height, font_scale)
+    horizontal, vertical = TEXT_SLOTS[slot]
+    if horizontal == 'left':
+        x = margin_size + font_size * 3
+    elif horizontal == 'middle':
+        x = target_width / 2
+    else:
+        x = target_width - margin_size - font_size * 6
+    y = margin_size if vertical == 'top' else bottom_pos
+    return x, y
+
+
+def render_text(text, color, font_path=None, size=36):
+    """
+    Return text as a tight RGBA image, and its offset relative to the text
+    position.
+    """
+    Image, _, ImageDraw, _ = _import_pillow()
+    font = get_font(font_path, size)
+    stroke_width = 0 if color else int(size / 18)
+    ascent, descent = font.getmetrics()
+    width = int(font.getlength(text)) + 1 + stroke_width * 2
+    height = ascent + descent + stroke_width * 2
+    image = Image.new('RGBA', (width, height))
+    ImageDraw.Draw(image).text(
+        (stroke_width, stroke_width), text, font=font,
+        fill=parse_color(color), anchor='la', stroke_width=stroke_width,
+        stroke_fill=BORDER_COLOR)
+    return image, (-stroke_width, -stroke_width)
+
+
+def draw_rectangle(layer, x, y, width, height, color, opacity, thickness):
+    Image, _, ImageDraw, _ = _import_pillow()
+    rectangle_layer = Image.new('RGBA', layer.size)
+    color = parse_color(color)
+    color = color[:3] + (round(color[3] * float(opacity)),)
+    ImageDraw.Draw(rectangle_layer).rectangle(
+        (x, y, x + width - 1, y + height - 1), outline=color,
+        width=thickness)
+    layer.alpha_composite(rectangle_layer)
+
+
+def render_static_layer(
+        width, height, texts=None, rectangles=None, font_path=None,
+        font_scale=1.0):
+    """
+    Draw texts and rectangles on a transparent RGBA image.
+
+    - texts (dict) {slot: (text, color)}, slots are TEXT_SLOTS keys.
+    - rectangles (dicts) need {x,y,width,height,color,opacity,thickness}
+    """
+    Image = _import_pillow()[0]
+    layer = Image.new('RGBA', (int(width), int(height)))
+    for slot, (text, color) in (texts or {}).items():
+        draw_text(
+            layer, slot, format_static_text(text), color, font_path,
+            font_scale)
+    for rectangle in rectangles or []:
+        draw_rectangle(layer, **rectangle)
+    return layer
+
+
+def create_static_layer_file(*args, **kwargs):
+    """Save render_static_layer() result to a temporary png file."""
+    layer = render_static_layer(*args, **kwargs)
+    handle, path = tempfile.mkstemp(prefix='dwencode_overlay_', suffix='.png')
+    os.close(handle)
+    layer.save(path)
+    return path.replace('\\', '/')
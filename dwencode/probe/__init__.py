@@ -1,26 +1,233 @@
-from dwencode.probe import ffprobe
-from dwencode.probe import quicktime
+"""
+Movie duration and information queries through pluggable backends.
 
+Backends are only imported when first used, and are chosen by capability
+(duration in seconds, frame count or full information), supported
+extensions and measured speed. QuickTime/MP4 movies are read by the pure
+python parser first, without loading any heavy module nor subprocess.
 
-try:
-    import cv2  # opencv-python
-except ImportError:
-    print('Warning: cannot use opencv => slower movie duration queries.')
-    cv2 = None
+Movie information can be kept in a persistent cache (see probe.cache).
+"""
 
+import time
+import importlib
+import importlib.util
+import threading
 
-def cv2_get_video_duration(video_path, frames=False):
-    video = cv2.VideoCapture(video_path)
-    duration = video.get(cv2.CAP_PROP_FRAME_COUNT)
-    if not frames and duration:
-        duration /= video.get(cv2.CAP_PROP_FPS)
-    return duration
+from dwencode.ffpath import get_ffprobe_path
+from dwencode.probe.cache import get_cache
 
 
-def get_video_duration(video_path, frames=False, ffprobe_path=None):
-    if cv2 is not None:
-        return cv2_get_video_duration(video_path, frames)
-    elif video_path.endswith('.mov'):
-        return quicktime.get_mov_duration(video_path, frames, framerate=25.0)
+DURATION = 'duration'
+FRAMES = 'frames'
+INFO = 'info'
+QUICKTIME_EXTENSIONS = ('.mov', '.mp4', '.m4v', '.m4a', '.3gp', '.qt')
+SPEED_SMOOTHING = 0.2  # weight of the last call in the measured time
+INFO_KEYS = (
+    'duration', 'video_duration', 'frames', 'fps', 'width', 'height',
+    'video_codec', 'pix_fmt', 'audio_duration', 'audio_codec', 'sample_rate',
+    'channels', 'audio_layout')
+
+
+class Backend(object):
+    """
+    - name (str) Name given to get_video_duration(backend=...)
+    - module (str) Module imported on first use, with a
+        get_video_duration(path, frames) function (DURATION and FRAMES
+        capabilities) and/or a get_movie_info(path) function (INFO)
+    - capabilities (set) DURATION, FRAMES and/or INFO
+    - extensions (tuple) Supported extensions. Default is all
+    - requires (str) Module which needs to be installed
+    - options (tuple) Keyword arguments passed to the backend (e.g.
+        "ffprobe_path")
+    - cost (float) Expected seconds per query, until it is measured
+    """
+    def __init__(
+            self, name, module, capabilities, extensions=None, requires=None,
+            options=(), cost=0.05):
+        self.name = name
+        self.module = module
+        self.capabilities = set(capabilities)
+        self.extensions = extensions
+        self.requires = requires
+        self.options = options
+        self.cost = cost
+        self.average_times = dict()  # {function name: seconds}
+        self._available = None
+        self._functions = dict()
+
+    def __repr__(self):
+        return '<Backend %s>' % self.name
+
+    def get_average_time(self, function_name='get_video_duration'):
+        return self.average_times.get(function_name, self.cost)
+
+    def is_available(self, ffprobe_path=None):
+        if 'ffprobe_path' in self.options:
+            try:
+                get_ffprobe_path(ffprobe_path)
+                return True
+            except Exception:
+                return False
+        if self._available is None:
+            self._available = not self.requires or bool(
+                importlib.util.find_spec(self.requires))
+        return self._available
+
+    def supports(self, video_path, capability):
+        if capability not in self.capabilities:
+            return False
+        return not self.extensions or video_path.lower().endswith(
+            self.extensions)
+
+    def call(self, function_name, *args, **options):
+        """Call a function of the backend module and measure its speed."""
+        function = self._functions.get(function_name)
+        if function is None:
+            module = importlib.import_module(self.module)
+            function = self._functions[function_name] = getattr(
+                module, function_name)
+        options = {k: v for k, v in options.items() if k in self.options}
+        start_time = time.perf_counter()
+        result = function(*args, **options)
+        elapsed_time = time.perf_counter() - start_time
+        average_time = self.get_average_time(function_name)
+        self.average_times[function_name] = average_time + SPEED_SMOOTHING * (
+            elapsed_time - average_time)
+        return result
+
+    def get_video_duration(self, video_path, frames=False, **options):
+        return self.call('get_video_duration', video_path, frames, **options)
+
+    def get_movie_info(self, video_path, **options):
+        return self.call('get_movie_info', video_path, **options)
+
+
+BACKENDS = [
+    Backend(
+        'quicktime', 'dwencode.probe.quicktime', {DURATION, FRAMES, INFO},
+        extensions=QUICKTIME_EXTENSIONS, cost=0.001),
+    Backend(
+        'pyav', 'dwencode.probe.pyav', {DURATION, FRAMES, INFO},
+        requires='av', cost=0.005),
+    Backend(
+        'cv2', 'dwencode.probe.opencv', {DURATION, FRAMES}, requires='cv2',
+        cost=0.01),
+    Backend(
+        'ffprobe', 'dwencode.probe.ffprobe', {DURATION, FRAMES, INFO},
+        options=('ffprobe_path',), cost=0.05),
+]
+_lock = threading.Lock()
+
+
+def register_backend(backend, first=False):
+    """Add a Backend, or replace the one of the same name."""
+    with _lock:
+        BACKENDS[:] = [b for b in BACKENDS if b.name != backend.name]
+        BACKENDS.insert(0 if first else len(BACKENDS), backend)
+
+
+def get_backend(name):
+    for backend in BACKENDS:
+        if backend.name == name:
+            return backend
+    raise ValueError('Unknown probe backend: %s' % name)
+
+
+def get_backends(video_path, capability=DURATION, ffprobe_path=None):
+    """Return the backends able to probe the movie, fastest first."""
+    function_name = 'get_movie_info' if capability == INFO else (
+        'get_video_duration')
+    backends = [
+        b for b in BACKENDS if b.supports(video_path, capability)
+        and b.is_available(ffprobe_path)]
+    return sorted(backends, key=lambda b: b.get_average_time(function_name))
+
+
+def _query(video_path, capability, backend, ffprobe_path, function):
+    if backend:
+        backends = [get_backend(backend)]
     else:
-        return ffprobe.get_video_duration(video_path, frames, ffprobe_path)
+        backends = get_backends(video_path, capability, ffprobe_path)
+    if not backends:
+        raise Exception(
+            'No probe backend available for %s: install PyAV, OpenCV or '
+            'FFprobe.' % video_path)
+    error = None
+    for backend in backends:
+        try:
+            return function(backend)
+        except Exception as e:
+            error = e
+    raise error
+
+
+def get_video_duration(
+        video_path, frames=False, ffprobe_path=None, backend=None,
+        use_cache=True):
+    """
+    Return the movie video duration in seconds, or its frames count.
+
+    - backend (str) Force a backend ("quicktime", "pyav", "cv2", "ffprobe").
+        By default, the fastest capable backend is used and the next ones
+        are tried if it fails.
+    - use_cache (bool) Return the cached movie information if available.
+    """
+    cache = get_cache() if use_cache and not backend else None
+    if cache:
+        info = cache.get(video_path, INFO) or dict()
+        value = info.get(FRAMES if frames else 'video_duration')
+        if value:
+            return value
+    return _query(
+        video_path, FRAMES if frames else DURATION, backend, ffprobe_path,
+        lambda b: b.get_video_duration(
+            video_path, frames, ffprobe_path=ffprobe_path))
+
+
+def get_movie_info(
+        video_path, ffprobe_path=None, backend=None, use_cache=True):
+    """
+    Return the movie information as a dict of INFO_KEYS: duration,
+    video_duration, frames, fps, width, height, video_codec, pix_fmt,
+    audio_duration, audio_codec, sample_rate, channels and audio_layout
+    (None when unknown).
+
+    Without PyAV or FFprobe, only the video_duration is known (and these
+    partial information are not cached).
+    """
+    return get_movies_infos([video_path], ffprobe_path, backend, use_cache)[0]
+
+
+def _probe_info(video_path, ffprobe_path=None, backend=None):
+    """Return the movie information and if they are complete."""
+    if backend or get_backends(video_path, INFO, ffprobe_path):
+        info = _query(
+            video_path, INFO, backend, ffprobe_path,
+            lambda b: b.get_movie_info(video_path, ffprobe_path=ffprobe_path))
+        return info, True
+    info = dict.fromkeys(INFO_KEYS)
+    info['video_duration'] = get_video_duration(
+        video_path, ffprobe_path=ffprobe_path, use_cache=False)
+    return info, False
+
+
+def get_movies_infos(
+        video_paths, ffprobe_path=None, backend=None, use_cache=True):
+    """
+    Return the information of many movies (see get_movie_info), in the
+    paths order. Cached movies are read with a single query, so they are not
+    probed again.
+    """
+    cache = get_cache() if use_cache else None
+    infos = cache.get_many(video_paths, INFO) if cache else dict()
+    complete_infos = dict()
+    for path in video_paths:
+        if path in infos:
+            continue
+        infos[path], complete = _probe_info(path, ffprobe_path, backend)
+        if complete:
+            complete_infos[path] = infos[path]
+    if cache and complete_infos:
+        cache.set_many(complete_infos, INFO)
+    return [infos[path] for path in video_paths]
@@ -0,0 +1,258 @@
+"""
+Persistent probe results cache (sqlite), shared between processes.
+
+Entries are keyed by movie path and kind of result (e.g. "ffprobe" raw json,
+"info" normalized movie information). They are only valid while the movie
+size and modification time are unchanged.
+
+The cache is best-effort: database errors (locked, read-only or corrupt
+file) are reported once and handled as cache misses.
+
+The cache is opt-in, nothing is written unless it is enabled with:
+- the DWENCODE_PROBE_CACHE environment variable: database path, or "1" for
+    the default location ("0" or empty keeps it disabled)
+- set_cache(ProbeCache(path)), which overrides the environment variable
+Default location is:
+- %LOCALAPPDATA%/dwencode/probe_cache.sqlite on Windows
+- ~/.cache/dwencode/probe_cache.sqlite otherwise
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+ENVIRONMENT_VARIABLE = 'DWENCODE_PROBE_CACHE'
+DEFAULT_MAX_ENTRIES = 100000
+SQL_VARIABLES_LIMIT = 500  # paths per query ("IN (?, ?...)")
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+_failed_path = None  # database which could not be created
+_cache_set = False  # default cache given by set_cache()
+
+
+def get_default_cache_path():
+    if os.name == 'nt' and os.environ.get('LOCALAPPDATA'):
+        root = os.environ['LOCALAPPDATA']
+    else:
+        root = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'dwencode', 'probe_cache.sqlite')
+
+
+def _normalize(path):
+    return os.path.normcase(os.path.abspath(path)).replace('\\', '/')
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _chunks(list_, chunk_size):
+    for i in range(0, len(list_), chunk_size):
+        yield list_[i:i + chunk_size]
+
+
+class ProbeCache(object):
+    """
+    - path (str) sqlite database path. Parent directory is created.
+    - max_entries (int) Least recently used entries are removed above it.
+    - wal (bool) Use write-ahead logging: faster concurrent access, but
+        not supported on network file systems (e.g. NFS home directories).
+    """
+    def __init__(
+            self, path=None, max_entries=DEFAULT_MAX_ENTRIES, wal=False):
+        self.path = path or get_default_cache_path()
+        self.max_entries = max_entries
+        self.wal = wal
+        self._writes = 0
+        self._warned = False
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'path TEXT, kind TEXT, size INTEGER, mtime INTEGER, '
+                'data TEXT, accessed REAL, PRIMARY KEY (path, kind))')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS accessed_index '
+                'ON entries (accessed)')
+
+    def __repr__(self):
+        return '<ProbeCache %s>' % self.path
+
+    def _connect(self):
+        # One short lived connection per operation: safe across threads and
+        # processes. Transactions are committed when leaving "with".
+        connection = sqlite3.connect(self.path, timeout=30)
+        if self.wal:
+            connection.execute('PRAGMA journal_mode=WAL')
+        return _Connection(connection)
+
+    def _warn(self, error):
+        if not self._warned:
+            print('Warning: probe cache error, ignored (%s)' % error)
+            self._warned = True
+
+    def get(self, path, kind):
+        """Return cached data, or None if missing or outdated."""
+        return self.get_many([path], kind).get(path)
+
+    def get_many(self, paths, kind):
+        """
+        Return {path: data} of the valid entries, in a single pass.
+        Database errors return no entries.
+        """
+        try:
+            return self._get_many(paths, kind)
+        except sqlite3.Error as e:
+            self._warn(e)
+            return dict()
+
+    def _get_many(self, paths, kind):
+        stats = {path: _stat(path) for path in paths}
+        keys = {_normalize(path): path for path in paths if stats[path]}
+        found = dict()
+        if not keys:
+            return found
+        with self._connect() as connection:
+            for chunk in _chunks(list(keys), SQL_VARIABLES_LIMIT):
+                rows = connection.execute(
+                    'SELECT path, size, mtime, data FROM entries '
+                    'WHERE kind = ? AND path IN (%s)' % ','.join(
+                        '?' * len(chunk)), [kind] + chunk).fetchall()
+                for key, size, mtime, data in rows:
+                    path = keys[key]
+                    if stats[path] == (size, mtime):
+                        found[path] = json.loads(data)
+            valid_keys = [_normalize(path) for path in found]
+            for chunk in _chunks(valid_keys, SQL_VARIABLES_LIMIT):
+                connection.execute(
+                    'UPDATE entries SET accessed = ? WHERE kind = ? AND '
+                    'path IN (%s)' % ','.join('?' * len(chunk)),
+                    [time.time(), kind] + chunk)
+        return found
+
+    def set(self, path, kind, data):
+        self.set_many({path: data}, kind)
+
+    def set_many(self, datas, kind):
+        """
+        Store {path: data}. Data needs to be json serializable.
+        Nothing is stored on database errors.
+        """
+        try:
+            self._set_many(datas, kind)
+        except sqlite3.Error as e:
+            self._warn(e)
+
+    def _set_many(self, datas, kind):
+        now = time.time()
+        rows = []
+        for path, data in datas.items():
+            stat = _stat(path)
+            if stat:
+                rows.append((
+                    _normalize(path), kind, stat[0], stat[1],
+                    json.dumps(data), now))
+        if not rows:
+            return
+        with self._connect() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+        self._writes += len(rows)
+        if self._writes > self.max_entries // 10:
+            self.prune()
+
+    def invalidate(self, paths=None):
+        """Remove the entries of given paths, or all the entries."""
+        with self._connect() as connection:
+            if paths is None:
+                connection.execute('DELETE FROM entries')
+                return
+            keys = [_normalize(path) for path in paths]
+            for chunk in _chunks(keys, SQL_VARIABLES_LIMIT):
+                connection.execute(
+                    'DELETE FROM entries WHERE path IN (%s)' % ','.join(
+                        '?' * len(chunk)), chunk)
+
+    def prune(self):
+        """Remove least recently used entries above max_entries."""
+        self._writes = 0
+        with self._connect() as connection:
+            count = connection.execute(
+                'SELECT COUNT(*) FROM entries').fetchone()[0]
+            if count <= self.max_entries:
+                return
+            connection.execute(
+                'DELETE FROM entries WHERE rowid IN (SELECT rowid FROM '
+                'entries ORDER BY accessed LIMIT ?)',
+                (count - self.max_entries,))
+
+    def count(self):
+        with self._connect() as connection:
+            return connection.execute(
+                'SELECT COUNT(*) FROM entries').fetchone()[0]
+
+
+class _Connection(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, *exc_info):
+        try:
+            if exc_info[0] is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            self.connection.close()
+
+
+def set_cache(cache):
+    """
+    Set the default ProbeCache used by the probe functions, overriding
+    DWENCODE_PROBE_CACHE. None disables the cache.
+    """
+    global _default_cache, _cache_set
+    with _default_cache_lock:
+        _default_cache = cache
+        _cache_set = True
+
+
+def get_cache():
+    """
+    Return the default ProbeCache, or None if not enabled (or if its
+    database cannot be created).
+    """
+    global _default_cache, _failed_path
+    with _default_cache_lock:
+        if _cache_set:
+            return _default_cache
+        path = os.environ.get(ENVIRONMENT_VARIABLE)
+        if not path or path == '0':
+            return None
+        if path == '1':
+            path = get_default_cache_path()
+        if _default_cache is None or path != _default_cache.path:
+            if path == _failed_path:
+                return None
+            try:
+                _default_cache = ProbeCache(path)
+            except (OSError, sqlite3.Error) as e:
+                print('Warning: probe cache disabled (%s)' % e)
+                _failed_path = path
+                _default_cache = None
+                return None
+        return _default_cache
@@ -1,24 +1,36 @@
 import os
-import time
 import json
 import locale
 import subprocess as sp
+from collections import namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures)
+
 from dwencode.ffpath import get_ffprobe_path
+from dwencode.probe.cache import get_cache
 
 
 CREATE_NO_WINDOW = 0x08000000
+DEFAULT_MAX_WORKERS = 8
 
+ProbeResult = namedtuple('ProbeResult', ['path', 'data', 'error'])
 
-def probe(vid_file_path, ffprobe_path=None):
-    ffprobe_path = get_ffprobe_path(ffprobe_path)
-    command = [
-        ffprobe_path, '-loglevel', 'quiet', '-print_format', 'json',
-        '-show_format', '-show_streams', vid_file_path]
-    proc = sp.Popen(
-        command, stdout=sp.PIPE, stderr=sp.STDOUT,
-        cwd=os.path.expanduser('~'),  # fix for Windows msg about UNC paths
-        creationflags=CREATE_NO_WINDOW)
-    out = proc.communicate()[0].decode(locale.getpreferredencoding())
+
+def get_probe_command(vid_file_path, ffprobe_path=None):
+    return [
+        get_ffprobe_path(ffprobe_path), '-loglevel', 'error',
+        '-print_format', 'json', '-show_format', '-show_streams',
+        os.path.abspath(vid_file_path)]
+
+
+def load_probe_output(out, err, returncode, vid_file_path):
+    """Return ffprobe json output as a dict, raise its error if it failed."""
+    encoding = locale.getpreferredencoding()
+    if returncode != 0:
+        err = err.decode(encoding, errors='replace').strip()
+        raise Exception('FFprobe failed on %s: %s' % (
+            vid_file_path, err or 'return code %i' % returncode))
+    out = out.decode(encoding, errors='replace')
     try:
         return json.loads(out)
     except ValueError:
@@ -26,6 +38,123 @@ def probe(vid_file_path, ffprobe_path=None):
         raise
 
 
+def probe(vid_file_path, ffprobe_path=None, use_cache=True):
+    """
+    Return ffprobe json output (format and streams) as a dict.
+    Results are kept in the persistent probe cache (see probe.cache).
+    """
+    cache = get_cache() if use_cache else None
+    if cache:
+        data = cache.get(vid_file_path, 'ffprobe')
+        if data:
+            return data
+    command = get_probe_command(vid_file_path, ffprobe_path)
+    proc = sp.Popen(
+        command, stdout=sp.PIPE, stderr=sp.PIPE,
+        cwd=os.path.expanduser('~'),  # fix for Windows msg about UNC paths
+        creationflags=CREATE_NO_WINDOW if os.name == 'nt' else 0)
+    out, err = proc.communicate()
+    data = load_probe_output(out, err, proc.returncode, vid_file_path)
+    if cache and data.get('streams'):
+        cache.set(vid_file_path, 'ffprobe', data)
+    return data
+
+
+def _probe_result(path, ffprobe_path):
+    try:
+        return ProbeResult(path, probe(path, ffprobe_path, False), None)
+    except Exception as e:
+        return ProbeResult(path, None, e)
+
+
+def probe_many(
+        vid_file_paths, max_workers=DEFAULT_MAX_WORKERS, ffprobe_path=None,
+        use_cache=True):
+    """
+    Probe many movies with at most @max_workers ffprobe processes at once,
+    and yield a ProbeResult (path, data, error) as each one completes, in
+    completion order. Cached movies are yielded first.
+
+    "data" is the probe() json output, or None if probing failed, in which
+    case "error" is the exception. A failing movie does not stop the others.
+    Paths are submitted progressively, so memory does not grow with the
+    number of movies. Closing the generator cancels the pending probes.
+    """
+    vid_file_paths = list(vid_file_paths)
+    ffprobe_path = get_ffprobe_path(ffprobe_path)
+    cache = get_cache() if use_cache else None
+    cached = cache.get_many(vid_file_paths, 'ffprobe') if cache else dict()
+    for path, data in cached.items():
+        yield ProbeResult(path, data, None)
+
+    paths = iter(p for p in vid_file_paths if p not in cached)
+    new_datas = dict()
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        pending = set()
+        for path in paths:
+            pending.add(executor.submit(_probe_result, path, ffprobe_path))
+            if len(pending) >= max_workers:
+                break
+        while pending:
+            done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result.data and result.data.get('streams'):
+                    new_datas[result.path] = result.data
+                path = next(paths, None)
+                if path is not None:
+                    pending.add(
+                        executor.submit(_probe_result, path, ffprobe_path))
+                yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if cache and new_datas:
+            cache.set_many(new_datas, 'ffprobe')
+
+
+def _get_rate(rate):
+    numerator, _, denominator = (rate or '0').partition('/')
+    if float(denominator or 1) == 0:
+        return None
+    return float(numerator) / float(denominator or 1) or None
+
+
+def _get_number(stream, key, type_=float):
+    try:
+        return type_(stream[key])
+    except (KeyError, ValueError):
+        return None
+
+
+def get_info_from_probe(data):
+    """Convert ffprobe json output to dwencode.probe movie information."""
+    streams = data.get('streams') or []
+    video = next((s for s in streams if s['codec_type'] == 'video'), None)
+    audio = next((s for s in streams if s['codec_type'] == 'audio'), None)
+    if video is None:
+        raise ValueError('No video stream found.')
+    return dict(
+        duration=_get_number(data.get('format', {}), 'duration'),
+        video_duration=_get_number(video, 'duration'),
+        frames=_get_number(video, 'nb_frames', int),
+        fps=_get_rate(video.get('avg_frame_rate')) or _get_rate(
+            video.get('r_frame_rate')),
+        width=video.get('width'),
+        height=video.get('height'),
+        video_codec=video.get('codec_name'),
+        pix_fmt=video.get('pix_fmt'),
+        audio_duration=audio and _get_number(audio, 'duration'),
+        audio_codec=audio and audio.get('codec_name'),
+        sample_rate=audio and _get_number(audio, 'sample_rate', int),
+        channels=audio and audio.get('channels'),
+        audio_layout=audio and audio.get('channel_layout'))
+
+
+def get_movie_info(video_path, ffprobe_path=None):
+    return get_info_from_probe(probe(video_path, ffprobe_path))
+
+
 def get_video_duration(video_path, frames=False, ffprobe_path=None):
     data = probe(video_path, ffprobe_path)
     vid_stream = [s for s in data['streams'] if 'nb_frames' in s][0]
@@ -41,51 +170,33 @@ def get_audio_duration(video_path, ffprobe_path=None):
 
 
 def get_format(vid_file_path, ffprobe_path=None):
-    ffprobe_path = get_ffprobe_path(ffprobe_path)
-    data = probe(vid_file_path, ffprobe_path)
-    vid_stream = [s for s in data['streams'] if 'coded_width' in s][0]
-    return vid_stream['coded_width'], vid_stream['coded_height']
+    return _get_format(probe(vid_file_path, ffprobe_path))
 
 
-def _get_formats(vid_file_paths, ffprobe_path):
-    processes = dict()
-    for path in vid_file_paths:
-        command = [
-            ffprobe_path, '-loglevel', 'quiet', '-print_format', 'json',
-            '-show_format', '-show_streams', path]
-        p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.STDOUT, shell=True)
-        processes[path] = p
-
-    formats = dict()
-    for path, p in processes.items():
-        try:
-            data = json.loads(p.communicate()[0])
-            vid_stream = [s for s in data['streams'] if 'coded_width' in s][0]
-            format_ = vid_stream['coded_width'], vid_stream['coded_height']
-            formats[path] = format_
-        except BaseException:
-            formats[path] = (0, 0)
-
-    return formats
-
-
-def _chunks(list_, chunk_size):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(list_), chunk_size):
-        yield list_[i:i + chunk_size]
+def _get_format(data):
+    vid_stream = [s for s in data['streams'] if 'coded_width' in s][0]
+    return vid_stream['coded_width'], vid_stream['coded_height']
 
 
-def get_formats(vid_file_paths, chunk_size=64, ffprobe_path=None):
-    # Cannot open infinite number of files at the same time, so cut the list
-    # into pieces:
-    ffprobe_path = get_ffprobe_path(ffprobe_path)
-    start_time = time.time()
+def get_formats(
+        vid_file_paths, max_workers=DEFAULT_MAX_WORKERS, ffprobe_path=None):
+    """
+    Return {path: (coded_width, coded_height)} of many movies, (0, 0) for
+    the movies which could not be probed (their error is printed).
+    """
     formats = dict()
     count = len(vid_file_paths)
-    for i, paths_chunk in enumerate(_chunks(vid_file_paths, chunk_size)):
-        print('Getting movies formats: %i/%i' % ((i + 1) * chunk_size, count))
-        formats.update(_get_formats(paths_chunk, ffprobe_path=ffprobe_path))
-    print(time.time() - start_time)
+    for i, result in enumerate(probe_many(
+            vid_file_paths, max_workers, ffprobe_path)):
+        try:
+            if result.error:
+                raise result.error
+            formats[result.path] = _get_format(result.data)
+        except Exception as e:
+            print('Could not get format of %s: %s' % (result.path, e))
+            formats[result.path] = (0, 0)
+        if (i + 1) % 64 == 0 or i + 1 == count:
+            print('Getting movies formats: %i/%i' % (i + 1, count))
     return formats
 
 
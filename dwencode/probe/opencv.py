@@ -0,0 +1,18 @@
+"""
+OpenCV probe backend (needs opencv-python).
+"""
+
+import cv2
+
+
+def get_video_duration(video_path, frames=False):
+    video = cv2.VideoCapture(video_path)
+    try:
+        if not video.isOpened():
+            raise ValueError('OpenCV cannot open %s' % video_path)
+        duration = video.get(cv2.CAP_PROP_FRAME_COUNT)
+        if not frames and duration:
+            duration /= video.get(cv2.CAP_PROP_FPS)
+        return duration
+    finally:
+        video.release()
@@ -0,0 +1,52 @@
+"""
+PyAV probe backend (needs av).
+"""
+
+import av
+
+
+def get_video_duration(video_path, frames=False):
+    with av.open(video_path, metadata_errors='ignore') as container:
+        if not container.streams.video:
+            raise ValueError('No video stream in %s' % video_path)
+        stream = container.streams.video[0]
+        if stream.duration is not None:
+            duration = float(stream.duration * stream.time_base)
+        elif container.duration is not None:
+            duration = container.duration / float(av.time_base)
+        else:
+            raise ValueError('Unknown duration: %s' % video_path)
+        if not frames:
+            return duration
+        if stream.frames:
+            return stream.frames
+        return int(round(duration * float(stream.average_rate)))
+
+
+def get_movie_info(video_path):
+    with av.open(video_path, metadata_errors='ignore') as container:
+        if not container.streams.video:
+            raise ValueError('No video stream in %s' % video_path)
+        video = container.streams.video[0]
+        audio = container.streams.audio[0] if container.streams.audio else None
+        info = dict(
+            duration=None,
+            video_duration=None,
+            frames=video.frames or None,
+            fps=float(video.average_rate) if video.average_rate else None,
+            width=video.codec_context.width,
+            height=video.codec_context.height,
+            video_codec=video.codec_context.name,
+            pix_fmt=video.codec_context.pix_fmt,
+            audio_duration=None,
+            audio_codec=audio and audio.codec_context.name,
+            sample_rate=audio and audio.codec_context.sample_rate,
+            channels=audio and audio.codec_context.channels,
+            audio_layout=audio and audio.codec_context.layout.name)
+        if container.duration is not None:
+            info['duration'] = container.duration / float(av.time_base)
+        if video.duration is not None:
+            info['video_duration'] = float(video.duration * video.time_base)
+        if audio is not None and audio.duration is not None:
+            info['audio_duration'] = float(audio.duration * audio.time_base)
+        return info
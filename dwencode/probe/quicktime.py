@@ -1,348 +1,690 @@
-#!/usr/bin/env python3
-# -*- mode: python -*-
-
-"""
-Downloaded from https://github.com/Deconimus/quicktime-parser
 """
+QuickTime/MP4 (.mov, .mp4) metadata parser.
 
+The file is memory-mapped and its atoms are walked in one pass (32 and 64
+bit atom sizes), so the media data is never read. Movie and tracks
+durations, exact frame rate and frame count (from mdhd and stts), video
+dimensions, codec fourcc and audio tracks information are read without
+running any subprocess.
 
-# This program is free software. It comes without any warranty, to the extent
-# permitted by applicable law. You can redistribute it and/or modify it under
-# the terms of the Do What The Fuck You Want To Public License, Version 2, as
-# published by Sam Hocevar. See http://sam.zoy.org/wtfpl/COPYING for more
-# details.
+Movie.get_sample_index() maps each frame to its byte offset, size, decode
+time and keyframe, for cut planning and random frame access.
 
-# Some useful resources:
-# - http://atomicparsley.sourceforge.net/mpeg-4files.html
-# - http://developer.apple.com/library/mac/#documentation/QuickTime/
-#       QTFF/QTFFChap2/qtff2.html
-# - http://www.sno.phy.queensu.ca/~phil/exiftool/TagNames/QuickTime.html
+Some useful resources:
+- https://developer.apple.com/documentation/quicktime-file-format
+- http://atomicparsley.sourceforge.net/mpeg-4files.html
+"""
 
-import datetime
-import os.path
-import struct
-import time
+__author__ = 'Olivier Evers'
+__copyright__ = 'DreamWall'
+__license__ = 'MIT'
 
-NAMES = {  # not used for anything, but just documents a short blurb
-    # about what these things mean
-    "vmhd": "video information media header",
-    "mvhd": 'movie header',
-    "tkhd": 'track header',
-    # The media header atom specifies the characteristics of a media,
-    # including time scale and duration
-    "mdhd": 'media header',
-    "smhd": 'sound media information header',
-    # The handler reference atom specifies the media handler component that is
-    # to be used to interpret the media's data
-    "hdlr": 'handler reference',
-
-    # The sample description atom contains a table of sample descriptions
-    "stsd": "sample description",
-    "stts": "time-to-sample",  # Time-to-sample atoms store duration
-    # information for a media's samples, providing a mapping from a time in a
-    # media to the corresponding data sample
-    # The sample-to-chunk atom contains a table that maps samples to chunks
-    "stsc": "sample-to-chunk",
-    "stco": 'chunk offset',  # Chunk offset atoms identify the location of
-    # each chunk of data
-    "stsz": 'sample size',  # You use sample size atoms to specify the size of
-    # each sample
-    # The composition offset atom contains a sample-by-sample mapping of the
-    # decode-to-presentation time
-    "ctts": 'composition offset',
-    "stss": "sync sample",  # The sync sample atom identifies the key frames
-}
 
-CONTAINER_ATOMS = ["moov", "trak", "mdia", "minf", "dinf", "stbl"]
-# undocumented atoms or redundant for metadata
-_IGNORE_ATOMS = ["iods", "mdat"]
-_ATOMS = {
-    "pnot": (12, "I2x4s2x",
-             ("Modification time", "Atom type"),
-             (0,)),
-    "vmhd": (12, "4xH6x",
-             ("graphics mode",),
-             ()),
-    "mvhd": (100, "4x5IH10x36x7I",
-             ("Creation time", "Modification time",
-              "Time Scale",
-              'Duration',
-              'Preferred rate',
-              'Preferred volume',
-              'preview time',
-              'preview duration',
-              'poster time',
-              'selection time',
-              'selection duration',
-              'current time',
-              'next track id'
-              ),
-             (4, 8)),
-    "tkhd": (84, "4x2I72x",
-             ("Creation time", "Modification time"),
-             (4, 8)),
-    "mdhd": (24, "B3x4I2H",  # 3x is "flags"
-             ("Version", "Creation time", "Modification time",
-              "Time Scale", "Duration", "Language", "Quality"),
-             (4, 8)),  # positions where dates are so we can modify them
-    "smhd": (8, "4xH2x",
-             ("balance",),
-             ())
+import os
+import sys
+import mmap
+import time
+import array
+import bisect
+import struct
+import datetime
+from collections import namedtuple
+
+
+CONTAINER_ATOMS = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts'}
+# Codec fourcc to FFmpeg codec names, same as the other probe backends:
+CODECS = {
+    'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc',
+    'av01': 'av1', 'vp09': 'vp9', 'mp4v': 'mpeg4', 'jpeg': 'mjpeg',
+    'mjpa': 'mjpeg', 'png': 'png', 'raw': 'rawvideo', 'AVdn': 'dnxhd',
+    'AVdh': 'dnxhd', 'apch': 'prores', 'apcn': 'prores', 'apcs': 'prores',
+    'apco': 'prores', 'ap4h': 'prores', 'ap4x': 'prores', 'mp4a': 'aac',
+    'ac-3': 'ac3', 'ec-3': 'eac3', '.mp3': 'mp3', 'Opus': 'opus',
+    'fLaC': 'flac', 'alac': 'alac', 'sowt': 'pcm_s16le', 'twos': 'pcm_s16be',
+    'in24': 'pcm_s24be', 'in32': 'pcm_s32be', 'fl32': 'pcm_f32be',
 }
+LAYOUTS = {1: 'mono', 2: 'stereo'}
+CHROMA_FORMATS = {0: 'gray', 1: 'yuv420p', 2: 'yuv422p', 3: 'yuv444p'}
+PRORES_FOURCCS = {'apco', 'apcs', 'apcn', 'apch', 'ap4h', 'ap4x'}
+AVC_HIGH_PROFILES = (100, 110, 122, 144, 244)
+MAC_EPOCH = datetime.datetime(1904, 1, 1)
+
+Sample = namedtuple(
+    'Sample', ['index', 'offset', 'size', 'dts', 'pts', 'keyframe'])
+
+
+def iter_atoms(data, start, end):
+    """Yield (type, data start, data end) of the atoms in [start, end]."""
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, offset)
+        header_size = 8
+        if size == 1:  # 64 bit size
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:  # atom extends to the end of the file
+            size = end - offset
+        if size < header_size:
+            raise ValueError('Invalid atom size at %i' % offset)
+        yield kind, offset + header_size, min(offset + size, end)
+        offset += size
+
+
+def _decode_fourcc(fourcc):
+    return fourcc.decode('latin1').rstrip(' \x00')
+
+
+def _read_array(data, typecode, start, count):
+    """Read @count big-endian numbers as an array."""
+    values = array.array(typecode)
+    values.frombytes(data[start:start + count * values.itemsize])
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def _read_avc_format(data, start, end):
+    """Return H.264 chroma format and bit depth of an avcC atom."""
+    profile = data[start + 1]
+    offset = start + 6
+    for _ in range(data[start + 5] & 31):  # sequence parameter sets
+        offset += 2 + struct.unpack_from('>H', data, offset)[0]
+    for _ in range(data[offset]):  # picture parameter sets
+        offset += 2 + struct.unpack_from('>H', data, offset + 1)[0]
+    offset += 1
+    if profile not in AVC_HIGH_PROFILES:
+        return 1, 8
+    if offset + 3 > end:
+        return None, None
+    return data[offset] & 3, (data[offset + 1] & 7) + 8
+
+
+def _read_prores_format(data, track):
+    """Return the pixel format FFmpeg decodes the first ProRes frame to."""
+    if b'stco' in track.tables:
+        offset = struct.unpack_from('>I', data, track.tables[b'stco'][0] + 8)
+    elif b'co64' in track.tables:
+        offset = struct.unpack_from('>Q', data, track.tables[b'co64'][0] + 8)
+    else:
+        return None
+    offset = offset[0]
+    if data[offset + 4:offset + 8] != b'icpf':
+        return None
+    chroma_format = data[offset + 20] >> 6
+    alpha = data[offset + 25] & 15
+    if chroma_format == 2:
+        return 'yuv422p10le'
+    bit_depth = 12 if track.fourcc in ('ap4h', 'ap4x') else 10
+    return '%s444p%ile' % ('yuva' if alpha else 'yuv', bit_depth)
+
+
+class SampleIndex(object):
+    """
+    Array-backed sample table of a track (stts, ctts, stsc, stco/co64, stsz
+    and stss atoms), in decode order. Samples are video frames or audio
+    packets (single samples for uncompressed audio), indexed from 0.
+
+    - offsets, sizes: position of each sample in the file, in bytes
+    - dts: decode time of each sample, in time_scale units
+    - composition_offsets: pts - dts of each sample (None without B-frames)
+    - keyframes: sorted sync samples (None if all samples are keyframes)
+    """
+    def __init__(self, path, time_scale):
+        self.path = path
+        self.time_scale = time_scale
+        self.offsets = array.array('Q')
+        self.sizes = array.array('I')
+        self.dts = array.array('Q')
+        self.composition_offsets = None
+        self.keyframes = None
+        self._presentation_order = None
+
+    def __repr__(self):
+        return '<SampleIndex %s: %i samples>' % (self.path, self.count)
+
+    @classmethod
+    def from_track(cls, data, path, track):
+        index = cls(path, track.time_scale)
+        tables = track.tables
+        if b'stsz' not in tables:
+            raise ValueError('No sample table found: %s' % path)
+        start = tables[b'stsz'][0]
+        sample_size, count = struct.unpack_from('>II', data, start + 4)
+        if sample_size:
+            index.sizes = array.array('I', [sample_size]) * count
+        else:
+            index.sizes = _read_array(data, 'I', start + 12, count)
+        index._read_offsets(data, tables)
+        index._read_times(data, tables, track.time_to_sample)
+        if b'stss' in tables:
+            start = tables[b'stss'][0]
+            count = struct.unpack_from('>I', data, start + 4)[0]
+            keyframes = _read_array(data, 'I', start + 8, count)
+            index.keyframes = array.array('I', (k - 1 for k in keyframes))
+        return index
+
+    def _read_offsets(self, data, tables):
+        if b'co64' in tables:
+            start = tables[b'co64'][0]
+            typecode = 'Q'
+        elif b'stco' in tables:
+            start = tables[b'stco'][0]
+            typecode = 'I'
+        else:
+            raise ValueError('No chunk offsets found: %s' % self.path)
+        count = struct.unpack_from('>I', data, start + 4)[0]
+        chunk_offsets = _read_array(data, typecode, start + 8, count)
+        start = tables[b'stsc'][0]
+        count = struct.unpack_from('>I', data, start + 4)[0]
+        # (first chunk, samples per chunk, sample description) entries:
+        chunk_runs = _read_array(data, 'I', start + 8, count * 3)
+        sizes = self.sizes
+        offsets = self.offsets
+        sample = 0
+        for i in range(count):
+            first_chunk = chunk_runs[i * 3] - 1
+            samples_per_chunk = chunk_runs[i * 3 + 1]
+            if i + 1 < count:
+                last_chunk = chunk_runs[i * 3 + 3] - 1
+            else:
+                last_chunk = len(chunk_offsets)
+            for chunk in range(first_chunk, last_chunk):
+                offset = chunk_offsets[chunk]
+                end = min(sample + samples_per_chunk, len(sizes))
+                for size in sizes[sample:end]:
+                    offsets.append(offset)
+                    offset += size
+                sample = end
+        if len(offsets) != len(sizes):
+            raise ValueError('Inconsistent sample tables: %s' % self.path)
+
+    def _read_times(self, data, tables, time_to_sample):
+        dts = self.dts
+        position = 0
+        for count, delta in time_to_sample:
+            if delta:
+                dts.extend(range(position, position + count * delta, delta))
+            else:
+                dts.extend([position] * count)
+            position += count * delta
+        if b'ctts' in tables:
+            start = tables[b'ctts'][0]
+            count = struct.unpack_from('>I', data, start + 4)[0]
+            # Signed offsets (version 1), usually also right for version 0.
+            runs = _read_array(data, 'i', start + 8, count * 2)
+            offsets = self.composition_offsets = array.array('i')
+            for i in range(count):
+                offsets.extend([runs[i * 2 + 1]] * runs[i * 2])
+
+    @property
+    def count(self):
+        return len(self.sizes)
+
+    @property
+    def duration(self):
+        if not self.count:
+            return 0
+        return (self.dts[-1] - self.dts[0]) / float(self.time_scale)
+
+    def get_pts(self, index):
+        if self.composition_offsets is None:
+            return self.dts[index]
+        return self.dts[index] + self.composition_offsets[index]
+
+    def is_keyframe(self, index):
+        if self.keyframes is None:
+            return True
+        i = bisect.bisect_left(self.keyframes, index)
+        return i < len(self.keyframes) and self.keyframes[i] == index
+
+    def get_keyframe(self, index):
+        """Return the last keyframe at or before sample @index."""
+        if self.keyframes is None:
+            return index
+        i = bisect.bisect_right(self.keyframes, index)
+        if not i:
+            raise ValueError('No keyframe before sample %i' % index)
+        return self.keyframes[i - 1]
+
+    def get_next_keyframe(self, index):
+        """Return the first keyframe at or after sample @index, or None."""
+        if self.keyframes is None:
+            return index if index < self.count else None
+        i = bisect.bisect_left(self.keyframes, index)
+        return self.keyframes[i] if i < len(self.keyframes) else None
+
+    def iter_gops(self):
+        """Yield (first sample, last sample + 1) of each group of pictures."""
+        keyframes = self.keyframes
+        if keyframes is None:
+            keyframes = range(self.count)
+        for i, start in enumerate(keyframes):
+            if i + 1 < len(keyframes):
+                yield start, keyframes[i + 1]
+            else:
+                yield start, self.count
+
+    def get_sample(self, index):
+        return Sample(
+            index, self.offsets[index], self.sizes[index], self.dts[index],
+            self.get_pts(index), self.is_keyframe(index))
+
+    def get_sample_at_time(self, seconds):
+        """Return the index of the sample decoded at given time."""
+        position = int(round(seconds * self.time_scale)) + self.dts[0]
+        return max(0, bisect.bisect_right(self.dts, position) - 1)
+
+    def get_decode_index(self, frame):
+        """
+        Return the sample index of the presentation @frame (the frame
+        numbers differ from the decode order with B-frames).
+        """
+        if self.composition_offsets is None:
+            return frame
+        if self._presentation_order is None:
+            self._presentation_order = array.array('I', sorted(
+                range(self.count), key=self.get_pts))
+        return self._presentation_order[frame]
+
+    def read_sample(self, index):
+        """Return the compressed data of a sample (e.g. one video frame)."""
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[index])
+            return f.read(self.sizes[index])
+
+
+class Track(object):
+    def __init__(self):
+        self.kind = None  # 'vide', 'soun'...
+        self.track_id = None
+        self.time_scale = None
+        self.media_duration = None  # in time_scale units
+        self.movie_time_scale = None
+        self.header_duration = None  # edited duration, in movie time scale
+        self.fourcc = None
+        self.width = None
+        self.height = None
+        self.pix_fmt = None
+        self.codec_config = None  # avcC/hvcC content (profile, SPS, PPS)
+        self.channels = None
+        self.sample_rate = None
+        self.sample_count = None
+        self.time_to_sample = []  # stts [(count, delta)]
+        self.tables = dict()  # sample tables atoms {type: (start, end)}
+
+    def __repr__(self):
+        return '<Track %s %s>' % (self.kind, self.fourcc)
+
+    @property
+    def codec(self):
+        return CODECS.get(self.fourcc, self.fourcc)
+
+    @property
+    def duration(self):
+        """
+        Duration after edits (e.g. without AAC priming samples). The track
+        header duration is rounded to the movie time scale, so the media
+        duration is used when it is shorter.
+        """
+        durations = []
+        if self.header_duration and self.movie_time_scale:
+            durations.append(
+                self.header_duration / float(self.movie_time_scale))
+        if self.time_scale and self.media_duration is not None:
+            durations.append(self.media_duration / float(self.time_scale))
+        return min(durations) if durations else None
+
+    @property
+    def frames(self):
+        if self.sample_count is not None:
+            return self.sample_count
+        if self.time_to_sample:
+            return sum(count for count, _ in self.time_to_sample)
+        return None
+
+    @property
+    def frame_rate(self):
+        """Exact rate for constant frame durations, average otherwise."""
+        if not self.time_scale or not self.time_to_sample:
+            return None
+        deltas = {delta for _, delta in self.time_to_sample}
+        if len(deltas) == 1 and 0 not in deltas:
+            return self.time_scale / float(deltas.pop())
+        total = sum(count * delta for count, delta in self.time_to_sample)
+        if not total:
+            return None
+        return self.time_scale * self.frames / float(total)
+
+
+class Movie(object):
+    """
+    Parse a QuickTime/MP4 file header (moov atom).
+
+    - time_scale, media_duration: movie header values
+    - creation_time, modification_time: movie header dates (seconds since
+        1904/01/01)
+    - tracks (list of Track)
+    - metadata {key: value} QuickTime "mdta" metadata (e.g. "author")
+    - date_offsets [(file offset, size)] of creation/modification dates
+    """
+    def __init__(self, path):
+        self.path = path
+        self.time_scale = None
+        self.media_duration = None
+        self.creation_time = None
+        self.modification_time = None
+        self.tracks = []
+        self.metadata = dict()
+        self.brand = None
+        self.fragmented = False
+        self.date_offsets = []
+        self.parse()
 
-_VARIABLE_LEN_ATOMS = {
-    "hdlr": (4 + 5 * 4, "4x5I",
-             ("Component type",
-              'component subtype',
-              'component manufacturer',
-              'component flags',
-              'component flags mask'),
-             (),
-             "component name"
-             ),
-    "stsd": (8, "4xI",
-             ("number of entries",),
-             (),
-             "sample description table"),
-    "stts": (8, "4xI",
-             ("number of entries",),
-             (),
-             "time-to-sample table"),
-    "stsc": (8, "4xI",
-             ("number of entries",),
-             (),
-             "sample-to-chunk table"),
-    "stco": (8, "4xI",
-             ("number of entries",),
-             (),
-             "chunk offset table"),
-    "stsz": (12, "4xII",
-             ("sample size", "number of entries",),
-             (),
-             "sample size table"),
-    "ctts": (12, "4xII",
-             ("entry count",),
-             (),
-             "composition offset table"),
-    "stss": (12, "4xII",
-             ("number of entries",),
-             (),
-             "sync sample table")
-}
+    def __repr__(self):
+        return '<Movie %s %s>' % (self.path, self.tracks)
 
-_VARIABLE_CHAINED_ATOMS = {
-    "dref": (8, "4xI",
-             ("number of entries",),
-             (),
-             "data references"
-             )
-}
+    def parse(self):
+        with open(self.path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise ValueError('Empty file: %s' % self.path)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self._parse(data)
+
+    def _parse(self, data):
+        moov = None
+        for kind, start, end in iter_atoms(data, 0, len(data)):
+            if kind == b'ftyp':
+                self.brand = _decode_fourcc(data[start:start + 4])
+            elif kind == b'moov':
+                moov = start, end
+        if moov is None:
+            raise ValueError('No moov atom found: %s' % self.path)
+        self._parse_atoms(data, moov[0], moov[1], None)
+        if not self.time_scale:
+            raise ValueError('No movie header found: %s' % self.path)
+        for track in self.tracks:
+            track.movie_time_scale = self.time_scale
+            if track.fourcc in PRORES_FOURCCS:
+                track.pix_fmt = _read_prores_format(data, track)
+
+    def _parse_atoms(self, data, start, end, track):
+        for kind, start, end in iter_atoms(data, start, end):
+            if kind == b'trak':
+                self.tracks.append(Track())
+                self._parse_atoms(data, start, end, self.tracks[-1])
+            elif kind in CONTAINER_ATOMS:
+                self._parse_atoms(data, start, end, track)
+            elif kind == b'mvex':
+                self.fragmented = True  # samples are described in moof
+            elif kind == b'mvhd':
+                self.time_scale, self.media_duration = self._read_header(
+                    data, start)
+                self.creation_time, self.modification_time = (
+                    struct.unpack_from('>QQ', data, start + 4)
+                    if data[start] == 1 else
+                    struct.unpack_from('>II', data, start + 4))
+            elif kind == b'udta' and track is None:
+                self._parse_atoms(data, start, end, track)
+            elif kind == b'meta' and track is None:
+                self._read_metadata(data, start, end)
+            elif track is None:
+                continue
+            elif kind == b'tkhd':
+                self._read_track_header(data, start, track)
+            elif kind == b'mdhd':
+                track.time_scale, track.media_duration = self._read_header(
+                    data, start)
+            elif kind == b'hdlr' and track.kind is None:
+                # QuickTime minf also has a data handler (e.g. "alis").
+                track.kind = _decode_fourcc(data[start + 8:start + 12])
+            elif kind == b'stsd':
+                self._read_sample_description(data, start, end, track)
+            elif kind == b'stts':
+                count = struct.unpack_from('>I', data, start + 4)[0]
+                values = struct.unpack_from(
+                    '>%iI' % (count * 2), data, start + 8)
+                track.time_to_sample = list(zip(values[::2], values[1::2]))
+                track.tables[kind] = start, end
+            elif kind == b'stsz':
+                track.sample_count = struct.unpack_from(
+                    '>I', data, start + 8)[0]
+                track.tables[kind] = start, end
+            elif kind in (b'stsc', b'stco', b'co64', b'stss', b'ctts'):
+                track.tables[kind] = start, end
+
+    def _read_header(self, data, start):
+        """Return time scale and duration of mvhd/mdhd atoms."""
+        if data[start] == 1:
+            self.date_offsets.extend(((start + 4, 8), (start + 12, 8)))
+            return struct.unpack_from('>IQ', data, start + 20)
+        self.date_offsets.extend(((start + 4, 4), (start + 8, 4)))
+        return struct.unpack_from('>II', data, start + 12)
+
+    def _read_metadata(self, data, start, end):
+        """Read the "mdta" keys and their values of a meta atom."""
+        if data[start + 4:start + 8] != b'hdlr':
+            start += 4  # MP4 meta is a full atom (version and flags)
+        keys = []
+        for kind, start, end in iter_atoms(data, start, end):
+            if kind == b'keys':
+                offset = start + 8
+                for _ in range(struct.unpack_from('>I', data, start + 4)[0]):
+                    size = struct.unpack_from('>I', data, offset)[0]
+                    key = bytes(data[offset + 8:offset + size]).decode(
+                        'utf-8', 'replace').lower().strip()
+                    if key.startswith('com.apple.quicktime.'):
+                        key = key[20:]
+                    keys.append(key)
+                    offset += size
+            elif kind == b'ilst':
+                for index, item_start, item_end in iter_atoms(
+                        data, start, end):
+                    index = struct.unpack('>I', index)[0] - 1
+                    if not 0 <= index < len(keys):
+                        continue
+                    for kind, value_start, value_end in iter_atoms(
+                            data, item_start, item_end):
+                        if kind == b'data':
+                            value = bytes(data[value_start + 8:value_end])
+                            self.metadata[keys[index]] = value.decode(
+                                'utf-8', 'replace').strip('\x00').strip()
+
+    def _read_track_header(self, data, start, track):
+        if data[start] == 1:
+            self.date_offsets.extend(((start + 4, 8), (start + 12, 8)))
+            track.track_id, track.header_duration = struct.unpack_from(
+                '>I4xQ', data, start + 20)
+        else:
+            self.date_offsets.extend(((start + 4, 4), (start + 8, 4)))
+            track.track_id, track.header_duration = struct.unpack_from(
+                '>I4xI', data, start + 12)
+
+    def _read_sample_description(self, data, start, end, track):
+        # Only the first sample description is read.
+        for fourcc, entry_start, entry_end in iter_atoms(
+                data, start + 8, end):
+            track.fourcc = _decode_fourcc(fourcc)
+            if track.kind == 'vide':
+                track.width, track.height = struct.unpack_from(
+                    '>HH', data, entry_start + 24)
+                track.pix_fmt = self._read_pixel_format(
+                    data, entry_start, entry_end, track.fourcc)
+                track.codec_config = self._read_codec_config(
+                    data, entry_start, entry_end)
+            elif track.kind == 'soun':
+                version = struct.unpack_from('>H', data, entry_start + 8)[0]
+                if version == 2:
+                    track.sample_rate, track.channels = struct.unpack_from(
+                        '>dI', data, entry_start + 32)
+                else:
+                    track.channels = struct.unpack_from(
+                        '>H', data, entry_start + 16)[0]
+                    track.sample_rate = struct.unpack_from(
+                        '>I', data, entry_start + 24)[0] >> 16
+                track.sample_rate = int(track.sample_rate) or (
+                    track.time_scale)
+                # PCM endianness flag
+                enda = data.find(b'enda', entry_start, entry_end)
+                if enda != -1 and data[enda + 5] == 1 and (
+                        track.codec.endswith('be')):
+                    track.fourcc = track.codec[:-2] + 'le'
+            return
 
-_DATES = ("Creation time", "Modification time")
+    def _read_codec_config(self, data, start, end):
+        for kind, start, end in iter_atoms(data, start + 78, end):
+            if kind in (b'avcC', b'hvcC'):
+                return bytes(data[start:end])
+
+    def _read_pixel_format(self, data, start, end, fourcc):
+        """Pixel format from the codec configuration, None if unknown."""
+        # Codec configuration atoms follow the 78 bytes video sample entry.
+        for kind, start, end in iter_atoms(data, start + 78, end):
+            if kind == b'avcC':
+                chroma_format, bit_depth = _read_avc_format(data, start, end)
+            elif kind == b'hvcC' and end - start > 17:
+                chroma_format = data[start + 16] & 3
+                bit_depth = (data[start + 17] & 7) + 8
+            else:
+                continue
+            if chroma_format not in CHROMA_FORMATS:
+                return None
+            pix_fmt = CHROMA_FORMATS[chroma_format]
+            return pix_fmt if bit_depth == 8 else '%s%ile' % (
+                pix_fmt, bit_depth)
+
+    @property
+    def duration(self):
+        if not self.time_scale:
+            return None
+        return self.media_duration / float(self.time_scale)
+
+    def get_track(self, kind):
+        """Return the first track of a kind ('vide', 'soun'), or None."""
+        for track in self.tracks:
+            if track.kind == kind:
+                return track
+
+    @property
+    def video_track(self):
+        return self.get_track('vide')
+
+    @property
+    def audio_track(self):
+        return self.get_track('soun')
+
+    def get_sample_index(self, track=None):
+        """
+        Return the SampleIndex of a track (default is the video track),
+        built from the sample tables of the file.
+        """
+        track = track or self.video_track
+        if track is None:
+            raise ValueError('No video track found: %s' % self.path)
+        if self.fragmented:
+            raise ValueError('Fragmented movies are not supported.')
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return SampleIndex.from_track(data, self.path, track)
+
+    def set_date(self, date):
+        """
+        Overwrite the creation and modification dates of the headers.
+        @date (naive datetime) is written as is, like the former Mov class:
+        mktime() local time conversion is compensated by time.timezone.
+        """
+        offset = datetime.datetime(1970, 1, 1) - MAC_EPOCH
+        seconds = int(
+            time.mktime((date + offset).timetuple()) - time.timezone)
+        with open(self.path, 'r+b') as f:
+            for offset, size in self.date_offsets:
+                f.seek(offset)
+                f.write(struct.pack('>Q' if size == 8 else '>I', seconds))
+        timestamp = time.mktime(date.timetuple())
+        os.utime(self.path, (timestamp, timestamp))
 
 
 class Mov(object):
+    """
+    Former parser interface, built on Movie. metadata is a flat dict of the
+    movie header values ("creation time", "modification time", "time scale",
+    "duration") and of the "mdta" metadata.
+    """
     def __init__(self, fn):
         self._fn = fn
-        self._offsets = []
+        self.movie = None
         self.metadata = dict()
 
     def parse(self):
-        fsize = os.path.getsize(self._fn)
-        # print("File: {} ({} bytes, {} MB)".format(
-        #     self._fn, fsize, fsize / (1024.**2)))
-        with open(self._fn, "rb") as self._f:
-            self._parse(fsize)
-
-    def _f_read(self, l):
-        # print('reading '+str(l))
-        return self._f.read(l)
-
-    def _f_skip(self, l):
-        self._f.seek(l, 1)
-
-    def _parse(self, length, depth=0):
-        n = 0
-        while n < length:
-            data = self._f_read(8)
-            al, an = struct.unpack(">I4s", data)
-            an = an.decode()
-
-            if an in _ATOMS:
-                self._parse_atom(an, al - 8, depth)
-            elif an == "udta":
-                self._parse_udta(al - 8, depth)
-            elif an == "ftyp":
-                self._read_ftyp(al - 8, depth)
-            elif an in CONTAINER_ATOMS:
-                self._parse(al - 8, depth + 1)
-            elif an in _VARIABLE_LEN_ATOMS:
-                self._parse_atom(an, al - 8, depth, variable=True)
-            elif an in _VARIABLE_CHAINED_ATOMS:
-                self._parse_atom(an, al - 8, depth, chained=True)
-            elif an in _IGNORE_ATOMS:
-                self._f_skip(al - 8)
-            elif an == "meta":
-                self._parse_meta(al - 8, depth)
-            else:
-                # print('unhandled thingie',al,an)
-                if al == 1:
-                    # 64 bit!
-                    # print("64 bit header!")
-                    al = struct.unpack(">Q", self._f_read(8))[0]
-                    self._f_skip(al - 16)
-                else:
-                    self._f_skip(al - 8)
-            n += al
-
-    def _parse_atom(self, atom, length, depth, variable=False, chained=False):
-        if variable:
-            spec = _VARIABLE_LEN_ATOMS[atom]
-        elif chained:
-            spec = _VARIABLE_CHAINED_ATOMS[atom]
-        else:
-            spec = _ATOMS[atom]
-            assert length == spec[0]
-
-        pos = self._f.tell()
-        data = self._f_read(length)
-        if variable:
-            v = struct.unpack(">" + spec[1], data[:spec[0]])
-        elif chained:
-            v = struct.unpack(">" + spec[1], data[:spec[0]])
-        else:
-            v = struct.unpack(">" + spec[1], data)
-        k = spec[2]
-        for i in range(0, len(k)):
-            vv = v[i]
-            if isinstance(vv, bytes):
-                vv = vv.decode()
-            elif k[i] in _DATES:
-                vv = self._macdate2date(vv)
-            # print("{}{}: {}".format(prefix, k[i], vv))
-            metakey = k[i].lower().strip()
-            if metakey not in self.metadata.keys():
-                self.metadata[metakey] = vv
-
-        if variable or chained:
-            lim = 10
-            realdata = data[spec[0]:]
-            if len(realdata) > lim:
-                # print("{}{}: {}{}{}{}".format(
-                #     prefix, spec[4], realdata[:lim], '...',
-                #     len(realdata)-lim,' more bytes'))
-                pass
-            else:
-                # print("{}{}: {}".format(prefix, spec[4], realdata))
-                pass
-
-        for offset in spec[3]:
-            self._offsets.append(pos + offset)
-
-    def _parse_meta(self, length, depth):
-
-        pos = self._f.tell()
-
-        self._f_skip(16)
-
-        header_version = self._f_read(4).decode("latin1")
-        if header_version != "mdta":
-            return
-
-        self._f_skip(33)
-
-        keys = []
-        values = []
-
-        h = self._f_read(4).decode("latin1")
-        while h == "mdta":
-            data = ""
-            b = self._f_read(1)
-            while b != b'\x00':
-                data += b.decode("latin1")
-                b = self._f_read(1)
-            keys.append(data.lower().strip())
-            while b == b'\x00':
-                b = self._f_read(1)
-            h = self._f_read(4).decode("latin1")
-
-        i = 0
-        while i < len(keys):
-            h = ""
-            while h != "data":
-                b = self._f_read(1)
-                while b == b'\x00':
-                    b = self._f_read(1)
-                b = self._f_read(1)
-                if b != b'\x00':
-                    h = b.decode("latin1")
-                    h += self._f_read(3).decode("latin1")
-            self._f_skip(8)
-            data = ""
-            b = self._f_read(1)
-            while b != b'\x00' and self._f.tell() - pos < length:
-                data += b.decode("latin1")
-                b = self._f_read(1)
-            values.append(data.strip())
-            i += 1
-
-        for i in range(0, min(len(keys), len(values))):
-
-            key = keys[i]
-            if key.startswith("com.apple.quicktime."):
-                key = key[20:]
-
-            self.metadata[key] = values[i]
-
-        self._f.seek(pos + length, 0)
-
-    def _read_ftyp(self, length, depth):
-        data = self._f_read(8)
-        brand, version = struct.unpack(">4sI", data)
-        brand = brand.decode("latin1")
-        # print("{}Brand: {}, version: {}".format(prefix, brand, version))
-        self._f_skip(length - 8)
-
-    def _parse_udta(self, length, depth):
-        n = 0
-        while n < length:
-            atom_size, data_type = struct.unpack(">I4s", self._f_read(8))
-            data_type = data_type.decode("latin1")
-            n += atom_size
-
-    def _macdate2date(self, md):
-        d = datetime.datetime(1904, 1, 1) + datetime.timedelta(seconds=md)
-        return "{} ({})".format(d, md)
-
-    def _date2macdate(self, d):
-        td = datetime.datetime(1970, 1, 1) - datetime.datetime(1904, 1, 1)
-        dd = d + td
-        sec = time.mktime(dd.timetuple()) - time.timezone
-        return int(sec)
+        self.movie = Movie(self._fn)
+        self.metadata = {
+            'creation time': _format_mac_date(self.movie.creation_time),
+            'modification time': _format_mac_date(
+                self.movie.modification_time),
+            'time scale': self.movie.time_scale,
+            'duration': self.movie.media_duration}
+        self.metadata.update(self.movie.metadata)
 
     def set_date(self, d):
-        md = self._date2macdate(d)
-        print("New date: {} ({})".format(d, md))
-        with open(self._fn, "r+b") as f:
-            print("Writing new date at {} positions...".format(
-                len(self._offsets)))
-            for offset in self._offsets:
-                f.seek(offset)
-                data = struct.pack(">I", md)
-                f.write(data)
-            f.flush()
-            print("Touching file...")
-            ts = time.mktime(d.timetuple())
-            os.utime(self._fn, (ts, ts))
-        print("Done!")
-
-
-def get_mov_duration(mov_path, frames=False, framerate=25.0):
-    # FIXME: get framerate from movie
-    m = Mov(mov_path)
-    m.parse()
-    duration = (
-        m.metadata['duration'] / float(m.metadata['time scale']))
-    if frames:
-        duration = int(round(duration * framerate))
-    return duration
+        if self.movie is None:
+            self.parse()
+        self.movie.set_date(d)
+
+
+def _format_mac_date(seconds):
+    date = MAC_EPOCH + datetime.timedelta(seconds=seconds or 0)
+    return '{} ({})'.format(date, seconds)
+
+
+def get_mov_duration(mov_path, frames=False, framerate=None):
+    """
+    Return the movie duration in seconds, or the video frames count.
+    @framerate is only used to count frames of movies without video track.
+    """
+    movie = Movie(mov_path)
+    if not frames:
+        return movie.duration
+    track = movie.video_track
+    if track is not None and track.frames is not None:
+        return track.frames
+    if not framerate:
+        raise ValueError('No video track found: %s' % mov_path)
+    return int(round(movie.duration * framerate))
+
+
+def _get_video_track(movie):
+    if movie.fragmented:
+        raise ValueError('Fragmented movies are not supported.')
+    track = movie.video_track
+    if track is None:
+        raise ValueError('No video track found: %s' % movie.path)
+    return track
+
+
+def get_video_duration(video_path, frames=False):
+    """Probe backend function: video track duration or frames count."""
+    track = _get_video_track(Movie(video_path))
+    value = track.frames if frames else track.duration
+    if value is None:
+        raise ValueError('Unknown video duration: %s' % video_path)
+    return value
+
+
+def get_movie_info(video_path):
+    """Probe backend function, see dwencode.probe.get_movie_info."""
+    movie = Movie(video_path)
+    video = _get_video_track(movie)
+    audio = movie.audio_track
+    return dict(
+        duration=movie.duration,
+        video_duration=video.duration,
+        frames=video.frames,
+        fps=video.frame_rate,
+        width=video.width,
+        height=video.height,
+        video_codec=video.codec,
+        pix_fmt=video.pix_fmt,  # None if not in the codec configuration
+        audio_duration=audio and audio.duration,
+        audio_codec=audio and audio.codec,
+        sample_rate=audio and audio.sample_rate,
+        channels=audio and audio.channels,
+        audio_layout=audio and LAYOUTS.get(audio.channels))
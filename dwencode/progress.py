@@ -0,0 +1,167 @@
+"""
+Run FFmpeg while reading its "-progress" output incrementally.
+"""
+
+__author__ = 'Olivier Evers'
+__copyright__ = 'DreamWall'
+__license__ = 'MIT'
+
+
+import locale
+import threading
+import subprocess as sp
+from collections import deque, namedtuple
+
+
+PROGRESS_ARGS = '-progress pipe:1 -nostats'
+STDERR_MAX_LINES = 200
+
+Progress = namedtuple('Progress', [
+    'frame',  # frames encoded so far
+    'fps',  # encoding speed in frames per second
+    'speed',  # encoding speed relative to real time (e.g. 2.5 = 2.5x)
+    'total_size',  # output size in bytes
+    'out_time',  # encoded duration in seconds
+    'eta',  # estimated remaining time in seconds (None if unknown)
+    'done',  # True for the last event
+])
+
+
+def _to_float(value):
+    try:
+        return float(value.strip().rstrip('x'))
+    except (AttributeError, ValueError):
+        return None
+
+
+class ProgressParser(object):
+    """
+    Turn FFmpeg "-progress" key=value lines into Progress events.
+
+    - total_frames (int) Used to compute the ETA from the encoding fps
+    - total_duration (float) Used to compute the ETA from the encoding speed
+    """
+    def __init__(self, total_frames=None, total_duration=None):
+        self.total_frames = total_frames
+        self.total_duration = total_duration
+        self._values = dict()
+
+    def feed(self, line):
+        """Return a Progress when a block is complete, None otherwise."""
+        key, _, value = line.strip().partition('=')
+        if not key:
+            return
+        if key != 'progress':
+            self._values[key] = value
+            return
+        values, self._values = self._values, dict()
+        return self._create_event(values, value == 'end')
+
+    def _create_event(self, values, done):
+        frame = int(_to_float(values.get('frame')) or 0)
+        fps = _to_float(values.get('fps'))
+        speed = _to_float(values.get('speed'))
+        total_size = int(_to_float(values.get('total_size')) or 0)
+        out_time = _to_float(values.get('out_time_us'))
+        if out_time is not None:
+            out_time /= 1000000.0
+
+        eta = None
+        if done:
+            eta = 0.0
+        elif self.total_frames and fps:
+            eta = max(0.0, (self.total_frames - frame) / fps)
+        elif self.total_duration and speed and out_time is not None:
+            eta = max(0.0, (self.total_duration - out_time) / speed)
+        return Progress(frame, fps, speed, total_size, out_time, eta, done)
+
+
+def _read_stderr(stream, lines, verbose):
+    encoding = locale.getpreferredencoding()
+    for line in iter(stream.readline, b''):
+        line = line.decode(encoding, errors='replace').rstrip()
+        lines.append(line)
+        if verbose:
+            print(line)
+
+
+def _write_stdin(stream, chunks, errors):
+    try:
+        for chunk in chunks:
+            try:
+                stream.write(chunk)  # blocks while FFmpeg is busy
+            except OSError:
+                return  # FFmpeg exited, its return code reports the error
+    except BaseException as e:
+        errors.append(e)  # raised by the chunks iterable, re-raised later
+    finally:
+        try:
+            stream.close()
+        except OSError:
+            pass
+
+
+def iter_progress(
+        cmd, total_frames=None, total_duration=None, cwd=None,
+        verbose=False, stdin_chunks=None, **popen_kwargs):
+    """
+    Launch an FFmpeg command (list of args) containing PROGRESS_ARGS and
+    yield Progress events as they are written.
+
+    Only the last lines of stderr are kept (to report errors), so memory use
+    does not grow with the encoding length.
+
+    @stdin_chunks is an optional iterable of bytes-like objects written to
+    FFmpeg stdin (e.g. "-i pipe:0" rawvideo frames).
+    """
+    proc = sp.Popen(
+        cmd, stdout=sp.PIPE, stderr=sp.PIPE, cwd=cwd,
+        stdin=sp.PIPE if stdin_chunks is not None else None, **popen_kwargs)
+    stderr_lines = deque(maxlen=STDERR_MAX_LINES)
+    stderr_thread = threading.Thread(
+        target=_read_stderr, args=(proc.stderr, stderr_lines, verbose))
+    stderr_thread.daemon = True
+    stderr_thread.start()
+    stdin_errors = []
+    stdin_thread = None
+    if stdin_chunks is not None:
+        stdin_thread = threading.Thread(
+            target=_write_stdin, args=(proc.stdin, stdin_chunks, stdin_errors))
+        stdin_thread.daemon = True
+        stdin_thread.start()
+
+    parser = ProgressParser(total_frames, total_duration)
+    encoding = locale.getpreferredencoding()
+    try:
+        for line in iter(proc.stdout.readline, b''):
+            event = parser.feed(line.decode(encoding, errors='replace'))
+            if event is not None:
+                yield event
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if stdin_thread:
+            stdin_thread.join()
+        stderr_thread.join()
+        proc.stdout.close()
+        proc.stderr.close()
+    if stdin_errors:
+        raise stdin_errors[0]
+    if proc.returncode != 0:
+        raise Exception('\n'.join(stderr_lines))
+
+
+def run_ffmpeg(
+        cmd, progress_callback=None, total_frames=None, total_duration=None,
+        cwd=None, verbose=False, stdin_chunks=None, **popen_kwargs):
+    """
+    Run an FFmpeg command (list of args), calling @progress_callback with
+    each Progress event. The command needs PROGRESS_ARGS to emit events.
+    """
+    for event in iter_progress(
+            cmd, total_frames, total_duration, cwd, verbose, stdin_chunks,
+            **popen_kwargs):
+        if progress_callback:
+            progress_callback(event)
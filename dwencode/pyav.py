@@ -1,10 +1,841 @@
 import os
+import time
+import queue
+import logging
 import fractions
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import av
+import av.bitstream
 import av.container
 import numpy as np
 
+from dwencode.encode import get_padding_values
+from dwencode.probe import get_movies_infos
+from dwencode.sequence import conform_pattern, scan_sequence
+from dwencode.overlay import (
+    format_static_text, get_font, get_framerange_anchor,
+    get_text_geometry, get_text_position, is_static_text, render_static_layer,
+    render_text)
+
+
+DEFAULT_LAYOUTS = {1: 'mono', 2: 'stereo'}
+DEFAULT_PROGRESS_INTERVAL = 0.5  # seconds between progress events
+DEFAULT_PREFETCH = 2  # clips decoded ahead of the one being encoded
+DEFAULT_PREFETCH_MEMORY = 512 * 1024 * 1024  # bytes of queued frames
+# Encoders output Annex B streams, remuxed packets need the same format:
+ANNEXB_FILTERS = {'h264': 'h264_mp4toannexb', 'hevc': 'hevc_mp4toannexb'}
+
+ConcatenateProgress = namedtuple('ConcatenateProgress', [
+    'clip',  # index of the clip being written
+    'clips',  # clips count
+    'frame',  # frames written so far
+    'total_frames',  # frames to write (None if unknown)
+    'fps',  # writing speed in frames per second
+    'total_size',  # bytes muxed so far
+    'eta',  # estimated remaining time in seconds (None if unknown)
+    'done',  # True for the last event
+])
+
+logger = logging.getLogger(__name__)
+
+
+class Layer(object):
+    """
+    RGBA image cached as premultiplied float arrays, cropped to its visible
+    pixels, to be blended on rgb24 frames.
+    """
+    def __init__(self, image, x=0, y=0):
+        bbox = image.getbbox()
+        self.empty = bbox is None
+        if self.empty:
+            return
+        rgba = np.asarray(image.crop(bbox), dtype=np.float32) / 255.0
+        self.alpha = rgba[..., 3:]
+        self.color = rgba[..., :3] * self.alpha * 255.0
+        self.x = int(round(x)) + bbox[0]
+        self.y = int(round(y)) + bbox[1]
+
+    def composite(self, array, x=None, y=None):
+        """Blend layer over a HxWx3 uint8 array, in place."""
+        if self.empty:
+            return
+        x = self.x if x is None else int(round(x)) + self.x
+        y = self.y if y is None else int(round(y)) + self.y
+        height, width = array.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1 = min(x + self.color.shape[1], width)
+        y1 = min(y + self.color.shape[0], height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        color = self.color[y0 - y:y1 - y, x0 - x:x1 - x]
+        alpha = self.alpha[y0 - y:y1 - y, x0 - x:x1 - x]
+        region = array[y0:y1, x0:x1]
+        region[...] = np.clip(
+            region * (1.0 - alpha) + color + 0.5, 0, 255).astype(np.uint8)
+
+
+class TextRenderer(object):
+    """Draw changing texts (e.g. frame numbers) from cached glyphs."""
+    def __init__(self, color=None, font_path=None, size=36):
+        self.color = color
+        self.font_path = font_path
+        self.size = size
+        self.font = get_font(font_path, size)
+        self._glyphs = dict()
+
+    def _get_glyph(self, char):
+        if char not in self._glyphs:
+            image, (x, y) = render_text(
+                char, self.color, self.font_path, self.size)
+            advance = self.font.getlength(char)
+            self._glyphs[char] = Layer(image, x, y), advance
+        return self._glyphs[char]
+
+    def get_width(self, text):
+        return sum(self._get_glyph(char)[1] for char in text)
+
+    def composite(self, array, text, x, y):
+        for char in text:
+            layer, advance = self._get_glyph(char)
+            layer.composite(array, x, y)
+            x += advance
+
+
+class AudioStreamWriter(object):
+    """
+    Encode audio frames alongside the video, so both streams are muxed
+    interleaved. Missing audio is padded with silence, extra audio is trimmed.
+    """
+    def __init__(self, output, stream, frames=None):
+        self.output = output
+        self.stream = stream
+        self.format = stream.format.name
+        self.layout = stream.layout.name
+        self.sample_rate = stream.rate
+        self.frame_size = stream.codec_context.frame_size or 1024
+        self.time_base = fractions.Fraction(1, self.sample_rate)
+        self.fifo = av.AudioFifo(
+            format=self.format, layout=self.layout,
+            sample_rate=self.sample_rate)
+        self.frames = iter(frames or ())
+        self.pts = 0
+        self.size = 0  # bytes muxed
+
+    def _write_frame(self, frame):
+        frame.pts = self.pts
+        frame.time_base = self.time_base
+        self.pts += frame.samples
+        for packet in self.stream.encode(frame):
+            self.size += packet.size
+            self.output.mux(packet)
+
+    def write_until(self, time, final=False):
+        """Encode audio up to @time (in seconds)."""
+        target = int(round(time * self.sample_rate))
+        while self.pts + self.fifo.samples < target:
+            try:
+                frame = next(self.frames)
+            except StopIteration:
+                break
+            frame.pts = None
+            self.fifo.write(frame)
+        if final:
+            missing = target - self.pts - self.fifo.samples
+            if missing > 0:
+                self.fifo.write(create_silence(
+                    self.format, self.layout, self.sample_rate, missing))
+        while self.fifo.samples >= self.frame_size and self.pts < target:
+            self._write_frame(self.fifo.read(self.frame_size))
+        if final:
+            remaining = target - self.pts
+            if remaining > 0:
+                self._write_frame(self.fifo.read(remaining))
+
+    def write(self, frame, time):
+        """
+        Queue a frame, and encode the queued audio up to @time (in seconds,
+        e.g. the video written so far).
+        """
+        frame.pts = None
+        self.fifo.write(frame)
+        target = int(round(time * self.sample_rate))
+        while (self.fifo.samples >= self.frame_size and
+                self.pts + self.frame_size <= target):
+            self._write_frame(self.fifo.read(self.frame_size))
+
+    def end_clip(self, time):
+        """
+        Encode the queued audio to end exactly at @time, padded with silence
+        if too short. The excess of the clip is dropped.
+        """
+        target = int(round(time * self.sample_rate))
+        missing = target - self.pts - self.fifo.samples
+        if missing > 0:
+            self.fifo.write(create_silence(
+                self.format, self.layout, self.sample_rate, missing))
+        while self.pts < target:
+            self._write_frame(self.fifo.read(
+                min(self.frame_size, target - self.pts)))
+        if self.fifo.samples:
+            self.fifo.read()
+
+    def flush(self):
+        for packet in self.stream.encode():
+            self.size += packet.size
+            self.output.mux(packet)
+
+
+class ClipReader(object):
+    """
+    Open, decode and convert a clip on a worker thread, into a bounded queue,
+    so the next clips are ready when the encoder reaches them.
+    Iterating yields ("video", frame) items, or ("packet", packet) items
+    without decoding if @remux is True (through @bitstream_filter if given),
+    interleaved with ("audio", frame) items if @audio_settings (format,
+    layout, sample_rate) are given.
+    Only the frames @first to @last are decoded (from the keyframe before
+    @first), with the matching audio.
+    """
+    _end = object()
+
+    def __init__(
+            self, path, width, height, pix_fmt, audio_settings=None,
+            max_frames=16, remux=False, bitstream_filter=None, first=None,
+            last=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.pix_fmt = pix_fmt
+        self.audio_settings = audio_settings
+        self.remux = remux
+        self.bitstream_filter = bitstream_filter
+        self.first = first
+        self.last = last
+        self.queue = queue.Queue(maxsize=max(1, max_frames))
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __repr__(self):
+        return '<ClipReader %s>' % self.path
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            container = av.open(self.path, metadata_errors='ignore')
+        except BaseException as e:
+            self._put(e)
+            self._put(self._end)
+            return
+        try:
+            for item in self._iter_items(container):
+                if not self._put(item):
+                    return
+        except BaseException as e:
+            self._put(e)
+        finally:
+            container.close()
+            self._put(self._end)
+
+    def _iter_items(self, container):
+        # Audio and video are demuxed together, in a single pass.
+        video_stream = container.streams.video[0]
+        streams = [video_stream]
+        if not self.remux:
+            video_stream.thread_type = 'AUTO'  # Important for performance
+        audio_stream = resampler = None
+        if self.audio_settings and container.streams.audio:
+            audio_stream = container.streams.audio[0]
+            audio_stream.thread_type = 'AUTO'
+            streams.append(audio_stream)
+            resampler = get_resampler(audio_stream, *self.audio_settings)
+        bitstream_filter = None
+        if self.remux and self.bitstream_filter:
+            bitstream_filter = av.bitstream.BitStreamFilterContext(
+                self.bitstream_filter, video_stream)
+        start_time = video_stream.start_time or 0
+
+        # In/out points, in seconds from the start of the video:
+        rate = video_stream.average_rate
+        first = self.first or 0
+        start, end = fractions.Fraction(first) / rate, None
+        if self.last is not None:
+            end = fractions.Fraction(self.last + 1) / rate
+        if first:
+            # Seek to the previous keyframe, frames before are dropped
+            container.seek(
+                start_time + int(start / video_stream.time_base),
+                stream=video_stream)
+        offset = start_time * video_stream.time_base
+        video_done, audio_done = False, audio_stream is None
+        index = first - 1
+
+        for packet in container.demux(streams):
+            if packet.stream.index != video_stream.index:
+                if audio_done:
+                    continue
+                if end is not None and packet.pts is not None and (
+                        packet.pts * packet.time_base - offset >= end):
+                    audio_done = True
+                    continue
+                for frame in packet.decode():
+                    frame = trim_audio_frame(
+                        frame, start + offset, end and end + offset)
+                    if frame is None:
+                        continue
+                    for frame in resampler.resample(frame) if resampler \
+                            else (frame, ):
+                        yield 'audio', frame
+            elif video_done:
+                continue
+            elif not self.remux:
+                for frame in packet.decode():
+                    index = index + 1 if frame.pts is None else round(
+                        (frame.pts - start_time) * video_stream.time_base *
+                        rate)
+                    if index < first:
+                        continue
+                    if self.last is not None and index > self.last:
+                        video_done = True
+                        break
+                    yield 'video', frame.reformat(
+                        width=self.width, height=self.height,
+                        format=self.pix_fmt)
+            elif packet.size:
+                packets = (packet, )
+                if bitstream_filter:
+                    packets = bitstream_filter.filter(packet)
+                for packet in packets:
+                    yield 'packet', shift_packet(packet, start_time)
+            if video_done and audio_done:
+                break
+        if bitstream_filter:
+            for packet in bitstream_filter.filter(None):
+                yield 'packet', shift_packet(packet, start_time)
+        if resampler:
+            for frame in resampler.resample(None):
+                yield 'audio', frame
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is self._end:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self):
+        """Stop the worker thread and release the queued frames."""
+        self._stopped.set()
+        while self._thread.is_alive():
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join(0.1)
+
+
+class VideoPacketWriter(object):
+    """
+    Mux the video packets of consecutive clips with continuous timestamps,
+    counted in frames. Clips are either encoded, or remuxed as they are.
+
+    - encoder (CodecContext) Shared by all clips, flushed at the end. If
+        None, each encoded clip gets its own encoder from @create_encoder,
+        flushed at the end of the clip, so remuxed clips can follow.
+    """
+    def __init__(self, output, stream, fps, encoder=None, create_encoder=None):
+        self.output = output
+        self.stream = stream
+        self.time_base = 1 / fractions.Fraction(fps)
+        self.encoder = encoder
+        self.create_encoder = create_encoder
+        self.frames = 0
+        self.size = 0  # bytes muxed
+        self._last_dts = None
+        self._clip_encoder = None
+        self._offset = 0
+
+    def _mux(self, packet, offset):
+        scale = packet.time_base / self.time_base
+        pts = int(round(packet.pts * scale)) + offset
+        dts = pts if packet.dts is None else (
+            int(round(packet.dts * scale)) + offset)
+        if self._last_dts is not None and dts <= self._last_dts:
+            dts = min(self._last_dts + 1, pts)
+        self._last_dts = dts
+        packet.pts, packet.dts = pts, dts
+        packet.duration = 1
+        packet.time_base = self.time_base
+        packet.stream = self.stream
+        self.size += packet.size
+        self.output.mux(packet)
+
+    def start_clip(self, remux=False):
+        """Timestamps of remuxed clips and clip encoders start at 0."""
+        self._offset = 0 if self.encoder and not remux else self.frames
+        if not remux and not self.encoder:
+            self._clip_encoder = self.create_encoder()
+
+    def encode(self, frame):
+        frame.pts = self.frames - self._offset
+        frame.time_base = self.time_base
+        self.frames += 1
+        for packet in (self.encoder or self._clip_encoder).encode(frame):
+            self._mux(packet, self._offset)
+
+    def remux(self, packet):
+        """Mux a clip packet, the clip pts starting at 0."""
+        self._mux(packet, self._offset)
+        self.frames += 1
+
+    def end_clip(self):
+        if self._clip_encoder:
+            for packet in self._clip_encoder.encode(None):
+                self._mux(packet, self._offset)
+            self._clip_encoder = None
+
+    def flush(self):
+        if self.encoder:
+            for packet in self.encoder.encode(None):
+                self._mux(packet, 0)
+
+
+class ProgressReporter(object):
+    """
+    Create ConcatenateProgress events, at most every @interval seconds
+    (except the last one).
+
+    - total_frames (int) Used to compute the ETA, None if unknown
+    """
+    def __init__(self, clips, total_frames=None, interval=0.5):
+        self.clips = clips
+        self.total_frames = total_frames
+        self.interval = interval
+        self.start_time = time.perf_counter()
+        self._last_time = None
+
+    def update(self, clip, frame, total_size, done=False):
+        """Return a ConcatenateProgress, or None if throttled."""
+        now = time.perf_counter()
+        if not done and self._last_time is not None and (
+                now - self._last_time < self.interval):
+            return None
+        self._last_time = now
+        elapsed = now - self.start_time
+        fps = frame / elapsed if elapsed > 0 and frame else None
+        eta = None
+        if done:
+            eta = 0.0
+        elif self.total_frames and fps:
+            eta = max(0.0, (self.total_frames - frame) / fps)
+        return ConcatenateProgress(
+            clip, self.clips, frame, self.total_frames, fps, total_size, eta,
+            done)
+
+
+def shift_packet(packet, offset):
+    """Shift packet timestamps by -@offset (in its time base)."""
+    packet.pts -= offset
+    if packet.dts is not None:
+        packet.dts -= offset
+    return packet
+
+
+def trim_audio_frame(frame, start, end=None):
+    """
+    Return the part of an audio frame between @start and @end (in seconds),
+    or None if the frame is outside.
+    """
+    if frame.pts is None:
+        return frame
+    time = frame.pts * frame.time_base
+    first = min(max(0, round((start - time) * frame.sample_rate)),
+                frame.samples)
+    last = frame.samples
+    if end is not None:
+        last = min(max(0, round((end - time) * frame.sample_rate)), last)
+    if first >= last:
+        return None
+    if first == 0 and last == frame.samples:
+        return frame
+    fifo = av.AudioFifo()
+    frame.pts = None
+    fifo.write(frame)
+    if first:
+        fifo.read(first)
+    return fifo.read(last - first)
+
+
+def get_resampler(audio_stream, audio_format, audio_layout, sample_rate):
+    """Return an AudioResampler if the stream audio needs conversion."""
+    if (audio_stream.format.name == audio_format and
+            audio_stream.layout.name == audio_layout and
+            audio_stream.rate == sample_rate):
+        return None
+    return av.AudioResampler(
+        format=audio_format, layout=audio_layout, rate=sample_rate)
+
+
+def get_parameter_sets(codec_context):
+    """
+    Return the codec extradata to compare streams, with H.264 parameter sets
+    (SPS and PPS) read from avcC (e.g. mov) or Annex B (encoders) formats.
+    """
+    extradata = codec_context.extradata
+    if not extradata or codec_context.name not in ('h264', 'libx264'):
+        return extradata or None
+    units = []
+    if extradata[0] == 1:  # avcC
+        offset = 5
+        for mask in (31, 255):  # SPS count is on 5 bits, PPS on 8 bits
+            count = extradata[offset] & mask
+            offset += 1
+            for _ in range(count):
+                size = int.from_bytes(extradata[offset:offset + 2], 'big')
+                units.append(extradata[offset + 2:offset + 2 + size])
+                offset += 2 + size
+    else:
+        units = [
+            unit.rstrip(b'\x00')
+            for unit in extradata.split(b'\x00\x00\x01') if unit]
+    return tuple(unit for unit in units if unit and unit[0] & 31 in (7, 8))
+
+
+def get_remux_params(stream_or_path):
+    """
+    Return the parameters (codec, width, height, pix_fmt, frame rate and
+    parameter sets) which need to match to remux a clip without decoding.
+    """
+    if isinstance(stream_or_path, str):
+        with av.open(stream_or_path, metadata_errors='ignore') as container:
+            return get_remux_params(container.streams.video[0])
+    context = stream_or_path.codec_context
+    return (
+        context.codec.id, context.width, context.height,
+        context.format and context.format.name,
+        stream_or_path.average_rate, get_parameter_sets(context))
+
+
+def create_video_encoder(
+        video_codec, width, height, pix_fmt, fps, options=None, flags=None):
+    """Standalone encoder, configured like an output stream."""
+    encoder = av.CodecContext.create(video_codec, 'w')
+    encoder.width = width
+    encoder.height = height
+    encoder.pix_fmt = pix_fmt
+    encoder.framerate = fractions.Fraction(fps)
+    encoder.time_base = 1 / fractions.Fraction(fps)
+    if flags is not None:
+        encoder.flags = flags
+    if options:
+        encoder.options = dict(options)
+    encoder.open()
+    return encoder
+
+
+def get_frame_size(width, height, pix_fmt):
+    """Return the size in bytes of a decoded frame."""
+    frame = av.VideoFrame(width, height, pix_fmt)
+    return sum(plane.buffer_size for plane in frame.planes)
+
+
+def get_layout_name(audio_stream):
+    """
+    Unspecified layouts (e.g. "1 channels" in wav files) cannot be encoded,
+    use the default layout for their channel count.
+    """
+    name = audio_stream.layout.name
+    if name.endswith('channels'):
+        name = DEFAULT_LAYOUTS.get(audio_stream.channels, name)
+    return name
+
+
+def _iter_sound_frames(
+        sound_path, sound_offset, audio_format, audio_layout,
+        audio_sample_rate):
+    if sound_offset and sound_offset > 0:
+        yield create_silence(
+            audio_format, audio_layout, audio_sample_rate,
+            int(round(sound_offset * audio_sample_rate)))
+    skip = 0
+    if sound_offset and sound_offset < 0:
+        skip = int(round(-sound_offset * audio_sample_rate))
+    resampler = av.AudioResampler(
+        format=audio_format, layout=audio_layout, rate=audio_sample_rate)
+    fifo = av.AudioFifo(
+        format=audio_format, layout=audio_layout,
+        sample_rate=audio_sample_rate)
+    container = av.open(sound_path, metadata_errors='ignore')
+    try:
+        stream = container.streams.audio[0]
+        stream.thread_type = 'AUTO'
+        for frame in container.decode(stream):
+            for frame in resampler.resample(frame):
+                if not skip:
+                    yield frame
+                    continue
+                frame.pts = None
+                fifo.write(frame)
+                dropped = min(skip, fifo.samples)
+                fifo.read(dropped)
+                skip -= dropped
+                if not skip and fifo.samples:
+                    yield fifo.read()
+    finally:
+        container.close()
+
+
+def _iter_held_frames(sequence, held_frames):
+    """Decode the existing images, repeated over the missing frames."""
+    for frame_number, count in held_frames:
+        with av.open(
+                sequence.path(frame_number),
+                metadata_errors='ignore') as image:
+            frame = next(image.decode(video=0))
+        for _ in range(count):
+            yield frame
+
+
+def encode(
+        images_path,
+        output_path,
+        start=None,
+        end=None,
+        frame_rate=None,
+        sound_path=None,
+        sound_offset=None,
+        source_width=None,
+        source_height=None,
+        target_width=None,
+        target_height=None,
+        crop=False,
+        framerange=None,
+        top_left=None,
+        top_middle=None,
+        top_right=None,
+        bottom_left=None,
+        bottom_middle=None,
+        bottom_right=None,
+        top_left_color=None,
+        top_middle_color=None,
+        top_right_color=None,
+        bottom_left_color=None,
+        bottom_middle_color=None,
+        bottom_right_color=None,
+        font_path=None,
+        font_scale=1.0,
+        overlay_image=None,
+        rectangles=None,
+        video_codec='libx264',
+        video_codec_options=None,
+        audio_codec='aac',
+        add_silent_audio=False,
+        pix_fmt='yuv420p',
+        threads=None,
+        metadata=None,
+        overwrite=False):
+    """
+    In-process alternative to dwencode.encode.encode(), with the same
+    layout. Texts, rectangles and overlay image are composited with NumPy:
+    static parts are rasterized once and frame numbers use cached glyphs.
+
+    Differences with dwencode.encode.encode():
+    - video_codec (str) PyAV codec name. Default is libx264
+    - video_codec_options (dict) Codec options, e.g. {'crf': '18'}
+    - audio_codec (str) PyAV codec name. Default is aac
+    - pix_fmt (str) Output pixel format. Default is yuv420p
+    - threads (int) Encoder threads. Default lets the codec decide
+    - font_path (str) Font path for Pillow, not escaped for FFmpeg
+    """
+    if os.path.exists(output_path) and not overwrite:
+        raise Exception('%s already exists.' % output_path)
+    frame_rate = frame_rate or 24
+
+    # Find frame range and missing images
+    images_path = conform_pattern(images_path)
+    sequence = scan_sequence(images_path)
+    if sequence:
+        start = sequence.first if start is None else start
+        end = sequence.last if end is None else end
+    start = start or 0
+    frames_count = end - start + 1 if end is not None else None
+    held_frames = None
+    if sequence and end is not None and sequence.missing(start, end):
+        print('Missing frames: %s' % sequence.missing(start, end))
+        held_frames = sequence.get_held_frames(start, end)
+
+    if held_frames:
+        source = av.open(
+            sequence.path(held_frames[0][0]), metadata_errors='ignore')
+    else:
+        source = av.open(
+            images_path, format='image2', metadata_errors='ignore',
+            options=dict(
+                start_number=str(start), framerate=str(frame_rate)))
+    source_stream = source.streams.video[0]
+    source_stream.thread_type = 'AUTO'
+    width = source_width or source_stream.codec_context.width
+    height = source_height or source_stream.codec_context.height
+    target_width = int(target_width or width)
+    target_height = int(target_height or height)
+
+    # Geometry, same as FFmpeg scale+pad or crop filters
+    image_width, x_offset, y_offset = get_padding_values(
+        width, height, target_width, target_height)
+    image_height = int(round(height * float(image_width) / width))
+
+    # Overlays
+    overlay_layer = None
+    if overlay_image:
+        from PIL import Image
+        with Image.open(overlay_image['path']) as image:
+            overlay_layer = Layer(
+                image.convert('RGBA'), overlay_image['x'], overlay_image['y'])
+
+    font_size = get_text_geometry(target_width, target_height, font_scale)[0]
+    texts = dict(
+        top_left=(top_left, top_left_color),
+        top_middle=(top_middle, top_middle_color),
+        top_right=(top_right, top_right_color),
+        bottom_left=(bottom_left, bottom_left_color),
+        bottom_middle=(bottom_middle, bottom_middle_color),
+        bottom_right=(bottom_right, bottom_right_color))
+    texts = {slot: value for slot, value in texts.items() if value[0]}
+    static_layer = Layer(render_static_layer(
+        target_width, target_height,
+        {slot: v for slot, v in texts.items() if is_static_text(v[0])},
+        rectangles, font_path, font_scale))
+    dynamic_texts = []
+    framerange = framerange or (start, end)
+    if framerange[1] is None and any(
+            text == '{framerange}' for text, _ in texts.values()):
+        raise ValueError('{framerange} needs an end frame: %s' % images_path)
+    for slot, (text, color) in texts.items():
+        if is_static_text(text):
+            continue
+        renderer = TextRenderer(color, font_path, font_size)
+        if text == '{framerange}':
+            x, y = get_framerange_anchor(
+                slot, target_width, target_height, font_scale)
+            image, offset = render_text(
+                '[%i-%i]' % framerange, color, font_path, font_size)
+            range_layer = Layer(image, x + 3 + offset[0], y + offset[1])
+            dynamic_texts.append(
+                (slot, '{frame}', renderer, (x, y), range_layer))
+        else:
+            text = format_static_text(text)
+            dynamic_texts.append((slot, text, renderer, None, None))
+
+    # Output
+    output = av.open(output_path, mode='w')
+    try:
+        for key, value in metadata or []:
+            output.metadata[key] = value
+        rate = fractions.Fraction(str(frame_rate))
+        out_video_stream = output.add_stream(
+            video_codec, rate=rate, options=video_codec_options)
+        out_video_stream.pix_fmt = pix_fmt
+        out_video_stream.width = target_width
+        out_video_stream.height = target_height
+        if threads:
+            out_video_stream.codec_context.thread_count = threads
+        video_time_base = 1 / rate
+
+        audio_writer = None
+        if sound_path:
+            with av.open(sound_path, metadata_errors='ignore') as sound:
+                sound_stream = sound.streams.audio[0]
+                audio_sample_rate = sound_stream.rate
+                audio_layout = get_layout_name(sound_stream)
+        elif add_silent_audio:
+            audio_sample_rate, audio_layout = 48000, 'mono'
+        if sound_path or add_silent_audio:
+            out_audio_stream = output.add_stream(
+                audio_codec, rate=audio_sample_rate)
+            out_audio_stream.layout = audio_layout
+            audio_format = out_audio_stream.codec_context.codec.audio_formats
+            out_audio_stream.codec_context.format = audio_format[0].name
+            frames = None
+            if sound_path:
+                frames = _iter_sound_frames(
+                    sound_path, sound_offset, audio_format[0].name,
+                    audio_layout, audio_sample_rate)
+            audio_writer = AudioStreamWriter(
+                output, out_audio_stream, frames)
+
+        images = source.decode(source_stream)
+        if held_frames:
+            images = _iter_held_frames(sequence, held_frames)
+        frame_index = 0
+        for frame in images:
+            if frames_count is not None and frame_index >= frames_count:
+                break
+            array = frame.to_ndarray(format='rgb24')
+            if overlay_layer:
+                overlay_layer.composite(array)
+            if crop:
+                array = array[100:100 + target_height, :target_width]
+                canvas = np.zeros(
+                    (target_height, target_width, 3), dtype=np.uint8)
+                canvas[:array.shape[0], :array.shape[1]] = array
+            else:
+                scaled = av.VideoFrame.from_ndarray(array, format='rgb24')
+                scaled = scaled.reformat(
+                    width=image_width, height=image_height).to_ndarray()
+                canvas = np.zeros(
+                    (target_height, target_width, 3), dtype=np.uint8)
+                canvas[y_offset:y_offset + image_height,
+                       x_offset:x_offset + image_width] = scaled
+            static_layer.composite(canvas)
+            frame_number = str(start + frame_index)
+            for slot, text, renderer, anchor, range_layer in dynamic_texts:
+                text = text.replace('{frame}', frame_number)
+                text_width = renderer.get_width(text)
+                if anchor:
+                    x, y = anchor[0] - 3 - text_width, anchor[1]
+                    range_layer.composite(canvas)
+                else:
+                    x, y = get_text_position(
+                        slot, text_width, target_width, target_height,
+                        font_scale)
+                renderer.composite(canvas, text, x, y)
+
+            out_frame = av.VideoFrame.from_ndarray(canvas, format='rgb24')
+            out_frame = out_frame.reformat(format=pix_fmt)
+            out_frame.pts = frame_index
+            out_frame.time_base = video_time_base
+            for packet in out_video_stream.encode(out_frame):
+                output.mux(packet)
+            frame_index += 1
+            if audio_writer:
+                audio_writer.write_until(frame_index / rate)
+
+        for packet in out_video_stream.encode():
+            output.mux(packet)
+        if audio_writer:
+            audio_writer.write_until(frame_index / rate, final=True)
+            audio_writer.flush()
+    finally:
+        output.close()
+        source.close()
+
 
 def concatenate_videos(
         paths,
@@ -17,8 +848,31 @@ def concatenate_videos(
         audio_codec='aac',
         pix_fmt='yuv420p',
         audio_format=None,
-        audio_layout=None):
+        audio_layout=None,
+        prefetch=DEFAULT_PREFETCH,
+        max_memory=DEFAULT_PREFETCH_MEMORY,
+        remux=True,
+        trims=None,
+        progress_interval=DEFAULT_PROGRESS_INTERVAL):
+    """
+    Decode and re-encode movies one after the other into @output_path.
+    Yield ConcatenateProgress events (clip index, frames written and total,
+    fps, bytes muxed, ETA), at most every @progress_interval seconds, and
+    a last one with done=True. Messages are sent to the "dwencode.pyav"
+    logger.
 
+    - prefetch (int) Number of next clips opened and decoded on worker
+        threads while the current clip is encoded
+    - max_memory (int) Maximum size in bytes of the decoded frames waiting
+        to be encoded, shared by the prefetched clips
+    - remux (bool) Copy the packets of the clips already matching the output
+        codec, size, frame rate, pixel format and codec parameters, without
+        decoding them. Only the other clips are decoded and encoded.
+    - trims (list) (first frame, last frame) per movie (frames start at 0,
+        None keeps the whole movie, or the movie end as last frame). Movies
+        are decoded from the keyframe before the first frame to the last
+        frame only, audio is cut to match. See concatenate.read_edl().
+    """
     output = av.open(output_path, mode='w')
     try:
         for data in _concatenate_videos(
@@ -32,7 +886,12 @@ def concatenate_videos(
                 audio_codec=audio_codec,
                 pix_fmt=pix_fmt,
                 audio_format=audio_format,
-                audio_layout=audio_layout):
+                audio_layout=audio_layout,
+                prefetch=prefetch,
+                max_memory=max_memory,
+                remux=remux,
+                trims=trims,
+                progress_interval=progress_interval):
             yield data
     finally:
         output.close()
@@ -51,7 +910,12 @@ def _concatenate_videos(
         audio_codec_options=None,
         pix_fmt='yuv420p',
         audio_format=None,
-        audio_layout=None):
+        audio_layout=None,
+        prefetch=DEFAULT_PREFETCH,
+        max_memory=DEFAULT_PREFETCH_MEMORY,
+        remux=True,
+        trims=None,
+        progress_interval=DEFAULT_PROGRESS_INTERVAL):
 
     # Get info from first video
     if not all([
@@ -60,7 +924,7 @@ def _concatenate_videos(
         try:
             temp = av.open(paths[0], metadata_errors='ignore')
         except:
-            print(paths[0])
+            logger.error('Cannot open %s', paths[0])
             raise
         first_video_stream = temp.streams.video[0]
         if not fps:
@@ -69,133 +933,156 @@ def _concatenate_videos(
             width = first_video_stream.format.width
         if not height:
             height = first_video_stream.format.height
-        try:
+        if temp.streams.audio:
             first_audio_stream = temp.streams.audio[0]
             if not audio_sample_rate:
                 audio_sample_rate = first_audio_stream.time_base.denominator
             if not audio_layout:
-                audio_layout = first_audio_stream.layout.name
+                audio_layout = get_layout_name(first_audio_stream)
             if not audio_format:
                 audio_format = first_audio_stream.format.name
-        except IndexError:
-            first_audio_stream = None
         temp.close()
-    print(f'Encoding to {width}x{height} {fps} fps')
-
-    # Create a video stream (H.264 codec, 30 fps)
-    out_video_stream = output.add_stream(
-        video_codec, rate=fps, options=video_codec_options)
-    out_video_stream.pix_fmt = pix_fmt
-    out_video_stream.width = width
-    out_video_stream.height = height
-    # Output audio stream
-    out_audio_stream = None
-    if first_audio_stream is not None:
+    logger.info('Encoding to %ix%i %s fps', width, height, fps)
+
+    # Clips matching the output parameters are remuxed, if not trimmed:
+    trims = trims or [None] * len(paths)
+    remux_flags = [False] * len(paths)
+    clips_params = []
+    if remux:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clips_params = list(executor.map(get_remux_params, paths))
+    output_params = (
+        av.Codec(video_codec, 'w').id, width, height, pix_fmt,
+        fractions.Fraction(fps))
+    if clips_params and not any(trims) and (
+            clips_params[0][:5] == output_params) and all(
+            params == clips_params[0] for params in clips_params):
+        # Uniform clips: only remux, with the codec parameters of the first
+        with av.open(paths[0], metadata_errors='ignore') as container:
+            out_video_stream = output.add_stream_from_template(
+                container.streams.video[0])
+        remux_flags = [True] * len(paths)
+        video_writer = VideoPacketWriter(output, out_video_stream, fps)
+    else:
+        # Create a video stream (H.264 codec, 30 fps)
+        out_video_stream = output.add_stream(
+            video_codec, rate=fps, options=video_codec_options)
+        out_video_stream.pix_fmt = pix_fmt
+        out_video_stream.width = width
+        out_video_stream.height = height
+
+        def create_encoder():
+            return create_video_encoder(
+                video_codec, width, height, pix_fmt, fps,
+                video_codec_options, out_video_stream.codec_context.flags)
+        if clips_params:
+            encoder_params = output_params + (
+                get_parameter_sets(create_encoder()),)
+            remux_flags = [
+                params == encoder_params and not trim
+                for params, trim in zip(clips_params, trims)]
+        if any(remux_flags):
+            # Encoded clips are closed, so remuxed clips can follow
+            video_writer = VideoPacketWriter(
+                output, out_video_stream, fps,
+                create_encoder=create_encoder)
+        else:
+            video_writer = VideoPacketWriter(
+                output, out_video_stream, fps,
+                encoder=out_video_stream.codec_context)
+    logger.info('%i/%i clips remuxed', sum(remux_flags), len(paths))
+    # Output audio stream, if the first clip has audio
+    audio_writer = audio_settings = None
+    if audio_sample_rate and audio_layout:
         out_audio_stream = output.add_stream(
             audio_codec, options=audio_codec_options)
         out_audio_stream.rate = audio_sample_rate
-        # out_audio_stream.channels = 2
         out_audio_stream.layout = audio_layout
-        audio_time_base = fractions.Fraction(1, audio_sample_rate)
-
-    # Global time counter
-    frame_pts = 0  # Monotonically increasing PTS across all videos
-    audio_pts = 0
-    video_time_base = fractions.Fraction(1, fps)
+        codec_formats = [
+            f.name for f in out_audio_stream.codec_context.codec.audio_formats
+            or ()]
+        if codec_formats:
+            out_audio_stream.codec_context.format = (
+                audio_format if audio_format in codec_formats
+                else codec_formats[0])
+        audio_writer = AudioStreamWriter(output, out_audio_stream)
+        # Clips audio is resampled to the encoder format, if needed
+        audio_settings = (
+            audio_writer.format, audio_writer.layout, audio_sample_rate)
 
-    # Write each frame
+    # Clips are decoded ahead on worker threads, within the memory limit:
+    prefetch = max(1, prefetch + 1)
+    max_frames = max_memory // (
+        get_frame_size(width, height, pix_fmt) * prefetch)
+    readers = deque()
     count = len(paths)
-    for i, path in enumerate(paths):
-        basename = os.path.basename(path)
-        print(f'{i + 1}/{count}: {basename}')
-        yield i, count
+    bitstream_filter = None
+    if not all(remux_flags):
+        bitstream_filter = ANNEXB_FILTERS.get(
+            av.Codec(video_codec, 'w').canonical_name)
 
-        # Handle Video
-        container = av.open(path, metadata_errors='ignore')
-        video_stream = container.streams.video[0]
-        # Set output image size
-        video_stream.thread_type = 'AUTO'  # Important for performance
-        decoder = container.decode(video_stream)
-        for frame in decoder:
-            frame = frame.reformat(width=width, height=height, format=pix_fmt)
-            frame.pts = frame_pts
-            frame.time_base = video_time_base
-            frame_pts += 1
-            for packet in out_video_stream.encode(frame):
-                output.mux(packet)
+    def start_readers(index):
+        for j in range(index + len(readers), min(index + prefetch, count)):
+            readers.append(ClipReader(
+                paths[j], width, height, pix_fmt, audio_settings,
+                max_frames, remux_flags[j], bitstream_filter,
+                *(trims[j] or (None, None))).start())
 
-        # Handle Audio
-        if first_audio_stream is None:
-            continue
-        container.seek(0)
-        video_duration = video_stream.duration * video_stream.time_base
-        expected_audio_samples = int(video_duration * audio_sample_rate)
-        raw_samples = av.AudioFifo(
-            format=audio_format,
-            layout=audio_layout,
-            sample_rate=audio_sample_rate)
-        try:
-            audio_stream = container.streams.audio[0]
-        except IndexError:
-            # No audio, add silence:
-            print('Silent audio')
-            raw_samples.write(create_silence(
-                audio_format, audio_layout, audio_sample_rate,
-                expected_audio_samples))
-        else:
-            needs_resampling = (
-                audio_stream.layout.name != audio_layout
-                or audio_stream.time_base.denominator != audio_sample_rate
-                or audio_stream.format.name
-            )
-            audio_stream.thread_type = 'AUTO'  # Important for performance
-            samples = []
-            for audio_frame in container.decode(audio_stream):
-                if needs_resampling:
-                    audio_resampler = av.AudioResampler(
-                        format=audio_format,
-                        layout=audio_layout,
-                        rate=audio_sample_rate)
-                    for audio_frame in audio_resampler.resample(audio_frame):
-                        samples.append(audio_frame)
+    def get_size():
+        return video_writer.size + (audio_writer.size if audio_writer else 0)
+
+    # Write each frame
+    reporter = ProgressReporter(
+        count, get_total_frames(paths, trims), progress_interval)
+    try:
+        for i, path in enumerate(paths):
+            logger.info('%i/%i: %s', i + 1, count, os.path.basename(path))
+            start_readers(i)
+            # Kept in the queue until consumed, to be closed on errors
+            reader = readers[0]
+            video_writer.start_clip(reader.remux)
+            for kind, data in reader:
+                if kind == 'audio':
+                    # Audio is encoded as it comes, up to the video written
+                    if audio_writer:
+                        audio_writer.write(data, fractions.Fraction(
+                            video_writer.frames, fps))
+                    continue
+                if kind == 'packet':
+                    video_writer.remux(data)
                 else:
-                    samples.append(audio_frame)
-            # Flatten and rebuild audio frame list
-            for audio_frame in samples:
-                audio_frame.pts = None
-                raw_samples.write(audio_frame)
-            total_samples = raw_samples.samples
-            sample_diff = expected_audio_samples - total_samples
-            # Adjust duration
-            if sample_diff > 0:
-                print('pad audio')
-                # Pad with silence
-                silent_frame = av.AudioFrame(
-                    audio_format, audio_layout, sample_diff)
-                silent_frame.sample_rate = audio_sample_rate
-                for plane in silent_frame.planes:
-                    plane.update(np.zeros(
-                        sample_diff, dtype=np.float32).tobytes())
-                raw_samples.write(silent_frame)
-            elif sample_diff < 0:
-                print('trim audio')
-                raw_samples.read(-sample_diff)  # Trim excess
-
-        # Write audio frames
-        while raw_samples.samples > 0:
-            frame = raw_samples.read(min(1024, raw_samples.samples))
-            frame.pts = audio_pts
-            frame.time_base = audio_time_base
-            audio_pts += frame.samples
-            for packet in out_audio_stream.encode(frame):
-                output.mux(packet)
+                    video_writer.encode(data)
+                event = reporter.update(i, video_writer.frames, get_size())
+                if event:
+                    yield event
+            readers.popleft()
+            video_writer.end_clip()
+            if audio_writer:
+                audio_writer.end_clip(
+                    fractions.Fraction(video_writer.frames, fps))
+    finally:
+        for reader in readers:
+            reader.close()
 
     # Flush encoder
-    for packet in out_video_stream.encode():
-        output.mux(packet)
-    if out_audio_stream is not None:
-        for packet in out_audio_stream.encode():
-            output.mux(packet)
+    video_writer.flush()
+    if audio_writer:
+        audio_writer.flush()
+    yield reporter.update(count - 1, video_writer.frames, get_size(), True)
+
+
+def get_total_frames(paths, trims=None):
+    """Return the frames count of the (trimmed) clips, None if unknown."""
+    total = 0
+    infos = get_movies_infos(paths)
+    for info, trim in zip(infos, trims or [None] * len(paths)):
+        first, last = trim or (0, None)
+        if last is None:
+            if not info.get('frames'):
+                return None
+            last = info['frames'] - 1
+        total += max(0, last - first + 1)
+    return total
 
 
 def create_silence(
@@ -0,0 +1,147 @@
+"""
+Image sequences scanning: frame range, padding and missing frames.
+"""
+
+__author__ = 'Olivier Evers'
+__copyright__ = 'DreamWall'
+__license__ = 'MIT'
+
+
+import os
+import re
+import bisect
+import tempfile
+import threading
+
+
+FRAME_PATTERN = re.compile(r'%(0?(\d+))?d')
+
+_directories_cache = dict()
+_cache_lock = threading.Lock()
+
+
+def conform_pattern(images_path):
+    """Convert "image.####.jpg" to "image.%04d.jpg"."""
+    for i in range(8, 0, -1):
+        images_path = images_path.replace('#' * i, '%0{}d'.format(i))
+    return images_path
+
+
+def list_directory(directory):
+    """
+    Return the file names of a directory with a single os.scandir pass.
+    Result is cached until the directory modification time changes.
+    """
+    mtime = os.stat(directory).st_mtime_ns
+    with _cache_lock:
+        cached = _directories_cache.get(directory)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with os.scandir(directory) as entries:
+        names = [e.name for e in entries if e.is_file()]
+    with _cache_lock:
+        _directories_cache[directory] = (mtime, names)
+    return names
+
+
+class ImageSequence(object):
+    def __init__(self, pattern, frames, padding):
+        self.pattern = pattern
+        self.frames = sorted(frames)
+        self.padding = padding
+        self._frames_set = set(frames)
+
+    def __repr__(self):
+        return '<ImageSequence %s [%i-%i], %i missing>' % (
+            self.pattern, self.first, self.last, len(self.missing()))
+
+    @property
+    def first(self):
+        return self.frames[0]
+
+    @property
+    def last(self):
+        return self.frames[-1]
+
+    def path(self, frame):
+        return self.pattern % frame
+
+    def missing(self, start=None, end=None):
+        start = self.first if start is None else start
+        end = self.last if end is None else end
+        return [f for f in range(start, end + 1) if f not in self._frames_set]
+
+    def get_existing_frame(self, frame):
+        """Return frame if it exists, else previous existing frame (or next
+        one if there is no previous frame)."""
+        index = bisect.bisect_right(self.frames, frame)
+        return self.frames[max(index - 1, 0)]
+
+    def get_held_frames(self, start, end):
+        """
+        Return [(frame, count)] covering [start, end], holding the previous
+        existing frame over the gaps.
+        """
+        held_frames = []
+        for frame in range(start, end + 1):
+            existing_frame = self.get_existing_frame(frame)
+            if held_frames and held_frames[-1][0] == existing_frame:
+                held_frames[-1][1] += 1
+            else:
+                held_frames.append([existing_frame, 1])
+        return [tuple(f) for f in held_frames]
+
+
+def scan_sequence(images_path):
+    """
+    Find existing frames of an image sequence pattern (e.g. "img.%04d.jpg"
+    or "img.####.jpg"). Return None if no frame is found.
+    """
+    images_path = conform_pattern(images_path)
+    directory, basename = os.path.split(images_path)
+    match = FRAME_PATTERN.search(basename)
+    if not match or not os.path.isdir(directory or '.'):
+        return None
+    padding = int(match.group(2) or 0)
+    regex = re.compile('^%s(-?\\d+)%s$' % (
+        re.escape(basename[:match.start()]),
+        re.escape(basename[match.end():])))
+    frames = []
+    for name in list_directory(directory or '.'):
+        frame_match = regex.match(name)
+        if not frame_match:
+            continue
+        digits = frame_match.group(1).lstrip('-')
+        if len(digits) < padding or (
+                len(digits) > max(padding, 1) and digits.startswith('0')):
+            continue  # same pattern but different padding
+        frames.append(int(frame_match.group(1)))
+    if not frames:
+        return None
+    return ImageSequence(images_path, frames, padding)
+
+
+def escape_concat_path(path):
+    """Absolute path, quoted for a "file '...'" line of a concat list."""
+    return os.path.abspath(path).replace('\\', '/').replace("'", "'\\''")
+
+
+def create_hold_list_file(sequence, start, end, frame_rate):
+    """
+    Write an FFmpeg concat demuxer list of the [start, end] images, where
+    missing frames hold the previous image. Return the list path.
+    """
+    lines = ['ffconcat version 1.0']
+    held_frames = sequence.get_held_frames(start, end)
+    for frame, count in held_frames:
+        lines.append("file '%s'" % escape_concat_path(sequence.path(frame)))
+        lines.append('duration %.9f' % (count / float(frame_rate)))
+    # The last duration is only used if the file is repeated:
+    lines.append(
+        "file '%s'" % escape_concat_path(sequence.path(held_frames[-1][0])))
+
+    handle, list_path = tempfile.mkstemp(
+        prefix='dwencode_sequence_', suffix='.txt')
+    with os.fdopen(handle, 'w') as f:
+        f.write('\n'.join(lines))
+    return list_path.replace('\\', '/')